@@ -0,0 +1,286 @@
+"""
+Lossless compression of Intan int16 amplifier files
+
+The bulk of every transfer is per-channel amp-*.dat files of little-endian
+int16 samples. Neighbouring samples are close, so after delta encoding
+most values are small, and after splitting low and high bytes into
+separate runs (byte-shuffle) the high bytes are nearly constant. Both
+steps are computed in NumPy over fixed-size blocks and followed by a
+stdlib codec (zlib or lzma).
+
+Compressed file layout (all little-endian):
+    header: magic, version, codec, filter, original size, original mtime
+    blocks: raw length (uint32), compressed length (uint32), payload
+    end:    a block header with raw length 0
+    trailer: digest of the original contents
+
+Each block is filtered and compressed on its own, so blocks can be decoded
+independently.
+
+usage: python -m src.amp_compression decompress <file.blz> [--out OUT]
+       python -m src.amp_compression compress <file.dat> [--codec {zlib,lzma}]
+       python -m src.amp_compression benchmark <file.dat> [--sample_mb N]
+"""
+
+import os
+import zlib
+import lzma
+import struct
+import hashlib
+import argparse
+from fnmatch import fnmatch
+from time import perf_counter
+
+
+MAGIC = b'BLZ1'
+VERSION = 1
+COMPRESSED_SUFFIX = '.blz'
+# Files compressed in compressed transfer mode
+COMPRESS_PATTERNS = ['amp-*.dat']
+# Bytes of original data per block, kept even so blocks hold whole samples
+BLOCK_SIZE = 4 * 1024 * 1024
+DIGEST_ALGORITHM = 'blake2b'
+DIGEST_SIZE = hashlib.new(DIGEST_ALGORITHM).digest_size
+
+HEADER = struct.Struct('<4sBBBxQd')
+BLOCK_HEADER = struct.Struct('<II')
+
+CODECS = {'zlib': 1, 'lzma': 2}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+DEFAULT_LEVELS = {'zlib': 1, 'lzma': 0}
+FILTERS = {'none': 0, 'delta_shuffle': 1}
+FILTER_NAMES = {v: k for k, v in FILTERS.items()}
+
+##############################
+##############################
+
+def is_compressible(rel_file):
+    """Check whether rel_file is compressed in compressed transfer mode."""
+    return any(fnmatch(os.path.basename(rel_file), p) for p in COMPRESS_PATTERNS)
+
+
+def delta_shuffle(buf):
+    """
+    Delta encode int16 samples and split their low and high bytes
+
+    Differences are taken modulo 2**16 so the transform is exactly
+    reversible. A trailing odd byte is passed through unchanged.
+    """
+    # numpy is only needed once files are compressed, not by every transfer
+    import numpy as np
+    n_samples = len(buf) // 2
+    samples = np.frombuffer(buf, dtype='<u2', count=n_samples)
+    delta = np.empty_like(samples)
+    if n_samples:
+        delta[0] = samples[0]
+        np.subtract(samples[1:], samples[:-1], out=delta[1:])
+    byte_pairs = delta.view(np.uint8).reshape(-1, 2)
+    return byte_pairs.T.tobytes() + bytes(buf[2 * n_samples:])
+
+
+def undo_delta_shuffle(buf):
+    """Invert delta_shuffle."""
+    import numpy as np
+    n_samples = len(buf) // 2
+    byte_runs = np.frombuffer(buf, dtype=np.uint8, count=2 * n_samples).reshape(2, -1)
+    delta = byte_runs[0].astype('<u2') | (byte_runs[1].astype('<u2') << 8)
+    samples = np.cumsum(delta, dtype='<u2')
+    return samples.tobytes() + bytes(buf[2 * n_samples:])
+
+
+def compress_block(buf, codec, level, filter_name='delta_shuffle'):
+    """Filter and compress one block."""
+    if filter_name == 'delta_shuffle':
+        buf = delta_shuffle(buf)
+    if codec == 'zlib':
+        return zlib.compress(buf, level)
+    return lzma.compress(buf, preset=level)
+
+
+def decompress_block(payload, codec, filter_name='delta_shuffle'):
+    """Decompress and unfilter one block."""
+    if codec == 'zlib':
+        buf = zlib.decompress(payload)
+    else:
+        buf = lzma.decompress(payload)
+    if filter_name == 'delta_shuffle':
+        buf = undo_delta_shuffle(buf)
+    return buf
+
+
+def compress_stream(src, dst, src_size, src_mtime, codec='zlib', level=None,
+                    filter_name='delta_shuffle', on_block=None, write=None):
+    """
+    Compress the open file src into the open file dst
+
+    Inputs:
+        src_size, src_mtime: stored in the header so a compressed copy can
+            be checked against its source without decompressing it
+        on_block: called with the number of original bytes of each block
+        write: called as write(dst, buf) instead of dst.write(buf)
+
+    Returns:
+        n_bytes: number of compressed bytes written
+        src_digest: digest of the original contents
+    """
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if write is None:
+        write = lambda f, buf: f.write(buf)
+    src_digest = hashlib.new(DIGEST_ALGORITHM)
+
+    n_bytes = 0
+    def _write(buf):
+        nonlocal n_bytes
+        write(dst, buf)
+        n_bytes += len(buf)
+
+    _write(HEADER.pack(MAGIC, VERSION, CODECS[codec], FILTERS[filter_name],
+                       src_size, src_mtime))
+    while True:
+        buf = src.read(BLOCK_SIZE)
+        if not buf:
+            break
+        src_digest.update(buf)
+        payload = compress_block(buf, codec, level, filter_name)
+        _write(BLOCK_HEADER.pack(len(buf), len(payload)) + payload)
+        if on_block is not None:
+            on_block(len(buf))
+    _write(BLOCK_HEADER.pack(0, 0) + src_digest.digest())
+    return n_bytes, src_digest.hexdigest()
+
+
+def read_header(f):
+    """Read the header of an open compressed file."""
+    buf = f.read(HEADER.size)
+    if len(buf) < HEADER.size:
+        raise ValueError("Not a compressed amplifier file")
+    magic, version, codec_id, filter_id, src_size, src_mtime = HEADER.unpack(buf)
+    if magic != MAGIC:
+        raise ValueError("Not a compressed amplifier file")
+    if version != VERSION:
+        raise ValueError(f"Unsupported compressed file version: {version}")
+    return dict(
+            codec=CODEC_NAMES[codec_id],
+            filter=FILTER_NAMES[filter_id],
+            size=src_size,
+            mtime=src_mtime,
+            )
+
+
+def decompress_file(compressed_path, out_path=None):
+    """
+    Restore the original file from compressed_path
+
+    The digest of the restored contents is checked against the trailer and
+    the original mtime is restored. By default the output is written next
+    to compressed_path without the compressed suffix.
+
+    Returns the path of the restored file.
+    """
+    if out_path is None:
+        out_path = compressed_path[:-len(COMPRESSED_SUFFIX)] \
+                if compressed_path.endswith(COMPRESSED_SUFFIX) \
+                else compressed_path + '.out'
+    digest = hashlib.new(DIGEST_ALGORITHM)
+    tmp_path = out_path + '.tmp'
+    with open(compressed_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        header = read_header(src)
+        while True:
+            raw_len, comp_len = BLOCK_HEADER.unpack(src.read(BLOCK_HEADER.size))
+            if raw_len == 0:
+                break
+            buf = decompress_block(src.read(comp_len), header['codec'], header['filter'])
+            if len(buf) != raw_len:
+                raise ValueError(f"Corrupt block in {compressed_path}")
+            digest.update(buf)
+            dst.write(buf)
+        expected_digest = src.read(DIGEST_SIZE)
+    if digest.digest() != expected_digest:
+        os.remove(tmp_path)
+        raise ValueError(f"Digest mismatch when decompressing {compressed_path}")
+    os.replace(tmp_path, out_path)
+    os.utime(out_path, (header['mtime'], header['mtime']))
+    return out_path
+
+
+def benchmark(path, sample_mb=64, codecs=None):
+    """
+    Measure compression ratio and single-core speed on a sample of path
+
+    Returns a list of dicts with codec, level, filter, ratio and
+    compression / decompression speed in MB/s per core.
+    """
+    with open(path, 'rb') as f:
+        sample = f.read(int(sample_mb * 1024 * 1024))
+    blocks = [sample[i:i + BLOCK_SIZE] for i in range(0, len(sample), BLOCK_SIZE)]
+    sample_mb = len(sample) / 1024**2
+
+    if codecs is None:
+        codecs = [('zlib', 1), ('zlib', 6), ('lzma', 0), ('lzma', 1)]
+    results = []
+    for codec, level in codecs:
+        for filter_name in FILTERS:
+            start = perf_counter()
+            payloads = [compress_block(b, codec, level, filter_name) for b in blocks]
+            compress_time = perf_counter() - start
+            start = perf_counter()
+            for payload in payloads:
+                decompress_block(payload, codec, filter_name)
+            decompress_time = perf_counter() - start
+            results.append(dict(
+                codec=codec,
+                level=level,
+                filter=filter_name,
+                ratio=len(sample) / max(1, sum(len(p) for p in payloads)),
+                compress_mb_per_s=sample_mb / max(compress_time, 1e-9),
+                decompress_mb_per_s=sample_mb / max(decompress_time, 1e-9),
+                ))
+    return results
+
+
+def print_benchmark(results):
+    """Print benchmark results as a table."""
+    print(f"{'codec':>6} {'level':>5} {'filter':>14} {'ratio':>6} "
+          f"{'comp MB/s':>10} {'decomp MB/s':>12}")
+    for r in results:
+        print(f"{r['codec']:>6} {r['level']:>5} {r['filter']:>14} {r['ratio']:>6.2f} "
+              f"{r['compress_mb_per_s']:>10.1f} {r['decompress_mb_per_s']:>12.1f}")
+    print("Compression pays off when the link is slower than "
+          "comp MB/s per core x cores used for copying.")
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+            description='Compress, decompress or benchmark int16 amplifier files')
+    parser.add_argument('command', choices=['compress', 'decompress', 'benchmark'])
+    parser.add_argument('path', type=str, help='File to process.')
+    parser.add_argument('--out', type=str, default=None, help='Output path.')
+    parser.add_argument('--codec', choices=list(CODECS), default='zlib',
+                        help='Codec used by compress (default: zlib).')
+    parser.add_argument('--sample_mb', type=float, default=64,
+                        help='MB of the file used by benchmark (default: 64).')
+    return parser.parse_args()
+
+
+def main():
+    """Main function to run the script"""
+    args = parse_arguments()
+    if args.command == 'decompress':
+        out_path = decompress_file(args.path, args.out)
+        print(f"Restored: {out_path}")
+    elif args.command == 'compress':
+        out_path = args.out if args.out is not None else args.path + COMPRESSED_SUFFIX
+        src_stat = os.stat(args.path)
+        with open(args.path, 'rb') as src, open(out_path, 'wb') as dst:
+            n_bytes, _ = compress_stream(
+                    src, dst, src_stat.st_size, src_stat.st_mtime, codec=args.codec)
+        print(f"Compressed {src_stat.st_size / 1024**2:.1f} MB to "
+              f"{n_bytes / 1024**2:.1f} MB: {out_path}")
+    else:
+        print_benchmark(benchmark(args.path, sample_mb=args.sample_mb))
+
+
+if __name__ == "__main__":
+    main()
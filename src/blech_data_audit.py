@@ -0,0 +1,242 @@
+"""
+Re-verify recordings stored on the server.
+
+This script walks the recordings listed in the dataset frame, hashes their
+files and compares the digests against a baseline. The first time a file is
+seen, its baseline is taken from the transfer manifest written by
+blech_data_transfer.py if there is one (so partial copies are caught),
+otherwise the current digest is recorded. On later runs, any file whose
+size or digest differs from the baseline, or which has disappeared, is
+reported.
+
+Audits can be rate-limited so they can run nightly without saturating the
+share, and an interrupted audit can be resumed with --resume.
+"""
+
+import os
+import csv
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from datetime import datetime
+import pandas as pd
+from tqdm import tqdm
+from src.utils.utils import base_dir_path as dir_path
+from src.blech_data_sentry import get_server_path, setup_server_home_dir
+from src.transfer_engine import (
+    hash_file,
+    read_manifest,
+    RateLimiter,
+    MANIFEST_NAME,
+    PARTIAL_SUFFIX,
+)
+
+
+BASELINE_NAME = 'audit_baseline.csv'
+PROGRESS_NAME = 'audit_progress.csv'
+BASELINE_COLUMNS = ['recording_path', 'path', 'size', 'digest', 'source', 'date']
+PROGRESS_COLUMNS = ['recording_path', 'path', 'status', 'expected', 'found']
+
+
+def parse_arguments():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(
+            description='Re-verify recordings listed in the dataset frame against baseline digests')
+    parser.add_argument('--n_workers', type=int, default=4,
+                        help='Number of files hashed concurrently (default: 4)')
+    parser.add_argument('--max_mb_per_s', type=float, default=None,
+                        help='Cap on total read throughput in MB/s (default: no cap)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the last unfinished audit')
+    return parser.parse_args()
+
+
+def get_recording_paths(server_home_dir):
+    """Get the unique recording paths listed in the dataset frame and its journal"""
+    from src.dataset_handler import read_dataset_frame
+    dataset_frame_path = os.path.join(server_home_dir, 'dataset_frame.csv')
+    dataset_frame = read_dataset_frame(dataset_frame_path, server_home_dir)
+    recording_paths = dataset_frame['recording_path'].dropna().unique()
+    print(f'Found {len(recording_paths)} recordings in {dataset_frame_path}')
+    return list(recording_paths)
+
+
+def list_recording_files(recording_path):
+    """List files of a recording relative to recording_path"""
+    rel_file_list = []
+    for root, _, files in os.walk(recording_path):
+        for f in files:
+            if f == MANIFEST_NAME or f.endswith(PARTIAL_SUFFIX):
+                continue
+            rel_file_list.append(
+                    os.path.relpath(os.path.join(root, f), recording_path))
+    return sorted(rel_file_list)
+
+
+def read_csv_rows(path):
+    """Read a csv file into a list of dicts, empty if it doesn't exist"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def append_csv_rows(path, rows, fieldnames):
+    """Append rows to a csv file, writing the header if it is new"""
+    write_header = not os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def load_baseline(server_home_dir):
+    """Load baseline digests keyed by (recording_path, path)"""
+    rows = read_csv_rows(os.path.join(server_home_dir, BASELINE_NAME))
+    return {(r['recording_path'], r['path']): r for r in rows}
+
+
+def load_progress(server_home_dir):
+    """Load results of an unfinished audit"""
+    return read_csv_rows(os.path.join(server_home_dir, PROGRESS_NAME))
+
+
+def audit_recording(recording_path, baseline, executor, rate_limiter=None):
+    """
+    Hash the files of one recording and compare them against the baseline
+
+    Returns:
+        results: list of dicts with PROGRESS_COLUMNS
+        new_baseline: list of baseline rows for files seen for the first time
+    """
+    if not os.path.isdir(recording_path):
+        return [dict(recording_path=recording_path, path='', status='missing_recording',
+                     expected='', found='')], []
+
+    manifest = read_manifest(recording_path)
+    rel_file_list = list_recording_files(recording_path)
+    digests = executor.map(
+            lambda f: hash_file(os.path.join(recording_path, f), rate_limiter=rate_limiter),
+            rel_file_list)
+
+    results = []
+    new_baseline = []
+    today = datetime.now().strftime('%Y-%m-%d')
+    for rel_file, digest in zip(rel_file_list, digests):
+        size = str(os.path.getsize(os.path.join(recording_path, rel_file)))
+        expected = baseline.get((recording_path, rel_file))
+        if expected is None and rel_file in manifest:
+            expected = dict(manifest[rel_file], source='manifest')
+            new_baseline.append(dict(
+                recording_path=recording_path, path=rel_file,
+                size=expected['size'], digest=expected['digest'],
+                source='manifest', date=today))
+        if expected is None:
+            new_baseline.append(dict(
+                recording_path=recording_path, path=rel_file,
+                size=size, digest=digest, source='audit', date=today))
+            status, expected_str = 'new', ''
+        elif expected['size'] != size:
+            status, expected_str = 'size_mismatch', expected['size']
+        elif expected['digest'] != digest:
+            status, expected_str = 'digest_mismatch', expected['digest']
+        else:
+            status, expected_str = 'ok', expected['digest']
+        found = size if status == 'size_mismatch' else digest
+        results.append(dict(recording_path=recording_path, path=rel_file,
+                            status=status, expected=expected_str, found=found))
+
+    # Files in the baseline or manifest which are no longer on the server
+    present = set(rel_file_list)
+    expected_files = {p for (r, p) in baseline if r == recording_path} | set(manifest)
+    for rel_file in sorted(expected_files - present):
+        results.append(dict(recording_path=recording_path, path=rel_file,
+                            status='missing_file', expected='', found=''))
+    return results, new_baseline
+
+
+def write_report(server_home_dir, start_time):
+    """Summarize the finished audit and move progress to a dated report"""
+    progress_path = os.path.join(server_home_dir, PROGRESS_NAME)
+    results = read_csv_rows(progress_path)
+    status_counts = pd.Series([r['status'] for r in results], dtype=object).value_counts()
+    problems = [r for r in results if r['status'] not in ['ok', 'new']]
+
+    report_path = os.path.join(
+            server_home_dir, f"audit_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+    os.replace(progress_path, report_path)
+
+    print(f'Audit finished in {(time() - start_time)/60:.2f} minutes')
+    print('File status counts:')
+    print(status_counts.to_string())
+    if problems:
+        print(f'Found {len(problems)} problems:')
+        for r in problems:
+            print(f"    {r['status']}: {os.path.join(r['recording_path'], r['path'])}")
+    print(f'Report written to: {report_path}')
+    return report_path, problems
+
+
+def run_audit(server_home_dir, n_workers=4, max_mb_per_s=None, resume=False):
+    """Audit all recordings in the dataset frame"""
+    start_time = time()
+    baseline_path = os.path.join(server_home_dir, BASELINE_NAME)
+    progress_path = os.path.join(server_home_dir, PROGRESS_NAME)
+
+    recording_paths = get_recording_paths(server_home_dir)
+    if resume:
+        done = {r['recording_path'] for r in load_progress(server_home_dir)}
+        print(f'Resuming audit, {len(done)} recordings already audited')
+        recording_paths = [r for r in recording_paths if r not in done]
+    elif os.path.exists(progress_path):
+        print(f'Discarding unfinished audit: {progress_path}')
+        os.remove(progress_path)
+
+    baseline = load_baseline(server_home_dir)
+    rate_limiter = None
+    if max_mb_per_s is not None:
+        rate_limiter = RateLimiter(max_mb_per_s * 1024**2)
+        print(f'Limiting reads to {max_mb_per_s} MB/s')
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        pbar = tqdm(recording_paths)
+        for recording_path in pbar:
+            pbar.set_description(f'Auditing {os.path.basename(recording_path)}')
+            results, new_baseline = audit_recording(
+                    recording_path, baseline, executor, rate_limiter)
+            # Baseline is written before progress, so a resumed audit
+            # never sees a recording as done without its baseline
+            if new_baseline:
+                append_csv_rows(baseline_path, new_baseline, BASELINE_COLUMNS)
+            if not results:
+                results = [dict(recording_path=recording_path, path='', status='empty',
+                                expected='', found='')]
+            append_csv_rows(progress_path, results, PROGRESS_COLUMNS)
+
+    if not os.path.exists(progress_path):
+        print('No recordings to audit')
+        return None, []
+    return write_report(server_home_dir, start_time)
+
+
+def main():
+    """Main function to run the script"""
+    args = parse_arguments()
+
+    # Get and validate server path
+    server_path = get_server_path(dir_path)
+
+    # Set up server home directory
+    server_home_dir = setup_server_home_dir(server_path)
+
+    run_audit(
+            server_home_dir,
+            n_workers=args.n_workers,
+            max_mb_per_s=args.max_mb_per_s,
+            resume=args.resume,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -10,24 +10,29 @@
     5) User email
     6) Recording name
     7) Recording path
+
+- transfer_recording can be called from other scripts to transfer a
+  recording without prompting; pandas, numpy and easygui are imported
+  only where they are needed, so starting a transfer stays fast
+  (see import_budget.py)
 """
 
-import easygui
 import os
+import errno
 import argparse
-import shutil
 import sys
 import time
 from glob import glob
-import pandas as pd
 from tqdm import tqdm
-import numpy as np
-from src import dataset_handler
+from src import transfer_engine
+from src import file_bundle
+from src import copy_backends
+from src import transfer_rules
+from src import recording_fingerprint
+from src.utils.utils import base_dir_path as dir_path
 
 
-# Load path to the blech server
-script_path = os.path.realpath(__file__)
-dir_path = os.path.dirname(script_path)
+# dir_path is the repository root, which holds local_only_files
 # dir_path = '/media/bigdata/projects/blech_data_transfer'
 
 ##############################
@@ -36,16 +41,69 @@ dir_path = os.path.dirname(script_path)
 def parse_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description='Transfer data from the blech server to the local machine.')
-    parser.add_argument('data_folder', type=str, help='Path to local data folder.',
+    parser.add_argument('data_folder', type=str, nargs='?', help='Path to local data folder.',
                         default=None)
+    parser.add_argument('--batch', type=str, nargs='+', default=None,
+                        help='More data folders to transfer in the same run.')
+    parser.add_argument('--queue_file', type=str, default=None,
+                        help='Text file listing data folders to transfer, one per line.')
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='Number of files to copy concurrently (default: 1).')
+    parser.add_argument('--checksum', action='store_true',
+                        help='Compare files already on the server by content hash '
+                        'when their mtime differs.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Start copying while the data folder is still being scanned.')
+    parser.add_argument('--live', action='store_true',
+                        help='Follow a recording which is still being acquired, copying '
+                        '.dat files as they grow, and finish once it stops changing.')
+    parser.add_argument('--poll_seconds', type=float, default=30,
+                        help='Seconds between checks of a recording with --live '
+                        '(default: 30).')
+    parser.add_argument('--settle_minutes', type=float, default=5,
+                        help='Minutes a recording must stay unchanged before --live '
+                        'finishes it (default: 5).')
+    parser.add_argument('--max_mb_per_s', type=float, default=None,
+                        help='Cap on total transfer throughput in MB/s (default: no cap).')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adapt the number of concurrent copies to the measured '
+                        'throughput, up to --n_workers.')
+    parser.add_argument('--bundle_below_kb', type=float, default=None,
+                        help='Pack files smaller than this many KB into a single tar '
+                        'bundle on the server (default: no bundling).')
+    parser.add_argument('--compress', choices=['zlib', 'lzma'], default=None,
+                        help='Losslessly compress amp-*.dat files on the way to the '
+                        'server (default: copy as is).')
+    parser.add_argument('--copy_backend', choices=copy_backends.BACKENDS,
+                        default=None,
+                        help='How file contents are copied (default: the backend '
+                        'calibrated for the server mount, else readinto).')
+    parser.add_argument('--drop_cache', action='store_true',
+                        help='Drop copied files from the page cache as they are '
+                        'copied, so a transfer does not slow down acquisition '
+                        'running on the same machine.')
+    parser.add_argument('--segment_workers', type=int, default=1,
+                        help='Split very large files into segments and copy this '
+                        'many segments of each at once (default: 1, no splitting).')
+    parser.add_argument('--segment_above_mb', type=float, default=1024,
+                        help='Size in MB from which files are split into segments '
+                        '(default: 1024).')
+    parser.add_argument('--retries', type=int, default=transfer_engine.FILE_RETRIES,
+                        help='Times a file hit by a transient server error (EIO, '
+                        'ESTALE, EAGAIN, ...) is tried again, with backoff '
+                        f'(default: {transfer_engine.FILE_RETRIES}).')
+    parser.add_argument('--max_failures', type=int, default=None,
+                        help='Give up the remaining files once more than this '
+                        'many files have failed (default: no limit).')
+    parser.add_argument('--dataset_backend', choices=['csv', 'sqlite'], default='csv',
+                        help='Look up recordings in the dataset frame csv, or in an '
+                        'indexed local SQLite copy of it (default: csv).')
     return parser.parse_args()
 
-# Get path to the data folder
-args = parse_arguments()
-
 def get_data_folder(args):
     """Get the data folder path from arguments or GUI selection."""
     if args.data_folder is None:
+        import easygui
         data_folder = easygui.diropenbox(title='Select data folder', 
                                          default=os.path.expanduser('~/Desktop'))
     else:
@@ -56,22 +114,50 @@ def get_data_folder(args):
     
     return data_folder
 
-data_folder = get_data_folder(args)
+def read_queue_file(queue_file):
+    """Read data folders from a queue file, skipping blank lines and # comments."""
+    with open(queue_file, 'r') as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+def get_data_folders(args):
+    """Get all data folders to transfer from arguments, queue file or GUI selection."""
+    data_folders = []
+    if args.data_folder is not None or not (args.batch or args.queue_file):
+        data_folders.append(get_data_folder(args))
+    data_folders += args.batch or []
+    if args.queue_file is not None:
+        data_folders += read_queue_file(args.queue_file)
+    data_folders = [d[:-1] if d and d[-1] == '/' else d for d in data_folders]
+    # Drop repeats but keep order
+    return list(dict.fromkeys(data_folders))
 
 # data_folder = '/media/bigdata/Abuzar_Data/ORX15_spont_230529_095725'
 
 # from importlib import reload
 # reload(dataset_handler)
-def initialize_dataset_handler(dir_path):
-    """Initialize the dataset handler and check the dataset frame."""
-    handler = dataset_handler.DatasetFrameHandler(dir_path)
+def initialize_dataset_handler(dir_path, backend='csv'):
+    """
+    Initialize the dataset handler and check the dataset frame
+
+    backend is 'csv' or 'sqlite' (lookups through a local SQLite copy,
+    see dataset_store.py).
+    """
+    from src import dataset_handler
+    handler = dataset_handler.DatasetFrameHandler(dir_path, backend=backend)
     handler.check_dataset_frame()
     handler.sync_logs()
     return handler
 
 def check_experiment_existence(handler, data_folder):
-    """Check if the experiment already exists on the server."""
-    exp_exists = handler.check_experiment_exists(data_folder)
+    """
+    Check if the experiment already exists on the server
+
+    Returns the content fingerprint of the recording, which is stored
+    with its dataset frame entry.
+    """
+    fingerprint = recording_fingerprint.fingerprint_recording(data_folder)
+    exp_exists = handler.check_experiment_exists(data_folder, fingerprint=fingerprint)
     if exp_exists: 
         print(f"Experiment already exists on the server: {data_folder}")
         continue_bool = input("Would you like to continue (y/n)? ")
@@ -81,10 +167,7 @@ def check_experiment_existence(handler, data_folder):
         if continue_bool == 'n':
             print("Exiting...")
             sys.exit()
-
-# Check that experiment is not already on the server
-this_dataset_handler = initialize_dataset_handler(dir_path)
-check_experiment_existence(this_dataset_handler, data_folder)
+    return fingerprint
 
 def validate_data_folder(data_folder):
     """Validate that the data folder exists."""
@@ -96,12 +179,15 @@ def validate_data_folder(data_folder):
         print(f"Processing data folder: {data_folder}")
         print("")
 
-validate_data_folder(data_folder)
-
 
 ##############################
 ##############################
 
+def find_info_file(data_folder):
+    """Return the .info file in the data folder, or None without prompting."""
+    info_file = glob(os.path.join(data_folder, '*.info'))
+    return info_file[0] if info_file else None
+
 def check_info_file(data_folder):
     """Check if an .info file exists in the data folder."""
     info_file = glob(os.path.join(data_folder, '*.info'))
@@ -127,13 +213,9 @@ def check_info_file(data_folder):
         print("")
     return info_file
 
-info_file = check_info_file(data_folder)
-
 ##############################
 ##############################
 
-server_path = this_dataset_handler.server_path
-
 # server_path_file = os.path.join(dir_path, 'blech_server_path.txt')
 # 
 # # Get server path
@@ -160,21 +242,24 @@ server_path = this_dataset_handler.server_path
 # If it does, copy it locally 
 
 # Get list of users on the blech server or from dir_path
-server_home_dir = this_dataset_handler.server_home_dir
-users_list_path = os.path.join(server_home_dir, 'users_list.txt')
-if not os.path.exists(users_list_path):
-    print(f"Users list not found: {users_list_path}")
-    print("Exiting...")
-    sys.exit()
-else:
-    users_list = pd.read_csv(users_list_path, header=0)
-    print(f"Users list found: {users_list_path}")
-    print("Continuing...")
-    print("")
+def load_users_list(server_home_dir):
+    """Load the users list from the server."""
+    users_list_path = os.path.join(server_home_dir, 'users_list.txt')
+    if not os.path.exists(users_list_path):
+        print(f"Users list not found: {users_list_path}")
+        print("Exiting...")
+        sys.exit()
+    else:
+        import pandas as pd
+        users_list = pd.read_csv(users_list_path, header=0)
+        print(f"Users list found: {users_list_path}")
+        print("Continuing...")
+        print("")
+    return users_list
 
 def select_user(users_list, server_path):
     """Select a user from the list and get their path."""
-    user_inds = list(np.arange(len(users_list))+1)
+    user_inds = list(range(1, len(users_list)+1))
     user_select_str = "\n".join(f"{i}: {users_list.iloc[i-1]['Username']}" for i in user_inds)
     msg = f"Select a user from the list:\n{user_select_str}\n:::"
     # Don't exit if user doesn't select a user
@@ -193,12 +278,10 @@ def select_user(users_list, server_path):
     
     return user, user_path
 
-user, user_path = select_user(users_list, server_path)
-
 def select_subfolder(user_path):
     """Select a subfolder or create a new one."""
     subdirs = sorted([d for d in os.listdir(user_path) if os.path.isdir(os.path.join(user_path, d))])
-    subdir_inds = list(np.arange(len(subdirs))+1)
+    subdir_inds = list(range(1, len(subdirs)+1))
     subdir_select_str = "\n".join(f"{i}: {subdirs[i-1]}" for i in subdir_inds)
     # Add -1 : Create new subfolder option
     subdir_select_str = f"\n-1: Create new subfolder" + '\n\n' + subdir_select_str
@@ -226,28 +309,39 @@ def select_subfolder(user_path):
     
     return copy_dir
 
-copy_dir = select_subfolder(user_path)
-
-
+def resolve_destination(handler, users_list, data_folder, previous=None):
+    """
+    Run the checks for one recording and ask where it should go
+
+    If previous (the destination of the last recording in a batch) is
+    given, the user can reuse its user and subfolder.
+
+    Returns a dict with data_folder, user, copy_dir and fingerprint.
+    """
+    validate_data_folder(data_folder)
+    fingerprint = check_experiment_existence(handler, data_folder)
+    check_info_file(data_folder)
+
+    if previous is not None:
+        msg = f"Use user {previous['user']} and subfolder {previous['copy_dir']} (y/n)? "
+        reuse = input(msg)
+        while reuse not in ['y', 'n']:
+            print(f"Invalid selection: {reuse}")
+            reuse = input(msg)
+        if reuse == 'y':
+            return dict(data_folder=data_folder, user=previous['user'],
+                        copy_dir=previous['copy_dir'], fingerprint=fingerprint)
+
+    user, user_path = select_user(users_list, handler.server_path)
+    copy_dir = select_subfolder(user_path)
+    return dict(data_folder=data_folder, user=user, copy_dir=copy_dir,
+                fingerprint=fingerprint)
 
 ##############################
 ##############################
 
-
-# Begin transfer process
-print("Beginning data transfer...")
-print("")
-
-def prepare_file_transfer(data_folder, copy_dir):
-    """Prepare file lists and create server data folder."""
-    # Get list of files to transfer
-    file_list = glob(os.path.join(data_folder, '**', '*'), recursive=True)
-    file_list = sorted(file_list)
-    dir_list = [f for f in file_list if os.path.isdir(f)]
-    file_list = [f for f in file_list if os.path.isfile(f)]
-    rel_file_list = [os.path.relpath(f, data_folder) for f in file_list]
-
-    # Create data folder on the server
+def create_server_data_folder(data_folder, copy_dir):
+    """Create the data folder on the server."""
     server_data_folder = os.path.join(copy_dir, os.path.basename(data_folder))
     if not os.path.exists(server_data_folder):
         os.makedirs(server_data_folder)
@@ -259,45 +353,402 @@ def prepare_file_transfer(data_folder, copy_dir):
         print("Continuing...")
         print("")
     
-    return dir_list, file_list, rel_file_list, server_data_folder
+    return server_data_folder
 
-dir_list, file_list, rel_file_list, server_data_folder = prepare_file_transfer(data_folder, copy_dir)
+def prepare_file_transfer(data_folder, copy_dir):
+    """Prepare file lists and create server data folder."""
+    # Get list of files to transfer in a single scandir pass
+    dir_list = []
+    file_list = []
+    for entry in transfer_engine.scan_recording(data_folder):
+        if entry.is_dir:
+            dir_list.append(entry.path)
+        else:
+            file_list.append(entry.path)
+    rel_file_list = [os.path.relpath(f, data_folder) for f in file_list]
+
+    # Create data folder on the server
+    server_data_folder = create_server_data_folder(data_folder, copy_dir)
+    
+    return dir_list, file_list, rel_file_list, server_data_folder
 
-def transfer_data(data_folder, server_data_folder, dir_list, rel_file_list):
-    """Transfer data from local folder to server."""
-    # Create directories on the server
-    pbar = tqdm(dir_list)
-    for d in pbar:
-        rel_dir = os.path.relpath(d, data_folder)
+def create_server_dirs(data_folder, server_data_folder, dir_list, snapshot=None, rules=None,
+                       rel_file_list=None):
+    """
+    Create the directories of the local data folder on the server
+
+    Directories already in snapshot (taken with
+    transfer_engine.snapshot_destination if not given) are not touched,
+    and each missing branch of the tree is created with a single makedirs.
+    With rules (see transfer_rules.py), only directories they include and
+    the folders of the files transferred (rel_file_list) are created.
+    """
+    if snapshot is None:
+        snapshot = transfer_engine.snapshot_destination(server_data_folder)
+    rel_dir_list = [os.path.relpath(d, data_folder) for d in dir_list]
+    if rules:
+        rel_dir_list = transfer_rules.included_dirs(
+                rel_dir_list, rel_file_list or [], rules)
+    to_create = transfer_engine.missing_dirs(rel_dir_list, snapshot)
+    n_existing = len([d for d in rel_dir_list if d in snapshot.dirs])
+    if n_existing:
+        print(f"{n_existing} directories already exist on the server")
+        print("")
+    pbar = tqdm(to_create)
+    for rel_dir in pbar:
         pbar.set_description(f"Creating {rel_dir}")
-        server_dir = os.path.join(server_data_folder, rel_dir)
-        if not os.path.exists(server_dir):
-            os.makedirs(server_dir)
-        else:
-            print(f"Directory already exists on the server: {server_dir}")
-            print("")
+        os.makedirs(os.path.join(server_data_folder, rel_dir), exist_ok=True)
+
+def plan_transfer(data_folder, server_data_folder, rel_file_list, checksum=False,
+                  bundle_below=None, compress=None, rules=None):
+    """
+    Work out what needs to go to the server, without writing anything
+
+    Files excluded by rules (see transfer_rules.py) are left out first.
+
+    Returns:
+        transfer_plan: dict with keys
+            files: files left after the rules
+            copy_candidates: files not going into the bundle
+            copy_list: files which are missing or differ on the server
+            plan: as returned by transfer_engine.plan_delta_sync
+            snapshot: state of the server folder when planning, see
+                transfer_engine.snapshot_destination
+            small_files: files going into the bundle
+            file_sizes: sizes of all files in rel_file_list
+            excluded: files left out by rules
+            bytes_excluded: total size of excluded files
+            total_bytes: size of the recording, without excluded files
+            bytes_to_copy: bytes which still have to be written to the server
+    """
+    file_sizes = transfer_engine.get_file_sizes(data_folder, rel_file_list)
+    rel_file_list, excluded, bytes_excluded = transfer_rules.filter_files(
+            rel_file_list, file_sizes, rules or [])
+    if excluded:
+        print(f"Excluded {len(excluded)} files ({bytes_excluded / 1024**2:.1f} MB) "
+              "by transfer rules")
+        print("")
+
+    # Files smaller than bundle_below bytes are packed into a single bundle
+    small_files = []
+    copy_candidates = rel_file_list
+    if bundle_below is not None:
+        small_files, copy_candidates = file_bundle.split_small_files(
+                {f: file_sizes[f] for f in rel_file_list}, bundle_below)
+
+    # Only copy files which are missing or differ on the server,
+    # judged from a single walk of the server folder
+    snapshot = transfer_engine.snapshot_destination(server_data_folder)
+    plan = transfer_engine.plan_delta_sync(
+            data_folder, server_data_folder, copy_candidates, checksum=checksum,
+            compress=compress, snapshot=snapshot)
+    for file in plan['overwrite']:
+        print(f"File differs from the server copy, overwriting: {file}")
+    print(f"{len(plan['skip'])} files already on the server, "
+          f"{len(plan['copy']) + len(plan['overwrite'])} files to copy")
+    print("")
+    copy_list = plan['copy'] + plan['overwrite']
+
+    bytes_to_copy = sum(file_sizes[f] for f in copy_list)
+    if small_files and not file_bundle.bundle_is_current(
+            data_folder, server_data_folder, small_files):
+        bytes_to_copy += sum(file_sizes[f] for f in small_files)
+    return dict(
+            files=rel_file_list,
+            copy_candidates=copy_candidates,
+            copy_list=copy_list,
+            plan=plan,
+            snapshot=snapshot,
+            small_files=small_files,
+            file_sizes=file_sizes,
+            excluded=excluded,
+            bytes_excluded=bytes_excluded,
+            total_bytes=sum(file_sizes.values()) - bytes_excluded,
+            bytes_to_copy=bytes_to_copy,
+            )
+
+def run_preflight(server_data_folder, total_bytes, bytes_to_copy, max_mb_per_s=None):
+    """
+    Print the size plan, raise OSError (ENOSPC) if the server does not have room for it
+    """
+    check = transfer_engine.preflight(
+            server_data_folder, total_bytes, bytes_to_copy, max_mb_per_s=max_mb_per_s)
+    transfer_engine.print_preflight(check)
+    if not check['enough_space']:
+        raise OSError(errno.ENOSPC, "Not enough free space on the server for",
+                      server_data_folder)
+    return check
+
+def open_journal(data_folder, server_data_folder):
+    """Open the transfer journal of a recording."""
+    journal = transfer_engine.TransferJournal.for_recording(
+            data_folder, server_data_folder)
+    if journal.entries:
+        print(f"Resuming interrupted transfer from journal: {journal.journal_path}")
+        print("")
+    return journal
+
+def finalize_transfer(data_folder, server_data_folder, report, copy_candidates, plan,
+                      bundle_report=None, compress=None, excluded=None, bytes_excluded=0):
+    """Merge skipped, excluded files and the bundle into report and write the manifest."""
+    report['skipped'] = plan['skip']
+    report['bytes_skipped'] = plan['bytes_skipped']
+    report['excluded'] = excluded or []
+    report['bytes_excluded'] = bytes_excluded
+    server_files = []
+    if bundle_report is not None:
+        report['bytes_copied'] += bundle_report['bytes_copied']
+        report['bytes_skipped'] += bundle_report['bytes_skipped']
+        if bundle_report['digest'] is not None:
+            report['digests'][file_bundle.BUNDLE_NAME] = bundle_report['digest']
+        server_files = [file_bundle.BUNDLE_NAME]
+        report['bundle'] = os.path.join(server_data_folder, file_bundle.BUNDLE_NAME)
+    transfer_engine.print_transfer_report(report)
+
+    # Write manifest of what is now on the server
+    # Compressed files are listed under their server name
+    transferred = [f for f in copy_candidates if f not in report['failed']]
+    server_files += [transfer_engine.get_server_name(f, compress) for f in transferred
+                     if transfer_engine.get_server_name(f, compress) != f]
+    transferred = [f for f in transferred
+                   if transfer_engine.get_server_name(f, compress) == f]
+    report['manifest_digest'] = transfer_engine.write_manifest(
+            data_folder, server_data_folder, transferred, report['digests'],
+            server_files=server_files)
+    print(f"Wrote manifest: {os.path.join(server_data_folder, transfer_engine.MANIFEST_NAME)}")
+    print("")
+    return report
+
+def transfer_data(data_folder, server_data_folder, dir_list, rel_file_list, n_workers=1,
+                  checksum=False, max_mb_per_s=None, adaptive=False, bundle_below=None,
+                  compress=None, copy_backend=None, drop_cache=False,
+                  segment_workers=1, segment_above=transfer_engine.SEGMENT_THRESHOLD,
+                  retries=transfer_engine.FILE_RETRIES, max_failures=None, rules=None):
+    """
+    Transfer data from local folder to server
+
+    rules are the include/exclude rules of the recording's user,
+    see transfer_rules.py.
+    """
+    transfer_plan = plan_transfer(
+            data_folder, server_data_folder, rel_file_list, checksum=checksum,
+            bundle_below=bundle_below, compress=compress, rules=rules)
+    run_preflight(server_data_folder, transfer_plan['total_bytes'],
+                  transfer_plan['bytes_to_copy'], max_mb_per_s=max_mb_per_s)
+
+    create_server_dirs(data_folder, server_data_folder, dir_list,
+                       snapshot=transfer_plan['snapshot'], rules=rules,
+                       rel_file_list=transfer_plan['files'])
+    bundle_report = bundle_small_files(
+            data_folder, server_data_folder, transfer_plan['small_files'],
+            transfer_plan['file_sizes'])
 
     # Copy files to the server
-    pbar = tqdm(rel_file_list)
-    for file in pbar:
-        pbar.set_description(f"Copying {file}")
-        src_path = os.path.join(data_folder, file)
-        dst_path = os.path.join(server_data_folder, file)
-        if not os.path.exists(dst_path): 
-            shutil.copy2(src_path, dst_path)
-        else:
-            print(f"File already exists on the server: {file}")
-            print("")
+    journal = open_journal(data_folder, server_data_folder)
+    report = transfer_engine.copy_files(
+            data_folder, server_data_folder, transfer_plan['copy_list'],
+            n_workers=n_workers, journal=journal, max_mb_per_s=max_mb_per_s,
+            adaptive=adaptive, compress=compress, backend=copy_backend,
+            drop_cache=drop_cache, segment_workers=segment_workers,
+            segment_above=segment_above, retries=retries, max_failures=max_failures)
+    transfer_engine.record_throughput(report['settings'], report['bytes_copied'])
+    finalize_transfer(data_folder, server_data_folder, report,
+                      transfer_plan['copy_candidates'], transfer_plan['plan'],
+                      bundle_report=bundle_report, compress=compress,
+                      excluded=transfer_plan['excluded'],
+                      bytes_excluded=transfer_plan['bytes_excluded'])
     print("Data transfer complete.")
     print("")
-
-transfer_data(data_folder, server_data_folder, dir_list, rel_file_list)
+    return report
+
+def batch_transfer_data(destinations, n_workers=1, checksum=False, max_mb_per_s=None,
+                        adaptive=False, bundle_below=None, compress=None,
+                        copy_backend=None, drop_cache=False, segment_workers=1,
+                        segment_above=transfer_engine.SEGMENT_THRESHOLD,
+                        retries=transfer_engine.FILE_RETRIES, max_failures=None):
+    """
+    Transfer several recordings under one shared concurrency budget
+
+    Files of all recordings are copied by a single pool, interleaved so
+    each recording gets an equal share of the workers, and a single
+    throughput cap covers the whole batch. Each recording is filtered by
+    the transfer rules of its user.
+
+    Inputs:
+        destinations: list of dicts as returned by resolve_destination
+
+    Returns:
+        reports: list of transfer reports, one per destination, each with
+            its server_data_folder
+    """
+    jobs = []
+    plans = []
+    for dest in destinations:
+        data_folder = dest['data_folder']
+        print(f"Preparing: {data_folder}")
+        dir_list, _, rel_file_list, server_data_folder = prepare_file_transfer(
+                data_folder, dest['copy_dir'])
+        rules = transfer_rules.load_rules(dest['user'])
+        transfer_rules.print_rules(rules, dest['user'])
+        transfer_plan = plan_transfer(
+                data_folder, server_data_folder, rel_file_list, checksum=checksum,
+                bundle_below=bundle_below, compress=compress, rules=rules)
+        transfer_plan['rules'] = rules
+        jobs.append(dict(
+            data_folder=data_folder,
+            server_data_folder=server_data_folder,
+            rel_file_list=transfer_plan['copy_list'],
+            dir_list=dir_list,
+            ))
+        plans.append(transfer_plan)
+
+    # Recordings going to the same filesystem share its free space
+    by_device = {}
+    for job, transfer_plan in zip(jobs, plans):
+        device = os.stat(job['server_data_folder']).st_dev
+        folder, total_bytes, bytes_to_copy = by_device.get(
+                device, (job['server_data_folder'], 0, 0))
+        by_device[device] = (folder, total_bytes + transfer_plan['total_bytes'],
+                             bytes_to_copy + transfer_plan['bytes_to_copy'])
+    for folder, total_bytes, bytes_to_copy in by_device.values():
+        run_preflight(folder, total_bytes, bytes_to_copy, max_mb_per_s=max_mb_per_s)
+
+    bundle_reports = []
+    for job, transfer_plan in zip(jobs, plans):
+        create_server_dirs(job['data_folder'], job['server_data_folder'], job.pop('dir_list'),
+                           snapshot=transfer_plan['snapshot'], rules=transfer_plan['rules'],
+                           rel_file_list=transfer_plan['files'])
+        bundle_reports.append(bundle_small_files(
+            job['data_folder'], job['server_data_folder'],
+            transfer_plan['small_files'], transfer_plan['file_sizes']))
+        job['journal'] = open_journal(job['data_folder'], job['server_data_folder'])
+
+    print(f"Copying {sum(len(j['rel_file_list']) for j in jobs)} files "
+          f"from {len(jobs)} recordings")
+    print("")
+    reports = transfer_engine.copy_batch(
+            jobs, n_workers=n_workers, max_mb_per_s=max_mb_per_s,
+            adaptive=adaptive, compress=compress, backend=copy_backend,
+            drop_cache=drop_cache, segment_workers=segment_workers,
+            segment_above=segment_above, retries=retries, max_failures=max_failures)
+    transfer_engine.record_throughput(
+            reports[0]['settings'], sum(r['bytes_copied'] for r in reports))
+
+    for job, report, transfer_plan, bundle_report in zip(jobs, reports, plans, bundle_reports):
+        print(f"Recording: {job['data_folder']}")
+        finalize_transfer(job['data_folder'], job['server_data_folder'], report,
+                          transfer_plan['copy_candidates'], transfer_plan['plan'],
+                          bundle_report=bundle_report, compress=compress,
+                          excluded=transfer_plan['excluded'],
+                          bytes_excluded=transfer_plan['bytes_excluded'])
+        report['server_data_folder'] = job['server_data_folder']
+    print("Data transfer complete.")
+    print("")
+    return reports
+
+def bundle_small_files(data_folder, server_data_folder, small_files, file_sizes):
+    """Write small files to the server as one bundle, unless it is already current."""
+    if not small_files:
+        return None
+    small_bytes = sum(file_sizes[f] for f in small_files)
+    bundle_report = dict(bytes_copied=0, bytes_skipped=0, digest=None)
+    if file_bundle.bundle_is_current(data_folder, server_data_folder, small_files):
+        print(f"Bundle of {len(small_files)} small files already on the server")
+        print("")
+        bundle_report['bytes_skipped'] = small_bytes
+        return bundle_report
+    print(f"Bundling {len(small_files)} small files "
+          f"({small_bytes / 1024**2:.1f} MB) into {file_bundle.BUNDLE_NAME}")
+    progress = transfer_engine.ByteProgress(small_bytes, desc='Bundling')
+    digest, bundle_size = file_bundle.write_bundle(
+            data_folder, server_data_folder, small_files, progress)
+    progress.close()
+    print("")
+    bundle_report['bytes_copied'] = bundle_size
+    bundle_report['digest'] = digest
+    return bundle_report
+
+def stream_transfer_data(data_folder, server_data_folder, n_workers=1, checksum=False,
+                         max_mb_per_s=None, adaptive=False, copy_backend=None,
+                         drop_cache=False, segment_workers=1,
+                         segment_above=transfer_engine.SEGMENT_THRESHOLD,
+                         retries=transfer_engine.FILE_RETRIES, max_failures=None,
+                         rules=None):
+    """
+    Transfer data to the server while the local folder is still being walked
+
+    The size of the recording is not known up front, so there is no
+    pre-flight check in this mode. Entries excluded by rules are dropped
+    from the walk as it goes.
+    """
+    excluded = []
+
+    def _plan():
+        for entry in transfer_engine.scan_recording(data_folder):
+            if transfer_rules.is_included(entry.rel_path, rules or []):
+                yield entry
+            elif not entry.is_dir:
+                excluded.append(entry)
+
+    journal = open_journal(data_folder, server_data_folder)
+    report = transfer_engine.stream_copy(
+            data_folder, server_data_folder, _plan(),
+            n_workers=n_workers, journal=journal, checksum=checksum,
+            max_mb_per_s=max_mb_per_s, adaptive=adaptive, backend=copy_backend,
+            drop_cache=drop_cache, segment_workers=segment_workers,
+            segment_above=segment_above, retries=retries, max_failures=max_failures)
+    report['excluded'] = [entry.rel_path for entry in excluded]
+    report['bytes_excluded'] = sum(entry.size for entry in excluded)
+    transfer_engine.record_throughput(report['settings'], report['bytes_copied'])
+    transfer_engine.print_transfer_report(report)
+
+    # Write manifest of what is now on the server
+    transferred = [f for f in report['files'] if f not in report['failed']]
+    report['manifest_digest'] = transfer_engine.write_manifest(
+            data_folder, server_data_folder, transferred, report['digests'])
+    print(f"Wrote manifest: {os.path.join(server_data_folder, transfer_engine.MANIFEST_NAME)}")
+    print("")
+    print("Data transfer complete.")
+    print("")
+    return report
+
+def live_transfer_data(data_folder, server_data_folder, poll_seconds=30, settle_seconds=300,
+                       n_workers=1, max_mb_per_s=None, copy_backend=None, drop_cache=False,
+                       retries=transfer_engine.FILE_RETRIES, rules=None):
+    """
+    Transfer a recording while it is still being acquired
+
+    Appended bytes of .dat files are copied every poll_seconds, and the
+    transfer is finished, checked and its manifest written once no file
+    has changed for settle_seconds. Files excluded by rules are not copied.
+    """
+    print(f"Following recording until unchanged for {settle_seconds / 60:.1f} minutes: "
+          f"{data_folder}")
+    print("")
+    report = transfer_engine.follow_recording(
+            data_folder, server_data_folder, poll_seconds=poll_seconds,
+            settle_seconds=settle_seconds, n_workers=n_workers,
+            max_mb_per_s=max_mb_per_s, backend=copy_backend, drop_cache=drop_cache,
+            retries=retries, rules=rules)
+    transfer_engine.record_throughput(report['settings'], report['bytes_copied'])
+    transfer_engine.print_transfer_report(report)
+
+    # Write manifest of what is now on the server
+    transferred = [f for f in report['files'] if f not in report['failed']]
+    report['manifest_digest'] = transfer_engine.write_manifest(
+            data_folder, server_data_folder, transferred, report['digests'])
+    print(f"Wrote manifest: {os.path.join(server_data_folder, transfer_engine.MANIFEST_NAME)}")
+    print("")
+    print("Data transfer complete.")
+    print("")
+    return report
 
 ##############################
 ##############################
 
-def add_log_entry(dataset_handler, users_list, user, data_folder, server_data_folder):
-    """Add an entry to the recording log."""
+def make_log_entry(users_list, user, data_folder, server_data_folder,
+                   manifest_digest=None, small_files_bundle=None, fingerprint=None):
+    """Make an entry for the recording log."""
     email = users_list.loc[
             users_list['Username'] == user, 'Email'].values[0]
     entry_keys = [
@@ -322,11 +773,23 @@ def add_log_entry(dataset_handler, users_list, user, data_folder, server_data_fo
                  ]
                 )
             )
-
+    if manifest_digest is not None:
+        entry_dict['manifest_digest'] = manifest_digest
+    if small_files_bundle is not None:
+        entry_dict['small_files_bundle'] = small_files_bundle
+    if fingerprint is not None:
+        entry_dict['fingerprint'] = fingerprint
+    return entry_dict
+
+def add_log_entry(dataset_handler, users_list, user, data_folder, server_data_folder,
+                  manifest_digest=None, small_files_bundle=None, fingerprint=None):
+    """Add an entry to the recording log."""
+    entry_dict = make_log_entry(
+            users_list, user, data_folder, server_data_folder,
+            manifest_digest=manifest_digest, small_files_bundle=small_files_bundle,
+            fingerprint=fingerprint)
     dataset_handler.add_entry(entry_dict)
 
-add_log_entry(this_dataset_handler, users_list, user, data_folder, server_data_folder)
-
 # Copy recording log back to server
 # shutil.copy2('recording_log.csv', server_home_dir)
 # print("Recording log updated.")
@@ -335,5 +798,170 @@ add_log_entry(this_dataset_handler, users_list, user, data_folder, server_data_f
 ##############################
 ##############################
 
-print("Exiting...")
-sys.exit()
+TRANSFER_MODES = ['copy', 'stream', 'live']
+# Options of transfer_data which the other modes support
+STREAM_OPTIONS = ['n_workers', 'checksum', 'max_mb_per_s', 'adaptive', 'copy_backend',
+                  'drop_cache', 'segment_workers', 'segment_above', 'retries',
+                  'max_failures']
+LIVE_OPTIONS = ['n_workers', 'max_mb_per_s', 'copy_backend', 'drop_cache', 'retries']
+
+def transfer_recording(data_folder, copy_dir, user=None, mode='copy', poll_seconds=30,
+                       settle_seconds=300, **options):
+    """
+    Transfer one recording into copy_dir without asking anything
+
+    This is the transfer main runs once the destination of a recording is
+    known, and can be called from other scripts or a long-running process.
+    The transfer rules of user are applied (see transfer_rules.py).
+
+    Inputs:
+        mode: 'copy' (plan, then copy), 'stream' (copy while scanning) or
+            'live' (follow a recording which is still being acquired)
+        poll_seconds, settle_seconds: only used in live mode
+        options: keyword arguments of transfer_data; those the mode does
+            not support (e.g. compress in stream mode) are ignored
+
+    Returns the transfer report, with its server_data_folder.
+    """
+    if mode not in TRANSFER_MODES:
+        raise ValueError(f"Unknown transfer mode: {mode}")
+    rules = transfer_rules.load_rules(user)
+    transfer_rules.print_rules(rules, user)
+    if mode == 'copy':
+        dir_list, _, rel_file_list, server_data_folder = prepare_file_transfer(
+                data_folder, copy_dir)
+        report = transfer_data(data_folder, server_data_folder, dir_list, rel_file_list,
+                               rules=rules, **options)
+    elif mode == 'stream':
+        server_data_folder = create_server_data_folder(data_folder, copy_dir)
+        report = stream_transfer_data(
+                data_folder, server_data_folder, rules=rules,
+                **{k: v for k, v in options.items() if k in STREAM_OPTIONS})
+    else:
+        server_data_folder = create_server_data_folder(data_folder, copy_dir)
+        report = live_transfer_data(
+                data_folder, server_data_folder, poll_seconds=poll_seconds,
+                settle_seconds=settle_seconds, rules=rules,
+                **{k: v for k, v in options.items() if k in LIVE_OPTIONS})
+    report['server_data_folder'] = server_data_folder
+    return report
+
+def transfer_recordings(destinations, mode='copy', poll_seconds=30, settle_seconds=300,
+                        **options):
+    """
+    Transfer several recordings, as given by resolve_destination
+
+    In copy mode several recordings share one pool of workers (see
+    batch_transfer_data), streamed and live recordings are transferred one
+    after the other. Recordings followed live are fingerprinted again once
+    they are complete.
+
+    Returns a list of transfer reports, one per destination.
+    """
+    if mode == 'copy' and len(destinations) > 1:
+        return batch_transfer_data(destinations, **options)
+    if len(destinations) > 1:
+        print(f"Recordings are transferred one after the other with --{mode}")
+        print("")
+    reports = []
+    for dest in destinations:
+        reports.append(transfer_recording(
+            dest['data_folder'], dest['copy_dir'], user=dest['user'], mode=mode,
+            poll_seconds=poll_seconds, settle_seconds=settle_seconds, **options))
+        if mode == 'live':
+            # The recording was still growing when it was first fingerprinted
+            dest['fingerprint'] = recording_fingerprint.fingerprint_recording(
+                    dest['data_folder'])
+    return reports
+
+def log_transfers(handler, users_list, destinations, reports):
+    """Log all transferred recordings with a single write to the dataset frame."""
+    entries = [
+            make_log_entry(users_list, dest['user'], dest['data_folder'],
+                           report['server_data_folder'],
+                           manifest_digest=report['manifest_digest'],
+                           small_files_bundle=report.get('bundle'),
+                           fingerprint=dest.get('fingerprint'))
+            for dest, report in zip(destinations, reports)
+            ]
+    handler.add_entries(entries)
+
+##############################
+##############################
+
+def print_failed_files(destinations, reports):
+    """List files of all recordings which could not be copied in this run."""
+    failed = [(dest['data_folder'], report['failed'])
+              for dest, report in zip(destinations, reports) if report['failed']]
+    if not failed:
+        return
+    print("=== Files which could not be copied ===")
+    for data_folder, failed_files in failed:
+        print(f"{data_folder}:")
+        for rel_file, error in sorted(failed_files.items()):
+            print(f"    {rel_file}: {error}")
+    print("Rerun the transfer to copy them, finished files are skipped")
+    print("")
+
+def main():
+    """Main function to run the script"""
+    args = parse_arguments()
+    data_folders = get_data_folders(args)
+    if not data_folders or None in data_folders:
+        print("No data folder selected")
+        print("Exiting...")
+        sys.exit()
+
+    this_dataset_handler = initialize_dataset_handler(dir_path, backend=args.dataset_backend)
+    users_list = load_users_list(this_dataset_handler.server_home_dir)
+
+    # Ask where every recording goes before copying anything,
+    # so a batch can run unattended
+    destinations = []
+    for data_folder in data_folders:
+        previous = destinations[-1] if destinations else None
+        destinations.append(resolve_destination(
+            this_dataset_handler, users_list, data_folder, previous))
+
+    bundle_below = None
+    if args.bundle_below_kb is not None:
+        bundle_below = int(args.bundle_below_kb * 1024)
+        if args.stream or args.live:
+            print("Small-file bundling is not used with --stream or --live")
+            print("")
+    if args.compress is not None and (args.stream or args.live):
+        print("Compression is not used with --stream or --live")
+        print("")
+    mode = 'stream' if args.stream else 'live' if args.live else 'copy'
+
+    # Begin transfer process
+    print("Beginning data transfer...")
+    print("")
+    try:
+        reports = transfer_recordings(
+                destinations, mode=mode, poll_seconds=args.poll_seconds,
+                settle_seconds=args.settle_minutes * 60,
+                n_workers=args.n_workers, checksum=args.checksum,
+                max_mb_per_s=args.max_mb_per_s, adaptive=args.adaptive,
+                bundle_below=bundle_below, compress=args.compress,
+                copy_backend=args.copy_backend, drop_cache=args.drop_cache,
+                segment_workers=args.segment_workers,
+                segment_above=int(args.segment_above_mb * 1024**2),
+                retries=args.retries, max_failures=args.max_failures)
+    except OSError as e:
+        if e.errno != errno.ENOSPC:
+            raise
+        print(f"{e.strerror}: {e.filename}")
+        print("Exiting...")
+        sys.exit()
+
+    log_transfers(this_dataset_handler, users_list, destinations, reports)
+    this_dataset_handler.flush()
+    print_failed_files(destinations, reports)
+
+    print("Exiting...")
+    sys.exit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+Watch an acquisition folder and transfer recordings once they are complete.
+
+Each subfolder of the watched folder is treated as a recording. A recording
+is considered complete once its file count, total size and latest mtime have
+not changed for --settle_minutes and it has an .info file. Complete
+recordings are transferred to the rig's default user and subfolder with the
+same engine as blech_data_transfer.py and logged in the dataset frame.
+
+The dataset handler, users list and destination are set up once when the
+watcher starts and kept between polls, so each new recording only pays for
+its own transfer.
+
+Defaults for a rig can be kept in local_only_files/watch_defaults.txt as
+key=value lines, e.g.:
+    watch_dir=/media/acquisition
+    user=abuzar
+    subfolder=rig1_recordings
+Command line arguments take precedence over the file.
+"""
+
+import os
+import sys
+import time
+import argparse
+from src.utils.utils import base_dir_path as dir_path
+from src import transfer_engine
+from src import copy_backends
+from src import blech_data_transfer
+from src import recording_fingerprint
+
+
+WATCH_DEFAULTS_NAME = 'watch_defaults.txt'
+
+
+def parse_arguments():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(
+            description='Watch an acquisition folder and transfer complete recordings to the server')
+    parser.add_argument('watch_dir', type=str, nargs='?', default=None,
+                        help='Folder where the rig writes recordings')
+    parser.add_argument('--user', type=str, default=None,
+                        help='User the recordings are transferred for')
+    parser.add_argument('--subfolder', type=str, default=None,
+                        help='Subfolder of the user directory to transfer into (created if missing)')
+    parser.add_argument('--poll_seconds', type=float, default=60,
+                        help='Seconds between scans of the watched folder (default: 60)')
+    parser.add_argument('--settle_minutes', type=float, default=10,
+                        help='Minutes a recording must stay unchanged before transfer (default: 10)')
+    parser.add_argument('--once', action='store_true',
+                        help='Scan once, transfer what is complete and exit')
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='Number of files to copy concurrently (default: 1)')
+    parser.add_argument('--checksum', action='store_true',
+                        help='Compare files already on the server by content hash')
+    parser.add_argument('--max_mb_per_s', type=float, default=None,
+                        help='Cap on total transfer throughput in MB/s (default: no cap)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adapt the number of concurrent copies to the measured throughput')
+    parser.add_argument('--bundle_below_kb', type=float, default=None,
+                        help='Pack files smaller than this many KB into a single tar bundle')
+    parser.add_argument('--compress', choices=['zlib', 'lzma'], default=None,
+                        help='Losslessly compress amp-*.dat files on the way to the server')
+    parser.add_argument('--copy_backend', choices=copy_backends.BACKENDS, default=None,
+                        help='How file contents are copied (default: calibrated for the server mount)')
+    parser.add_argument('--drop_cache', action='store_true',
+                        help='Drop copied files from the page cache so the transfer does not slow acquisition')
+    parser.add_argument('--segment_workers', type=int, default=1,
+                        help='Segments of each very large file copied at once (default: 1, no splitting)')
+    parser.add_argument('--segment_above_mb', type=float, default=1024,
+                        help='Size in MB from which files are split into segments (default: 1024)')
+    parser.add_argument('--retries', type=int, default=transfer_engine.FILE_RETRIES,
+                        help='Times a file hit by a transient server error is tried again '
+                        f'(default: {transfer_engine.FILE_RETRIES})')
+    parser.add_argument('--max_failures', type=int, default=None,
+                        help='Give up the remaining files once more than this many have failed')
+    parser.add_argument('--dataset_backend', choices=['csv', 'sqlite'], default='csv',
+                        help='Look up recordings in the dataset frame csv or a local SQLite copy (default: csv)')
+    return parser.parse_args()
+
+
+def load_watch_defaults(dir_path):
+    """Read key=value defaults for this rig, empty if there is no defaults file"""
+    defaults_path = os.path.join(dir_path, 'local_only_files', WATCH_DEFAULTS_NAME)
+    defaults = {}
+    if not os.path.exists(defaults_path):
+        return defaults
+    with open(defaults_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            defaults[key.strip()] = value.strip()
+    return defaults
+
+
+def recording_signature(data_folder):
+    """Get the file count, total size and latest mtime of a recording"""
+    n_files = 0
+    total_size = 0
+    latest_mtime = os.stat(data_folder).st_mtime
+    for entry in transfer_engine.scan_recording(data_folder):
+        # Directory mtimes change when files are added to them
+        latest_mtime = max(latest_mtime, os.stat(entry.path).st_mtime)
+        if not entry.is_dir:
+            n_files += 1
+            total_size += entry.size
+    return n_files, total_size, latest_mtime
+
+
+class RecordingWatcher:
+    """
+    Track recordings in a watched folder until they are complete
+
+    A recording is complete once its signature has not changed for
+    settle_seconds and an .info file is present. On the first poll a
+    recording counts as unchanged since its latest mtime, so recordings
+    which finished before the watcher started are picked up right away.
+
+    Names are reused between recordings, so a complete recording whose
+    name is in logged_names is only skipped if is_transferred(data_folder)
+    confirms it is on the server, e.g. by its fingerprint. Without
+    is_transferred, the name alone is trusted.
+    """
+    def __init__(self, watch_dir, settle_seconds, logged_names=None, is_transferred=None):
+        self.watch_dir = watch_dir
+        self.settle_seconds = settle_seconds
+        # Recording names in the dataset frame
+        self.logged_names = set(logged_names or [])
+        self.is_transferred = is_transferred
+        # Recording paths which are on the server
+        self.done = set()
+        # Recording path -> (signature, time the signature was first seen)
+        self.pending = {}
+
+    def list_recordings(self):
+        """List subfolders of the watched folder"""
+        with os.scandir(self.watch_dir) as it:
+            return sorted(entry.path for entry in it
+                          if entry.is_dir() and not entry.name.startswith('.'))
+
+    def poll(self, now=None):
+        """Scan the watched folder and return recordings ready to transfer"""
+        if now is None:
+            now = time.time()
+        ready = []
+        recordings = self.list_recordings()
+        for data_folder in recordings:
+            if data_folder in self.done:
+                continue
+            signature = recording_signature(data_folder)
+            previous = self.pending.get(data_folder)
+            if previous is None:
+                self.pending[data_folder] = (signature, min(now, signature[2]))
+            elif previous[0] != signature:
+                self.pending[data_folder] = (signature, now)
+            stable_since = self.pending[data_folder][1]
+            if signature[0] == 0 or now - stable_since < self.settle_seconds:
+                continue
+            if blech_data_transfer.find_info_file(data_folder) is None:
+                continue
+            if os.path.basename(data_folder) in self.logged_names and (
+                    self.is_transferred is None or self.is_transferred(data_folder)):
+                print(f"Already on the server, not transferring: {data_folder}")
+                print("")
+                self.mark_done(data_folder)
+                continue
+            ready.append(data_folder)
+        # Forget recordings which were removed from the watched folder,
+        # a new recording may be written under the same name
+        for data_folder in set(self.pending) - set(recordings):
+            del self.pending[data_folder]
+        self.done &= set(recordings)
+        return ready
+
+    def mark_done(self, data_folder):
+        """Stop watching a recording once it is on the server"""
+        self.done.add(data_folder)
+        self.pending.pop(data_folder, None)
+
+
+def get_rig_destination(users_list, server_path, user, subfolder):
+    """Get the directory recordings of this rig are copied into, creating it if needed"""
+    if user not in users_list['Username'].values:
+        print(f"User not found in users list: {user}")
+        print("Exiting...")
+        sys.exit()
+    user_path = users_list.loc[
+            users_list['Username'] == user, 'Directory'].values[0]
+    copy_dir = os.path.join(server_path, user_path, subfolder)
+    if not os.path.exists(copy_dir):
+        os.makedirs(copy_dir)
+        print(f"Created new subfolder: {copy_dir}")
+    print(f"Transferring recordings to: {copy_dir}")
+    print("")
+    return copy_dir
+
+
+def load_done_recordings(handler):
+    """Get the names of recordings already in the dataset frame"""
+    dataset_frame = handler.read_dataset_frame()
+    return set(dataset_frame['recording'].dropna().astype(str))
+
+
+def is_transferred(handler, data_folder):
+    """
+    Check whether the dataset frame has a recording with the same contents
+
+    Entries logged without a fingerprint are matched by name. A recording
+    whose name was logged with different contents is a new recording.
+    """
+    kind, _ = handler.match_recording(
+            data_folder, fingerprint=recording_fingerprint.fingerprint_recording(data_folder))
+    if kind == 'conflict':
+        print(f"Same name as a different recording on the server, transferring: {data_folder}")
+        print("")
+    return kind in ['fingerprint', 'name']
+
+
+def ingest_recordings(handler, users_list, user, copy_dir, ready, transfer_kwargs):
+    """
+    Transfer ready recordings and log those copied without errors
+
+    Returns the recordings which were transferred and logged.
+    """
+    destinations = [dict(data_folder=f, user=user, copy_dir=copy_dir) for f in ready]
+    reports = blech_data_transfer.batch_transfer_data(destinations, **transfer_kwargs)
+
+    entries = []
+    transferred = []
+    for dest, report in zip(destinations, reports):
+        if report['failed']:
+            print(f"{len(report['failed'])} files failed, will retry: {dest['data_folder']}")
+            continue
+        entries.append(blech_data_transfer.make_log_entry(
+            users_list, user, dest['data_folder'], report['server_data_folder'],
+            manifest_digest=report['manifest_digest'],
+            small_files_bundle=report.get('bundle'),
+            fingerprint=recording_fingerprint.fingerprint_recording(dest['data_folder'])))
+        transferred.append(dest['data_folder'])
+    if entries:
+        handler.add_entries(entries)
+    return transferred
+
+
+def run_watch(handler, users_list, watcher, user, copy_dir, poll_seconds=60,
+              once=False, transfer_kwargs=None):
+    """Poll the watched folder and transfer recordings as they complete"""
+    transfer_kwargs = transfer_kwargs or {}
+    print(f"Watching: {watcher.watch_dir}")
+    print("")
+    while True:
+        # A failed poll leaves its recordings pending, to retry at the next one
+        ready = []
+        try:
+            ready = watcher.poll()
+            if ready:
+                print(f"Found {len(ready)} complete recordings: "
+                      f"{', '.join(os.path.basename(f) for f in ready)}")
+                print("")
+                transferred = ingest_recordings(
+                        handler, users_list, user, copy_dir, ready, transfer_kwargs)
+                for data_folder in transferred:
+                    watcher.mark_done(data_folder)
+        except OSError as e:
+            print(f"Transfer failed, will retry: {type(e).__name__}: {e}")
+            print("")
+        except SystemExit:
+            # The transfer gave up on these recordings (e.g. a missing folder),
+            # which would happen again at every poll
+            print(f"Transfer stopped, no longer watching: "
+                  f"{', '.join(os.path.basename(f) for f in ready)}")
+            print("")
+            for data_folder in ready:
+                watcher.mark_done(data_folder)
+        if once:
+            break
+        time.sleep(poll_seconds)
+
+
+def main():
+    """Main function to run the script"""
+    args = parse_arguments()
+    defaults = load_watch_defaults(dir_path)
+    watch_dir = args.watch_dir or defaults.get('watch_dir')
+    user = args.user or defaults.get('user')
+    subfolder = args.subfolder or defaults.get('subfolder')
+    if not all([watch_dir, user, subfolder]):
+        print("watch_dir, user and subfolder must be given as arguments "
+              f"or in local_only_files/{WATCH_DEFAULTS_NAME}")
+        print("Exiting...")
+        sys.exit()
+    if not os.path.isdir(watch_dir):
+        print(f"Watch folder not found: {watch_dir}")
+        print("Exiting...")
+        sys.exit()
+
+    # Set up everything which does not change between recordings once
+    handler = blech_data_transfer.initialize_dataset_handler(
+            dir_path, backend=args.dataset_backend)
+    # The watcher runs until stopped, so synced frames are written now
+    handler.flush()
+    users_list = blech_data_transfer.load_users_list(handler.server_home_dir)
+    copy_dir = get_rig_destination(users_list, handler.server_path, user, subfolder)
+    watcher = RecordingWatcher(
+            watch_dir, args.settle_minutes * 60,
+            logged_names=load_done_recordings(handler),
+            is_transferred=lambda data_folder: is_transferred(handler, data_folder))
+
+    bundle_below = None
+    if args.bundle_below_kb is not None:
+        bundle_below = int(args.bundle_below_kb * 1024)
+    transfer_kwargs = dict(
+            n_workers=args.n_workers,
+            checksum=args.checksum,
+            max_mb_per_s=args.max_mb_per_s,
+            adaptive=args.adaptive,
+            bundle_below=bundle_below,
+            compress=args.compress,
+            copy_backend=args.copy_backend,
+            drop_cache=args.drop_cache,
+            segment_workers=args.segment_workers,
+            segment_above=int(args.segment_above_mb * 1024**2),
+            retries=args.retries,
+            max_failures=args.max_failures,
+            )
+    try:
+        run_watch(handler, users_list, watcher, user, copy_dir,
+                  poll_seconds=args.poll_seconds, once=args.once,
+                  transfer_kwargs=transfer_kwargs)
+    except KeyboardInterrupt:
+        print("")
+    print("Exiting...")
+
+
+if __name__ == "__main__":
+    main()
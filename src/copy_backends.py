@@ -0,0 +1,268 @@
+"""
+Copy backends used by the transfer engine
+
+Each backend moves one chunk of a file from src to dst and returns the
+bytes it moved, so the engine can hash them and report progress the same
+way whatever the backend:
+
+- copy_file_range: os.copy_file_range, copied inside the kernel (and on
+    the server for filesystems which support server-side copies)
+- sendfile: os.sendfile, copied inside the kernel
+- readinto: readinto a large buffer reused through a memoryview
+- shutil: read and write with shutil's default buffer size, as
+    shutil.copyfileobj does
+
+The kernel backends never copy the data through user space to write it,
+but the digest still needs the bytes, so each chunk is read back with
+pread from the page cache, which the kernel has just filled.
+
+If the kernel or filesystem refuses a backend (e.g. copy_file_range
+across filesystems), copying carries on at the same offset with the next
+backend in BACKENDS, and the refused backend is not tried again for that
+destination filesystem.
+
+The fastest backend for a server mount can be measured with calibrate,
+which is remembered in local_only_files/copy_backends.json and used by
+later transfers to that mount.
+
+usage: python -m src.copy_backends calibrate [target_dir] [--size_mb N]
+       python -m src.copy_backends show
+"""
+
+import os
+import json
+import errno
+import shutil
+import tempfile
+import threading
+import argparse
+from time import perf_counter, strftime
+from src.utils.utils import base_dir_path
+
+
+BACKENDS = ['copy_file_range', 'sendfile', 'readinto', 'shutil']
+# Used when a mount has not been calibrated
+DEFAULT_BACKEND = 'readinto'
+# Bytes moved per chunk by all backends except shutil
+BACKEND_BUFFER_SIZE = 8 * 1024 * 1024
+CALIBRATION_PATH = os.path.join(base_dir_path, 'local_only_files', 'copy_backends.json')
+# Errors meaning a backend is not supported for this pair of files
+FALLBACK_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                   errno.ENOTSUP, errno.EBADF}
+
+# Buffers are reused by all copies made by the same thread
+_thread_buffers = threading.local()
+# (backend, st_dev) pairs refused by the kernel or filesystem
+_refused = set()
+
+##############################
+##############################
+
+def get_buffer():
+    """Get this thread's copy buffer as a memoryview."""
+    view = getattr(_thread_buffers, 'view', None)
+    if view is None:
+        view = memoryview(bytearray(BACKEND_BUFFER_SIZE))
+        _thread_buffers.view = view
+    return view
+
+
+def is_available(backend):
+    """Check whether this Python exposes the calls a backend needs."""
+    if backend == 'copy_file_range':
+        return hasattr(os, 'copy_file_range') and hasattr(os, 'preadv')
+    if backend == 'sendfile':
+        return hasattr(os, 'sendfile') and hasattr(os, 'preadv')
+    return backend in BACKENDS
+
+
+def _write_all(dst, data):
+    """Write all of data to an unbuffered file."""
+    written = 0
+    while written < len(data):
+        written += dst.write(data[written:])
+
+
+def pread_into(fd, view, offset):
+    """Fill view from fd starting at offset, stopping early at end of file."""
+    n_read = 0
+    while n_read < len(view):
+        n = os.preadv(fd, [view[n_read:]], offset + n_read)
+        if n == 0:
+            break
+        n_read += n
+    return view[:n_read]
+
+
+def _chunk_copy_file_range(src, dst, offset, view):
+    n = os.copy_file_range(src.fileno(), dst.fileno(), len(view), offset, offset)
+    return pread_into(src.fileno(), view[:n], offset)
+
+
+def _chunk_sendfile(src, dst, offset, view):
+    n = os.sendfile(dst.fileno(), src.fileno(), offset, len(view))
+    return pread_into(src.fileno(), view[:n], offset)
+
+
+def _chunk_readinto(src, dst, offset, view):
+    n = src.readinto(view)
+    _write_all(dst, view[:n])
+    return view[:n]
+
+
+def _chunk_shutil(src, dst, offset, view):
+    buf = src.read(shutil.COPY_BUFSIZE)
+    _write_all(dst, buf)
+    return buf
+
+
+CHUNK_FUNCS = {
+        'copy_file_range': _chunk_copy_file_range,
+        'sendfile': _chunk_sendfile,
+        'readinto': _chunk_readinto,
+        'shutil': _chunk_shutil,
+        }
+
+
+def copy_chunks(src, dst, offset=0, backend=DEFAULT_BACKEND, fallback=True):
+    """
+    Copy src to dst from offset onwards, yielding the bytes of each chunk
+
+    src and dst must be files opened unbuffered and positioned at offset.
+    Yielded buffers are only valid until the next chunk is requested.
+
+    If fallback is False, an error from a refused backend is raised
+    instead of moving on to the next backend.
+    """
+    dst_dev = os.fstat(dst.fileno()).st_dev
+    chain = BACKENDS[BACKENDS.index(backend):] if fallback else [backend]
+    chain = [b for b in chain if is_available(b) and (b, dst_dev) not in _refused]
+    if not chain:
+        raise ValueError(f"Copy backend not available: {backend}")
+    view = get_buffer()
+    for i, name in enumerate(chain):
+        chunk_func = CHUNK_FUNCS[name]
+        try:
+            while True:
+                data = chunk_func(src, dst, offset, view)
+                if not len(data):
+                    return
+                offset += len(data)
+                yield data
+        except OSError as e:
+            if not fallback or e.errno not in FALLBACK_ERRNOS or i == len(chain) - 1:
+                raise
+            _refused.add((name, dst_dev))
+            # Kernel backends do not move file positions
+            src.seek(offset)
+            dst.seek(offset)
+
+
+def load_calibration(path=CALIBRATION_PATH):
+    """Load calibrated backends keyed by mount path."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def get_backend(dst_dir, path=CALIBRATION_PATH):
+    """Get the calibrated backend of the mount holding dst_dir."""
+    dst_dir = os.path.realpath(dst_dir)
+    best_mount = None
+    for mount in load_calibration(path):
+        if (dst_dir == mount or dst_dir.startswith(mount.rstrip(os.sep) + os.sep)) \
+                and (best_mount is None or len(mount) > len(best_mount)):
+            best_mount = mount
+    if best_mount is None:
+        return DEFAULT_BACKEND
+    return load_calibration(path)[best_mount]['backend']
+
+
+def calibrate(target_dir, size_mb=256, backends=None, path=CALIBRATION_PATH):
+    """
+    Time copying a local test file into target_dir with each backend
+
+    The fastest backend is saved for target_dir, so later transfers into
+    target_dir or any folder below it use it.
+
+    Returns:
+        results: dict mapping backend to MB/s, None if it was refused
+    """
+    if backends is None:
+        backends = [b for b in BACKENDS if is_available(b)]
+    n_bytes = int(size_mb * 1024**2)
+    src_fd, src_path = tempfile.mkstemp(prefix='blech_calibration_')
+    with os.fdopen(src_fd, 'wb') as f:
+        for start in range(0, n_bytes, BACKEND_BUFFER_SIZE):
+            f.write(os.urandom(min(BACKEND_BUFFER_SIZE, n_bytes - start)))
+
+    results = {}
+    try:
+        for backend in backends:
+            dst_path = os.path.join(target_dir, f'.blech_calibration_{backend}')
+            try:
+                start = perf_counter()
+                with open(src_path, 'rb', buffering=0) as src, \
+                        open(dst_path, 'wb', buffering=0) as dst:
+                    for _ in copy_chunks(src, dst, backend=backend, fallback=False):
+                        pass
+                    os.fsync(dst.fileno())
+                results[backend] = size_mb / max(perf_counter() - start, 1e-9)
+            except OSError as e:
+                if e.errno not in FALLBACK_ERRNOS:
+                    raise
+                results[backend] = None
+            finally:
+                if os.path.exists(dst_path):
+                    os.remove(dst_path)
+    finally:
+        os.remove(src_path)
+
+    measured = {b: s for b, s in results.items() if s is not None}
+    if measured:
+        best = max(measured, key=measured.get)
+        calibration = load_calibration(path)
+        calibration[os.path.realpath(target_dir)] = dict(
+                backend=best,
+                mb_per_s=round(measured[best], 1),
+                date=strftime('%Y-%m-%d %H:%M:%S'),
+                )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(calibration, f, indent=2)
+    return results
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+            description='Calibrate the copy backend used for a server mount')
+    parser.add_argument('command', choices=['calibrate', 'show'])
+    parser.add_argument('target_dir', type=str, nargs='?', default=None,
+                        help='Folder on the server mount (default: the blech server path).')
+    parser.add_argument('--size_mb', type=float, default=256,
+                        help='Size of the test file in MB (default: 256).')
+    return parser.parse_args()
+
+
+def main():
+    """Main function to run the script"""
+    args = parse_arguments()
+    if args.command == 'show':
+        for mount, entry in sorted(load_calibration().items()):
+            print(f"{mount}: {entry['backend']} ({entry['mb_per_s']} MB/s, {entry['date']})")
+        return
+    target_dir = args.target_dir
+    if target_dir is None:
+        from src.blech_data_sentry import get_server_path
+        target_dir = get_server_path(base_dir_path)
+    results = calibrate(target_dir, size_mb=args.size_mb)
+    for backend, mb_per_s in results.items():
+        speed_str = f"{mb_per_s:.1f} MB/s" if mb_per_s is not None else 'not supported'
+        print(f"{backend:>16}: {speed_str}")
+    print(f"Using {get_backend(target_dir)} for: {os.path.realpath(target_dir)}")
+
+
+if __name__ == "__main__":
+    main()
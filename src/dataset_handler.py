@@ -3,20 +3,38 @@ Checks for logs both locally and on server.
 If both present, merge.
 Regardless, confirm that logs are up to date (that is, all files are present).
 Ask user if they would like to validate logs, or just sync from server.
+
+New entries are appended to a journal next to the dataset frame on the
+server (dataset_frame_journal.jsonl, one JSON record per line) instead of
+rewriting dataset_frame.csv, so adding an entry is one small write
+however long the history is. Readers see the csv plus the journal. Once
+the journal grows past COMPACT_ABOVE_BYTES it is folded into the csv
+copies in a background thread.
+
+With backend='sqlite', lookups go through a local SQLite copy of the
+dataset frame instead of reading the csv (see dataset_store.py).
+
+Every entry gets an entry_id (a UUID) and a seq (a timestamp in ns which
+only increases for each writer). Copies are only ever appended to, so
+sync_logs remembers where each copy ended at the last sync (its
+watermark) and exchanges the rows appended since, by entry_id. Both
+copies are read in full and merged only when one was rewritten, and
+nothing is written when nothing changed.
 """
 
-import easygui
 import os
-import argparse
-import shutil
 import sys
+import io
+import csv
 import time
-from glob import glob
+import json
+import uuid
+import threading
 import pandas as pd
-from tqdm import tqdm
 import numpy as np
 from datetime import datetime
 from pprint import pformat 
+from src import dataset_store
 
 
 # Load path to the blech server
@@ -29,6 +47,366 @@ from pprint import pformat
 # this_dataset_handler.get_dataset_frame()
 # this_dataset_handler.sync_logs()
 
+JOURNAL_NAME = 'dataset_frame_journal.jsonl'
+# The journal is renamed to this while it is folded into the csv
+COMPACTING_SUFFIX = '.compacting'
+COMPACT_LOCK_NAME = 'dataset_frame_compact.lock'
+# Journal size from which it is compacted into the csv
+COMPACT_ABOVE_BYTES = 64 * 1024
+# A compaction lock older than this was left by a crashed process
+COMPACT_LOCK_STALE = 10 * 60
+ENTRY_ID_COL = 'entry_id'
+SEQ_COL = 'seq'
+# Watermarks of the local and server copies at the last sync
+SYNC_STATE_NAME = 'dataset_frame_sync.json'
+# Bytes before a watermark checked to make sure a copy was only appended to
+WATERMARK_TAIL_BYTES = 64
+
+def _write_all(fd, data):
+    """Write all of data to a file descriptor."""
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+def append_records(journal_path, records):
+    """
+    Append records to a journal as JSON lines with a single O_APPEND write
+
+    If the journal was renamed for compaction while it was being written,
+    the records are written again to the new journal, duplicates are
+    dropped when reading.
+
+    Returns the size of the journal after the write.
+    """
+    data = ''.join(json.dumps(r, default=str) + '\n' for r in records).encode()
+    while True:
+        fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+            _write_all(fd, data)
+            os.fsync(fd)
+            journal_stat = os.fstat(fd)
+        finally:
+            os.close(fd)
+        try:
+            renamed = os.stat(journal_path).st_ino != journal_stat.st_ino
+        except FileNotFoundError:
+            renamed = True
+        if not renamed:
+            return journal_stat.st_size
+
+def read_journal_tail(journal_path, offset=0):
+    """
+    Read the records appended to a journal after offset
+
+    A last line without its newline is still being written and is left
+    for the next read, a line cut short by a crash is skipped.
+
+    Returns:
+        records: list of dicts
+        end_offset: offset after the last complete line
+        inode: inode of the journal, None if it does not exist
+    """
+    try:
+        f = open(journal_path, 'rb')
+    except FileNotFoundError:
+        return [], 0, None
+    with f:
+        inode = os.fstat(f.fileno()).st_ino
+        f.seek(offset)
+        data = f.read()
+    n_complete = data.rfind(b'\n') + 1
+    records = []
+    for line in data[:n_complete].splitlines():
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records, offset + n_complete, inode
+
+def read_journal(journal_path):
+    """Read the records of a journal, skipping a line cut short by a crash."""
+    return read_journal_tail(journal_path)[0]
+
+def get_journal_paths(server_home_dir):
+    """Paths of the journal and of the journal being compacted."""
+    journal_path = os.path.join(server_home_dir, JOURNAL_NAME)
+    return [journal_path, journal_path + COMPACTING_SUFFIX]
+
+def read_dataset_frame(dataset_frame_path, server_home_dir):
+    """
+    Read the dataset frame with the entries still in the journal
+
+    Journals are read before the csv, so an entry moved into the csv by a
+    compaction running at the same time is seen in one place or the other.
+    """
+    journal_path, compacting_path = get_journal_paths(server_home_dir)
+    journal_records = read_journal(journal_path)
+    compacting_records = read_journal(compacting_path)
+    return merge_records(pd.read_csv(dataset_frame_path),
+                         compacting_records + journal_records)
+
+def drop_duplicate_entries(dataset_frame, subset=None):
+    """
+    Drop entries seen twice
+
+    Entries with an entry_id are the same entry only if their ids match,
+    so a recording transferred twice keeps both entries. Entries logged
+    before ids were added are compared on the subset columns (all columns
+    if None), keeping the last.
+    """
+    has_id = np.zeros(len(dataset_frame), dtype=bool)
+    id_dup = np.zeros(len(dataset_frame), dtype=bool)
+    if ENTRY_ID_COL in dataset_frame.columns:
+        has_id = dataset_frame[ENTRY_ID_COL].notna().to_numpy()
+        id_dup = has_id & dataset_frame[ENTRY_ID_COL].duplicated().to_numpy()
+    legacy_dup = np.zeros(len(dataset_frame), dtype=bool)
+    if (~has_id).any():
+        if subset is not None:
+            subset = [c for c in subset if c in dataset_frame.columns]
+        legacy_dup[~has_id] = dataset_frame[~has_id].duplicated(
+                subset=subset, keep='last').to_numpy()
+    return dataset_frame[~(id_dup | legacy_dup)].reset_index(drop=True)
+
+def merge_records(dataset_frame, records):
+    """Add journal records to a dataset frame, dropping entries seen twice."""
+    if records:
+        dataset_frame = pd.concat([dataset_frame, pd.DataFrame(records)], ignore_index=True)
+    return drop_duplicate_entries(dataset_frame)
+
+def read_csv_header(path):
+    """Get the header line of a csv and its column names."""
+    with open(path, 'r') as f:
+        header = f.readline()
+    return header, next(csv.reader([header]), [])
+
+def append_csv_rows(path, header, rows):
+    """
+    Append rows (dicts) to a csv with this header in a single O_APPEND write
+
+    Returns:
+        data: bytes written
+        size: size of the csv after the write
+    """
+    columns = next(csv.reader([header]))
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=columns, lineterminator='\n',
+                            extrasaction='ignore')
+    writer.writerows(rows)
+    data = buf.getvalue().encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        _write_all(fd, data)
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+    return data, size
+
+def fits_header(rows, columns):
+    """Check that every value of rows has a column in the csv."""
+    columns = set(columns)
+    return all(k in columns for row in rows for k, v in row.items()
+               if v is not None and v != '')
+
+def make_watermark(path):
+    """Remember the header, size and last bytes of a csv."""
+    with open(path, 'rb') as f:
+        header = f.readline()
+        size = os.fstat(f.fileno()).st_size
+        tail_start = max(len(header), size - WATERMARK_TAIL_BYTES)
+        f.seek(tail_start)
+        tail = f.read(size - tail_start)
+    return dict(size=size, header=header.decode(), tail=tail.hex())
+
+def advance_watermark(watermark, data):
+    """Move a watermark past data appended at its end."""
+    tail = (bytes.fromhex(watermark['tail']) + data)[-WATERMARK_TAIL_BYTES:]
+    return dict(size=watermark['size'] + len(data), header=watermark['header'],
+                tail=tail.hex())
+
+def read_csv_tail(path, watermark):
+    """
+    Read the rows appended to a csv since its watermark
+
+    Returns (rows as dicts of strings, watermark after them), or None if
+    the csv was rewritten since the watermark was taken.
+    """
+    tail = bytes.fromhex(watermark['tail'])
+    with open(path, 'rb') as f:
+        if f.readline().decode() != watermark['header']:
+            return None
+        f.seek(watermark['size'] - len(tail))
+        if f.read(len(tail)) != tail:
+            return None
+        data = f.read()
+    # A last line without its newline is still being written
+    data = data[:data.rfind(b'\n') + 1]
+    columns = next(csv.reader([watermark['header']]))
+    rows = [dict(zip(columns, values))
+            for values in csv.reader(io.StringIO(data.decode())) if values]
+    return rows, advance_watermark(watermark, data)
+
+def compact_journal(dataset_frame_path_list, server_home_dir):
+    """
+    Fold the journal into the csv copies of the dataset frame
+
+    Records are appended to each copy in dataset_frame_path_list, which is
+    only written again if the records have columns it does not. Only one
+    process compacts at a time, others return straight away.
+
+    Returns the number of journal records compacted.
+    """
+    lock_path = os.path.join(server_home_dir, COMPACT_LOCK_NAME)
+    try:
+        lock_fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        if time.time() - os.path.getmtime(lock_path) < COMPACT_LOCK_STALE:
+            return 0
+        os.remove(lock_path)
+        return compact_journal(dataset_frame_path_list, server_home_dir)
+    try:
+        journal_path, compacting_path = get_journal_paths(server_home_dir)
+        # A compacting journal left by a crash is finished first
+        if not os.path.exists(compacting_path):
+            if not os.path.exists(journal_path):
+                return 0
+            os.replace(journal_path, compacting_path)
+        records = read_journal(compacting_path)
+        for dataset_frame_path in dataset_frame_path_list:
+            if not records or not os.path.exists(dataset_frame_path):
+                continue
+            header, columns = read_csv_header(dataset_frame_path)
+            if fits_header(records, columns):
+                append_csv_rows(dataset_frame_path, header, records)
+                continue
+            # New columns need the csv to be written again
+            dataset_frame = merge_records(pd.read_csv(dataset_frame_path), records)
+            temp_path = dataset_frame_path + '.tmp'
+            dataset_frame.to_csv(temp_path, index=False)
+            os.replace(temp_path, dataset_frame_path)
+        os.remove(compacting_path)
+        return len(records)
+    finally:
+        os.close(lock_fd)
+        os.remove(lock_path)
+
+class DatasetFrameSession:
+    """
+    Dataset frame files read and written by one handler
+
+    Each csv and journal is read once and kept in memory with its
+    (mtime, size). Later reads only stat the file, and read it again if
+    another process has changed it; records appended to a journal are
+    read from where the last read stopped. The dataset frame with its
+    journal entries is merged once per version, with an index of rows by
+    recording name.
+
+    Writes are kept in memory and written by flush. A csv which another
+    process changed since this session read it is not overwritten.
+
+    n_reads counts the files read, to check how often a run reads them.
+    Frames returned are shared with the session and must not be modified.
+    """
+    def __init__(self):
+        # Path -> ((mtime, size), frame) as last read or written
+        self.frames = {}
+        # Path -> frame waiting for flush
+        self.pending = {}
+        # Journal path -> (inode, offset, records)
+        self.journals = {}
+        # (key, csv frame, merged frame, recording index) of the last merge
+        self.view = None
+        self.n_reads = 0
+
+    @staticmethod
+    def signature(path):
+        """Get the (mtime, size) of a file."""
+        file_stat = os.stat(path)
+        return (file_stat.st_mtime_ns, file_stat.st_size)
+
+    def exists(self, path):
+        """Check whether a csv exists on disk or is waiting to be written."""
+        return path in self.pending or os.path.exists(path)
+
+    def read_csv(self, path):
+        """Get a csv, reading it only if it is new or changed on disk."""
+        if path in self.pending:
+            return self.pending[path]
+        signature = self.signature(path)
+        cached = self.frames.get(path)
+        if cached is None or cached[0] != signature:
+            self.frames[path] = (signature, pd.read_csv(path))
+            self.n_reads += 1
+        return self.frames[path][1]
+
+    def write_csv(self, path, dataset_frame):
+        """Keep a csv to be written by flush."""
+        self.pending[path] = dataset_frame
+
+    def flush(self):
+        """
+        Write the csvs kept by write_csv
+
+        Returns the paths written.
+        """
+        written = []
+        for path, dataset_frame in self.pending.items():
+            cached = self.frames.get(path)
+            if cached is not None and os.path.exists(path) \
+                    and self.signature(path) != cached[0]:
+                print(f"Dataset frame changed by another process, not overwriting: {path}")
+                continue
+            temp_path = path + '.tmp'
+            dataset_frame.to_csv(temp_path, index=False)
+            os.replace(temp_path, path)
+            self.frames[path] = (self.signature(path), dataset_frame)
+            written.append(path)
+        self.pending = {}
+        return written
+
+    def read_journal(self, journal_path):
+        """Get the records of a journal, reading only what was appended."""
+        try:
+            journal_stat = os.stat(journal_path)
+        except FileNotFoundError:
+            self.journals.pop(journal_path, None)
+            return []
+        inode, offset, records = self.journals.get(journal_path, (None, 0, []))
+        if inode != journal_stat.st_ino or journal_stat.st_size < offset:
+            offset, records = 0, []
+        if journal_stat.st_size > offset:
+            new_records, offset, inode = read_journal_tail(journal_path, offset)
+            records = records + new_records
+            self.n_reads += 1
+        self.journals[journal_path] = (inode, offset, records)
+        return records
+
+    def read_dataset_frame(self, dataset_frame_path, server_home_dir):
+        """
+        Get the dataset frame with its journal entries
+
+        Same as read_dataset_frame, but files are only read when they
+        changed and the merge is only redone when one of them did.
+        """
+        journal_paths = get_journal_paths(server_home_dir)
+        journal_records = self.read_journal(journal_paths[0])
+        compacting_records = self.read_journal(journal_paths[1])
+        dataset_frame = self.read_csv(dataset_frame_path)
+        key = (id(dataset_frame),) + tuple(
+                self.journals.get(p, (None, 0))[:2] for p in journal_paths)
+        if self.view is None or self.view[0] != key:
+            merged = merge_records(dataset_frame, compacting_records + journal_records)
+            index = {}
+            for i, recording in enumerate(merged['recording'].values):
+                index.setdefault(recording, []).append(i)
+            # The csv frame is kept so its id is not reused while cached
+            self.view = (key, dataset_frame, merged, index)
+        return self.view[2]
+
+    def find_recording(self, dataset_frame_path, server_home_dir, recording):
+        """Get the rows of the dataset frame with this recording name."""
+        merged = self.read_dataset_frame(dataset_frame_path, server_home_dir)
+        return merged.iloc[self.view[3].get(recording, [])]
+
 def get_time_pretty():
     return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
 
@@ -51,14 +429,32 @@ class DatasetFrameLogger:
             self.log_cxn.write(write_str)
             print(write_str)
 
+BACKENDS = ['csv', 'sqlite']
+
 class DatasetFrameHandler:
 
-    def __init__(self, dir_path): 
+    def __init__(self, dir_path, backend='csv'): 
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown dataset frame backend: {backend}")
         self.dir_path = dir_path
         self.server_path_file = os.path.join(dir_path, 'local_only_files','blech_server_path.txt')
         self.get_server_path()
         self.check_server_write_access(self.server_home_dir)
         self.logger = DatasetFrameLogger(self.server_home_dir)
+        # Fingerprint -> dataset frame rows, built on first lookup
+        self.fingerprint_index = None
+        self.journal_path = get_journal_paths(self.server_home_dir)[0]
+        # Background thread folding the journal into the csv
+        self.compaction = None
+        # Last seq given to an entry by this handler
+        self.last_seq = 0
+        # Dataset frame files read and written by this handler
+        self.session = DatasetFrameSession()
+        self.backend = backend
+        self.store = None
+        if backend == 'sqlite':
+            self.store = dataset_store.DatasetStore(
+                    os.path.join(dir_path, 'local_only_files', dataset_store.DB_NAME))
 
     def get_server_path(self):
         # Get server path
@@ -167,80 +563,370 @@ class DatasetFrameHandler:
         """
         If logs are not present on both local and server, copy the one that is present.
         If present on both, merge and update both
+
+        Only rows appended to either copy since the last sync are exchanged
+        (see sync_tails), both copies are merged in full only if one was
+        rewritten. Full merges are read through the session and written by
+        flush, and a copy is only written if the merge changed it.
         """
         subset_cols = ['user', 'recording', 'recording_path', 'info_file_exists']
         dataset_frame_path_list = [
                 os.path.join(self.server_home_dir, 'dataset_frame.csv'),
                 os.path.join(self.dir_path, 'dataset_frame.csv')
                 ]
-        path_exists = [os.path.exists(f) for f in dataset_frame_path_list]
+        path_exists = [self.session.exists(f) for f in dataset_frame_path_list]
         if not all(path_exists) and any(path_exists):
             dataset_frame_path = dataset_frame_path_list[path_exists.index(True)]
-            dataset_frame = pd.read_csv(dataset_frame_path)
-            dataset_frame = dataset_frame.drop_duplicates(
-                    subset=subset_cols,
-                    keep='last')
+            dataset_frame = self.session.read_csv(dataset_frame_path)
+            dataset_frame = drop_duplicate_entries(dataset_frame, subset=subset_cols)
             if path_exists[0]:
-                dataset_frame.to_csv(dataset_frame_path_list[1], index=False)
+                self.session.write_csv(dataset_frame_path_list[1], dataset_frame)
                 self.logger.log(f"Synced dataset frame from server to local: {dataset_frame_path_list[1]}")
             else:
-                dataset_frame.to_csv(dataset_frame_path_list[0], index=False)
+                self.session.write_csv(dataset_frame_path_list[0], dataset_frame)
                 self.logger.log(f"Synced dataset frame from local to server: {dataset_frame_path_list[1]}")
         elif all(path_exists):
-            dataset_frames = [pd.read_csv(f) for f in dataset_frame_path_list]
-            subset_frames = [df[subset_cols] for df in dataset_frames]
-            if not subset_frames[0].equals(subset_frames[1]):
-                self.logger.log(f"Found different dataset frames on server and local")
-                dataset_frame = pd.concat(dataset_frames)
-                dataset_frame = dataset_frame.drop_duplicates(
-                        subset=subset_cols,
-                        keep='last')
-                dataset_frame = dataset_frame.reset_index(drop=True)
-                list_str = "\n".join(dataset_frame_path_list)
-                self.logger.log(f"Merged dataset frames: \n{list_str}")
-                for f in dataset_frame_path_list:
-                    dataset_frame.to_csv(f, index=False)
-                self.logger.log(f"Synced dataset frames: \n{list_str}") 
-            else:
-                # Just drop duplicates and save
-                dataset_frame = dataset_frames[0]
-                dataset_frame = dataset_frame.drop_duplicates(
-                        subset=subset_cols,
-                        keep='last')
-                for f in dataset_frame_path_list:
-                    dataset_frame.to_csv(f, index=False)
+            if self.sync_tails(dataset_frame_path_list):
+                return
+            dataset_frames = [self.session.read_csv(f) for f in dataset_frame_path_list]
+            dataset_frame = drop_duplicate_entries(
+                    pd.concat(dataset_frames, ignore_index=True), subset=subset_cols)
+            merged_csv = dataset_frame.to_csv(index=False)
+            changed = [f for f, df in zip(dataset_frame_path_list, dataset_frames)
+                       if df.to_csv(index=False) != merged_csv]
+            if changed:
+                list_str = "\n".join(changed)
+                self.logger.log(f"Merged dataset frames, updating: \n{list_str}")
+            for f in dataset_frame_path_list:
+                if f in changed:
+                    self.session.write_csv(f, dataset_frame)
+                elif f not in self.session.pending:
+                    self.set_watermark(f)
+
+    def sync_tails(self, dataset_frame_path_list):
+        """
+        Exchange the rows appended to either copy since the last sync
+
+        Rows appended to one copy whose entry_id the other copy did not
+        also get are appended to it, in seq order. Nothing is read but the
+        header and the new rows, and nothing is written if neither copy
+        has new rows.
+
+        Returns False if the copies have to be merged in full instead:
+        there is no watermark yet, a copy was rewritten, a new row has no
+        entry_id or has columns the other copy does not.
+        """
+        if any(f in self.session.pending for f in dataset_frame_path_list):
+            return False
+        state = self.load_sync_state()
+        if not all(f in state for f in dataset_frame_path_list):
+            return False
+        tails = [read_csv_tail(f, state[f]) for f in dataset_frame_path_list]
+        if None in tails:
+            return False
+        rows = [tail[0] for tail in tails]
+        watermarks = [tail[1] for tail in tails]
+        if not any(rows):
+            if watermarks != [state[f] for f in dataset_frame_path_list]:
+                self.save_sync_state(dict(zip(dataset_frame_path_list, watermarks)))
+            return True
+        if not all(r.get(ENTRY_ID_COL) for side in rows for r in side):
+            return False
+        # Rows for each copy from the other one
+        to_append = []
+        for i in range(2):
+            other = rows[1 - i]
+            ids = set(r[ENTRY_ID_COL] for r in rows[i])
+            new_rows = sorted([r for r in other if r[ENTRY_ID_COL] not in ids],
+                              key=lambda r: int(r.get(SEQ_COL) or 0))
+            columns = next(csv.reader([watermarks[i]['header']]))
+            if not fits_header(new_rows, columns):
+                return False
+            to_append.append(new_rows)
+        for i, f in enumerate(dataset_frame_path_list):
+            if not to_append[i]:
+                continue
+            data, size = append_csv_rows(f, watermarks[i]['header'], to_append[i])
+            # If someone else appended at the same time, their rows are
+            # read with ours at the next sync
+            if size == watermarks[i]['size'] + len(data):
+                watermarks[i] = advance_watermark(watermarks[i], data)
+            self.logger.log(f"Synced {len(to_append[i])} new entries to: {f}")
+        self.save_sync_state(dict(zip(dataset_frame_path_list, watermarks)))
+        return True
+
+    def get_sync_state_path(self):
+        return os.path.join(self.dir_path, 'local_only_files', SYNC_STATE_NAME)
+
+    def load_sync_state(self):
+        """
+        Get the watermarks of the dataset frame copies at the last sync
+        """
+        sync_state_path = self.get_sync_state_path()
+        if not os.path.exists(sync_state_path):
+            return {}
+        with open(sync_state_path, 'r') as f:
+            return json.load(f)
+
+    def save_sync_state(self, watermarks):
+        """
+        Update the watermarks of some dataset frame copies
+        """
+        state = self.load_sync_state()
+        state.update(watermarks)
+        sync_state_path = self.get_sync_state_path()
+        os.makedirs(os.path.dirname(sync_state_path), exist_ok=True)
+        with open(sync_state_path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(sync_state_path + '.tmp', sync_state_path)
+
+    def set_watermark(self, dataset_frame_path):
+        """
+        Mark a copy as synced up to its current end
+
+        Skipped if the file changed since the session read it, so rows
+        appended meanwhile are not taken as synced.
+        """
+        cached = self.session.frames.get(dataset_frame_path)
+        if cached is not None and cached[0] != self.session.signature(dataset_frame_path):
+            return
+        self.save_sync_state({dataset_frame_path: make_watermark(dataset_frame_path)})
 
     def add_entry(self, entry_dict):
         """
         Add entry to dataset frame
         """
+        self.add_entries([entry_dict])
+
+    def add_entries(self, entry_dicts):
+        """
+        Add several entries to dataset frame with a single journal write
+
+        Each entry is given an entry_id and a seq unless it has them. The
+        journal is compacted into the csv in the background once it passes
+        COMPACT_ABOVE_BYTES.
+        """
         entry_keys = ['date', 'time', 'user', 'email', 'recording', 'recording_path']
-        # Check that dict has all required keys
-        if not all([k in entry_dict.keys() for k in entry_keys]):
-            print(f"Missing keys in entry_dict: {entry_dict.keys()}")
-            print(f"Required keys: {entry_keys}")
-            raise ValueError("Missing keys in entry_dict")
-        else:
-            dataset_frame = pd.read_csv(self.dataset_frame_path)
-            dataset_frame = dataset_frame._append(entry_dict, ignore_index=True)
-            dataset_frame.to_csv(self.dataset_frame_path, index=False)
+        # Check that dicts have all required keys
+        for entry_dict in entry_dicts:
+            if not all([k in entry_dict.keys() for k in entry_keys]):
+                print(f"Missing keys in entry_dict: {entry_dict.keys()}")
+                print(f"Required keys: {entry_keys}")
+                raise ValueError("Missing keys in entry_dict")
+        for entry_dict in entry_dicts:
+            entry_dict.setdefault(ENTRY_ID_COL, uuid.uuid4().hex)
+            entry_dict.setdefault(SEQ_COL, self.next_seq())
+        journal_size = append_records(self.journal_path, entry_dicts)
+        if self.store is not None:
+            self.refresh_store()
+        if self.fingerprint_index is not None:
+            self.index_entries(entry_dicts)
+        for entry_dict in entry_dicts:
             pformat_dict = pformat(entry_dict, indent=4)
             self.logger.log(f"Added entry to dataset frame: \n {pformat_dict}")
-            self.sync_logs()
+        if journal_size >= COMPACT_ABOVE_BYTES:
+            self.start_compaction()
 
-    def check_experiment_exists(self, data_folder):
+    def next_seq(self):
         """
-        Check if experiment has already been transferred
+        Get a seq for a new entry: the time in ns, always above the last one
         """
-        dataset_frame = pd.read_csv(self.dataset_frame_path)
-        recording = os.path.basename(data_folder)
-        if recording in dataset_frame['recording'].values:
-            print("Recording already exists") 
-            row = dataset_frame.loc[dataset_frame['recording'] == recording]
-            print(row.T)
-            return True
+        self.last_seq = max(time.time_ns(), self.last_seq + 1)
+        return self.last_seq
+
+    def read_dataset_frame(self):
+        """
+        Read the dataset frame, including entries still in the journal
+        """
+        if self.store is not None:
+            self.refresh_store()
+            return self.store.to_frame()
+        return self.session.read_dataset_frame(self.dataset_frame_path, self.server_home_dir)
+
+    def flush(self):
+        """
+        Write dataset frames kept by the session, once at the end of a run
+
+        A running compaction is waited for first, as the csvs it appends
+        to would otherwise look changed by another process.
+        """
+        self.wait_for_compaction()
+        written = self.session.flush()
+        if written:
+            list_str = "\n".join(written)
+            self.logger.log(f"Wrote dataset frames: \n{list_str}")
+            self.save_sync_state({f: make_watermark(f) for f in written
+                                  if os.path.basename(f) == 'dataset_frame.csv'})
+        return written
+
+    def refresh_store(self):
+        """
+        Bring the sqlite store up to date with the csv and journal
+
+        Records appended to the journal since the last refresh are added
+        to the store. If the csv has changed (e.g. it was synced or
+        compacted) or a compaction is under way, the whole dataset frame
+        is imported again. A csv kept by the session for flush is imported
+        from memory, so lookups do not write it early.
+        """
+        journal_path, compacting_path = get_journal_paths(self.server_home_dir)
+        pending = self.session.pending.get(self.dataset_frame_path)
+        if pending is not None:
+            # The session keeps the frame, so its id is not reused while pending
+            csv_source = [self.dataset_frame_path, 'pending', id(pending)]
         else:
+            csv_stat = os.stat(self.dataset_frame_path)
+            csv_source = [self.dataset_frame_path, csv_stat.st_mtime_ns, csv_stat.st_size]
+        source = self.store.get_meta('source')
+        if source is not None and source['csv'] == csv_source \
+                and not os.path.exists(compacting_path):
+            offset = source['offset']
+            if os.path.exists(journal_path) \
+                    and os.stat(journal_path).st_ino != source['journal_inode']:
+                offset = 0
+            records, offset, inode = read_journal_tail(journal_path, offset)
+            if records or inode != source['journal_inode']:
+                self.store.insert(records, meta=dict(source=dict(
+                    csv=csv_source, journal_inode=inode, offset=offset)))
+            return
+        # Same order as read_dataset_frame: journals first, then the csv
+        records, offset, inode = read_journal_tail(journal_path)
+        records = read_journal(compacting_path) + records
+        dataset_frame = merge_records(self.session.read_csv(self.dataset_frame_path), records)
+        self.store.import_frame(dataset_frame, meta=dict(source=dict(
+            csv=csv_source, journal_inode=inode, offset=offset)))
+
+    def compact(self):
+        """
+        Fold the journal into the server and local dataset frames
+        """
+        if self.session.pending:
+            self.flush()
+        return self.compact_files()
+
+    def compact_files(self):
+        """
+        Fold the journal into the dataset frames on disk
+
+        Run by the compaction thread, so it does not touch the session.
+        """
+        dataset_frame_path_list = [
+                os.path.join(self.server_home_dir, 'dataset_frame.csv'),
+                os.path.join(self.dir_path, 'dataset_frame.csv')
+                ]
+        n_records = compact_journal(dataset_frame_path_list, self.server_home_dir)
+        if n_records:
+            self.logger.log(f"Compacted {n_records} journal entries into dataset frame")
+        return n_records
+
+    def start_compaction(self):
+        """
+        Compact the journal in a background thread, unless one is running
+
+        The thread is not a daemon, so the interpreter waits for it to
+        finish before exiting.
+        """
+        if self.compaction is not None and self.compaction.is_alive():
+            return
+        # The compaction writes the csvs on disk
+        self.flush()
+        self.compaction = threading.Thread(
+                target=self.compact_files, name='dataset_frame_compaction')
+        self.compaction.start()
+
+    def wait_for_compaction(self):
+        """
+        Wait for a compaction started by start_compaction to finish
+        """
+        if self.compaction is not None:
+            self.compaction.join()
+            self.compaction = None
+
+    def index_entries(self, entry_dicts):
+        """
+        Add entries with a fingerprint to the fingerprint index
+        """
+        for entry_dict in entry_dicts:
+            fingerprint = entry_dict.get('fingerprint')
+            if isinstance(fingerprint, str):
+                self.fingerprint_index.setdefault(fingerprint, []).append(entry_dict)
+
+    def load_fingerprint_index(self):
+        """
+        Build the fingerprint index from a single read of the dataset frame
+        """
+        dataset_frame = self.read_dataset_frame()
+        self.fingerprint_index = {}
+        if 'fingerprint' in dataset_frame.columns:
+            self.index_entries(dataset_frame.to_dict('records'))
+        return self.fingerprint_index
+
+    def find_fingerprint(self, fingerprint):
+        """
+        Get the dataset frame entries of recordings with this fingerprint
+        """
+        if self.store is not None:
+            self.refresh_store()
+            return self.store.find_fingerprint(fingerprint)
+        if self.fingerprint_index is None:
+            self.load_fingerprint_index()
+        return self.fingerprint_index.get(fingerprint, [])
+
+    def find_recording(self, recording):
+        """
+        Get the dataset frame rows of recordings with this name
+        """
+        if self.store is not None:
+            self.refresh_store()
+            return pd.DataFrame(self.store.find_recording(recording))
+        return self.session.find_recording(
+                self.dataset_frame_path, self.server_home_dir, recording)
+
+    def match_recording(self, data_folder, fingerprint=None):
+        """
+        Find how a recording matches the dataset frame
+
+        Returns:
+            kind: 'fingerprint' if a recording with the same contents was
+                logged, 'name' if one with the same name was, 'conflict' if
+                all recordings logged with the same name have a different
+                fingerprint, or None
+            rows: the matching dataset frame rows, as a DataFrame
+        """
+        if fingerprint is not None:
+            duplicates = self.find_fingerprint(fingerprint)
+            if duplicates:
+                return 'fingerprint', pd.DataFrame(duplicates)
+        row = self.find_recording(os.path.basename(data_folder))
+        if not len(row):
+            return None, row
+        if fingerprint is not None and 'fingerprint' in row.columns \
+                and row['fingerprint'].notna().all():
+            return 'conflict', row
+        return 'name', row
+
+    def check_experiment_exists(self, data_folder, fingerprint=None):
+        """
+        Check if experiment has already been transferred
+
+        If fingerprint is given (see recording_fingerprint.py), recordings
+        with the same contents are reported wherever they are and whatever
+        their name. A recording with the same name is reported whether or
+        not its fingerprint matches, a different fingerprint is reported
+        as a conflict for the caller to decide on (see match_recording).
+        """
+        kind, row = self.match_recording(data_folder, fingerprint)
+        if kind is None:
             return False
+        if kind == 'fingerprint':
+            print("Recording with the same contents already exists")
+        elif kind == 'conflict':
+            print("Recording with the same name but different contents already exists: "
+                  f"{os.path.basename(data_folder)}")
+        else:
+            print("Recording already exists")
+        print(row.T)
+        return True
 
 
 # ##############################
@@ -0,0 +1,202 @@
+"""
+SQLite copy of the dataset frame for indexed lookups
+
+dataset_frame.csv has to be read in full for every check. With the
+sqlite backend of DatasetFrameHandler, entries are also kept in a local
+SQLite database with indexes on recording, user, fingerprint and date, so
+checking whether a recording exists or listing a user's recordings is an
+index lookup.
+
+The csv and its journal on the server stay the shared record that every
+rig reads and writes, and the database is refreshed from them: appended
+journal records are read from where the last refresh stopped, and the
+whole frame is imported again only when the csv itself has changed (e.g.
+after a sync or compaction). The database lives in local_only_files
+because SQLite's WAL mode needs shared memory, which network mounts do
+not provide.
+
+usage: python -m src.dataset_store import <csv_path> [--db DB]
+       python -m src.dataset_store export <csv_path> [--db DB]
+       python -m src.dataset_store report [--db DB]
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+import pandas as pd
+from src.utils.utils import base_dir_path
+
+
+DB_NAME = 'dataset_frame.sqlite'
+DB_PATH = os.path.join(base_dir_path, 'local_only_files', DB_NAME)
+# Columns with a column of their own, in csv order, other keys go to extra
+ENTRY_COLUMNS = ['date', 'time', 'user', 'email', 'recording', 'recording_path',
+                 'info_file_exists', 'manifest_digest', 'small_files_bundle',
+                 'fingerprint']
+INDEXED_COLUMNS = ['recording', 'user', 'fingerprint', 'date']
+
+##############################
+##############################
+
+def to_records(dataset_frame):
+    """Convert a dataset frame to a list of dicts, with None for missing values."""
+    dataset_frame = dataset_frame.astype(object).where(dataset_frame.notna(), None)
+    return dataset_frame.to_dict('records')
+
+
+class DatasetStore:
+    """
+    Dataset frame entries in a SQLite database
+
+    Lookups return entries as dicts, like rows of the csv, without the
+    keys an entry does not have.
+    """
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.create_tables()
+
+    def create_tables(self):
+        """Create the entries and meta tables and the indexes if missing."""
+        columns = ', '.join(ENTRY_COLUMNS)
+        with self.conn:
+            self.conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS entries '
+                    f'(row_id INTEGER PRIMARY KEY, {columns}, extra TEXT)')
+            for column in INDEXED_COLUMNS:
+                self.conn.execute(
+                        f'CREATE INDEX IF NOT EXISTS entries_{column} ON entries ({column})')
+            self.conn.execute(
+                    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def _row(self, entry):
+        """Split an entry into values of the entry columns and a JSON extra."""
+        values = [entry.get(c) for c in ENTRY_COLUMNS]
+        extra = {k: v for k, v in entry.items()
+                 if k not in ENTRY_COLUMNS and v is not None}
+        return values + [json.dumps(extra, default=str) if extra else None]
+
+    def _entry(self, row):
+        """Rebuild an entry from a row of the entries table."""
+        entry = {c: v for c, v in zip(ENTRY_COLUMNS, row[1:-1]) if v is not None}
+        if 'info_file_exists' in entry:
+            entry['info_file_exists'] = bool(entry['info_file_exists'])
+        if row[-1] is not None:
+            entry.update(json.loads(row[-1]))
+        return entry
+
+    def _insert(self, entries):
+        placeholders = ', '.join('?' * (len(ENTRY_COLUMNS) + 1))
+        self.conn.executemany(
+                f'INSERT INTO entries ({", ".join(ENTRY_COLUMNS)}, extra) '
+                f'VALUES ({placeholders})',
+                [self._row(e) for e in entries])
+
+    def _set_meta(self, meta):
+        self.conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                              [(k, json.dumps(v)) for k, v in (meta or {}).items()])
+
+    def insert(self, entries, meta=None):
+        """Insert entries, and set meta values, in a single transaction."""
+        with self.conn:
+            self._insert(entries)
+            self._set_meta(meta)
+
+    def import_frame(self, dataset_frame, meta=None):
+        """Replace all entries with the rows of a dataset frame, in one transaction."""
+        with self.conn:
+            self.conn.execute('DELETE FROM entries')
+            self._insert(to_records(dataset_frame))
+            self._set_meta(meta)
+
+    def import_csv(self, csv_path):
+        """Replace all entries with the rows of a dataset frame csv."""
+        self.import_frame(pd.read_csv(csv_path))
+
+    def query(self, where='', params=()):
+        """Get entries matching an SQL where clause, in insertion order."""
+        rows = self.conn.execute(
+                f'SELECT * FROM entries {where} ORDER BY row_id', params).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def find_recording(self, recording):
+        """Get the entries of recordings with this name."""
+        return self.query('WHERE recording = ?', (recording,))
+
+    def find_fingerprint(self, fingerprint):
+        """Get the entries of recordings with this fingerprint."""
+        return self.query('WHERE fingerprint = ?', (fingerprint,))
+
+    def find_user(self, user):
+        """Get the entries of a user."""
+        return self.query('WHERE user = ?', (user,))
+
+    def to_frame(self):
+        """Get all entries as a dataset frame."""
+        entries = self.query()
+        columns = list(dict.fromkeys(
+            [c for c in ENTRY_COLUMNS if any(c in e for e in entries)]
+            + [k for e in entries for k in e]))
+        return pd.DataFrame(entries, columns=columns or ENTRY_COLUMNS[:6])
+
+    def export_csv(self, csv_path):
+        """Write all entries to a csv in the dataset frame format."""
+        self.to_frame().to_csv(csv_path, index=False)
+
+    def user_report(self):
+        """Count the recordings of each user, with their first and last dates."""
+        return pd.read_sql_query(
+                'SELECT user, COUNT(*) AS n_recordings, MIN(date) AS first_date, '
+                'MAX(date) AS last_date FROM entries GROUP BY user ORDER BY user',
+                self.conn)
+
+    def get_meta(self, key):
+        """Get a value stored with set_meta, None if it was never set."""
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_meta(self, key, value):
+        """Store a JSON serializable value, e.g. what the entries were read from."""
+        with self.conn:
+            self._set_meta({key: value})
+
+    def close(self):
+        """Close the database connection."""
+        self.conn.close()
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+            description='Import, export or report on the SQLite copy of the dataset frame')
+    parser.add_argument('command', choices=['import', 'export', 'report'])
+    parser.add_argument('csv_path', type=str, nargs='?', default=None,
+                        help='Dataset frame csv to import from or export to.')
+    parser.add_argument('--db', type=str, default=DB_PATH,
+                        help=f'Path of the database (default: {DB_PATH}).')
+    return parser.parse_args()
+
+
+def main():
+    """Main function to run the script"""
+    args = parse_arguments()
+    store = DatasetStore(args.db)
+    if args.command == 'report':
+        print(store.user_report().to_string(index=False))
+    elif args.csv_path is None:
+        print(f"A csv path is needed to {args.command}")
+        print("Exiting...")
+    elif args.command == 'import':
+        store.import_csv(args.csv_path)
+        print(f"Imported {len(store.query())} entries from: {args.csv_path}")
+    else:
+        store.export_csv(args.csv_path)
+        print(f"Exported {len(store.query())} entries to: {args.csv_path}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Bundle small files of a recording into a single tar on the server
+
+Behavior rigs produce thousands of tiny files (event logs, per-trial images,
+settings), each of which costs several CIFS round trips when copied on its
+own. Files below a size threshold are instead packed into one tar file
+streamed to the server, next to an index of where each member's data
+starts, so single files can be listed and extracted later without reading
+the whole bundle.
+
+usage: python -m src.file_bundle list <server_data_folder>
+       python -m src.file_bundle extract <server_data_folder> [files ...] [--out OUT]
+"""
+
+import os
+import io
+import csv
+import hashlib
+import tarfile
+import argparse
+from src.transfer_engine import (
+    COPY_BUFFER_SIZE,
+    DIGEST_ALGORITHM,
+    PARTIAL_SUFFIX,
+)
+
+
+BUNDLE_NAME = 'blech_small_files.tar'
+BUNDLE_INDEX_NAME = 'blech_small_files_index.csv'
+INDEX_COLUMNS = ['path', 'offset', 'size', 'mtime', 'digest']
+# Write buffer for the bundle, so it reaches the server in few large writes
+BUNDLE_BUFFER_SIZE = 16 * COPY_BUFFER_SIZE
+
+##############################
+##############################
+
+def split_small_files(file_sizes, threshold):
+    """Split files into those below threshold bytes and the rest."""
+    small = sorted(f for f, size in file_sizes.items() if size < threshold)
+    large = sorted(f for f, size in file_sizes.items() if size >= threshold)
+    return small, large
+
+
+class _HashingWriter:
+    """
+    File wrapper which hashes everything written through it
+    """
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.new(DIGEST_ALGORITHM)
+
+    def write(self, buf):
+        self.digest.update(buf)
+        return self.f.write(buf)
+
+
+def read_bundle_index(server_data_folder):
+    """Read the bundle index of a server recording into a dict keyed by path."""
+    index_path = os.path.join(server_data_folder, BUNDLE_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, 'r', newline='') as f:
+        return {row['path']: row for row in csv.DictReader(f)}
+
+
+def bundle_is_current(data_folder, server_data_folder, small_files):
+    """Check whether the bundle on the server already holds small_files as they are."""
+    if not os.path.exists(os.path.join(server_data_folder, BUNDLE_NAME)):
+        return False
+    index = read_bundle_index(server_data_folder)
+    if sorted(index) != sorted(small_files):
+        return False
+    for rel_file in small_files:
+        src_stat = os.stat(os.path.join(data_folder, rel_file))
+        if index[rel_file]['size'] != str(src_stat.st_size) or \
+                index[rel_file]['mtime'] != repr(src_stat.st_mtime):
+            return False
+    return True
+
+
+def write_bundle(data_folder, server_data_folder, small_files, progress=None):
+    """
+    Stream small_files into a tar bundle on the server and write its index
+
+    The bundle is written under a temporary name and renamed once complete,
+    as other files are. The index records where the data of each member
+    starts in the bundle, along with its size, mtime and digest.
+
+    Returns:
+        bundle_digest: digest of the whole bundle
+        bundle_size: size of the bundle in bytes
+    """
+    bundle_path = os.path.join(server_data_folder, BUNDLE_NAME)
+    partial_path = bundle_path + PARTIAL_SUFFIX
+    rows = []
+    with open(partial_path, 'wb', buffering=BUNDLE_BUFFER_SIZE) as f:
+        writer = _HashingWriter(f)
+        with tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for rel_file in small_files:
+                src_path = os.path.join(data_folder, rel_file)
+                with open(src_path, 'rb') as src:
+                    data = src.read()
+                tarinfo = tar.gettarinfo(src_path, arcname=rel_file)
+                tar.addfile(tarinfo, io.BytesIO(data))
+                # Data is followed by padding up to the next tar block
+                padded_size = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                rows.append(dict(
+                    path=rel_file,
+                    offset=str(tar.offset - padded_size),
+                    size=str(len(data)),
+                    mtime=repr(os.stat(src_path).st_mtime),
+                    digest=hashlib.new(DIGEST_ALGORITHM, data).hexdigest(),
+                    ))
+                if progress is not None:
+                    progress.update(len(data))
+        f.flush()
+        os.fsync(f.fileno())
+        bundle_size = f.tell()
+    os.replace(partial_path, bundle_path)
+
+    index_path = os.path.join(server_data_folder, BUNDLE_INDEX_NAME)
+    with open(index_path + PARTIAL_SUFFIX, 'w', newline='') as f:
+        index_writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS)
+        index_writer.writeheader()
+        index_writer.writerows(rows)
+    os.replace(index_path + PARTIAL_SUFFIX, index_path)
+
+    return writer.digest.hexdigest(), bundle_size
+
+
+def extract_from_bundle(server_data_folder, rel_file, out_path):
+    """Extract a single file from the bundle using its index entry."""
+    index = read_bundle_index(server_data_folder)
+    if rel_file not in index:
+        raise KeyError(f"{rel_file} is not in the bundle of {server_data_folder}")
+    entry = index[rel_file]
+    with open(os.path.join(server_data_folder, BUNDLE_NAME), 'rb') as f:
+        f.seek(int(entry['offset']))
+        data = f.read(int(entry['size']))
+    if hashlib.new(DIGEST_ALGORITHM, data).hexdigest() != entry['digest']:
+        raise ValueError(f"Digest mismatch for {rel_file} in bundle")
+    out_dir = os.path.dirname(out_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with open(out_path, 'wb') as f:
+        f.write(data)
+    mtime = float(entry['mtime'])
+    os.utime(out_path, (mtime, mtime))
+    return out_path
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+            description='List or extract files bundled by blech_data_transfer.py')
+    parser.add_argument('command', choices=['list', 'extract'])
+    parser.add_argument('server_data_folder', type=str,
+                        help='Recording folder on the server containing the bundle.')
+    parser.add_argument('files', nargs='*',
+                        help='Files to extract (default: all).')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Folder to extract into (default: the recording folder).')
+    return parser.parse_args()
+
+
+def main():
+    """Main function to run the script"""
+    args = parse_arguments()
+    index = read_bundle_index(args.server_data_folder)
+    if not index:
+        print(f"No bundle index found in: {args.server_data_folder}")
+        return
+    if args.command == 'list':
+        for rel_file, entry in sorted(index.items()):
+            print(f"{int(entry['size']):>12}  {rel_file}")
+        return
+    out_dir = args.out if args.out is not None else args.server_data_folder
+    for rel_file in (args.files or sorted(index)):
+        out_path = extract_from_bundle(
+                args.server_data_folder, rel_file, os.path.join(out_dir, rel_file))
+        print(f"Extracted: {out_path}")
+
+
+if __name__ == "__main__":
+    main()
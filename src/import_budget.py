@@ -0,0 +1,107 @@
+"""
+Measure how long the transfer scripts take to start
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter and
+adds up the time Python spends importing the module and everything it pulls
+in. Starting a transfer should not pay for pandas, numpy or easygui, which
+are only imported on the paths that need them (reading the users list, the
+dataset frame, compressing files, the folder picker).
+
+Fails (exit code 1) if startup takes longer than the budget or a heavy
+module is imported at startup.
+
+usage: python -m src.import_budget [--module MODULE] [--budget_ms MS] [--top N]
+"""
+
+import sys
+import argparse
+import subprocess
+from src.utils.utils import base_dir_path
+
+
+DEFAULT_MODULE = 'src.blech_data_transfer'
+# Import time allowed for DEFAULT_MODULE, pandas alone takes longer
+IMPORT_BUDGET_MS = 250
+# Modules which must not be imported just to start a transfer
+HEAVY_MODULES = ('pandas', 'numpy', 'easygui')
+
+##############################
+##############################
+
+def parse_importtime(stderr):
+    """
+    Parse the output of -X importtime
+
+    Returns a list of (module, self_us, cumulative_us, depth), in the
+    order modules finished importing.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # Header line
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+    return imports
+
+
+def measure_imports(module=DEFAULT_MODULE):
+    """Import module in a fresh interpreter and parse its import times."""
+    result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=base_dir_path, capture_output=True, text=True, check=True)
+    return parse_importtime(result.stderr)
+
+
+def check_budget(imports, budget_ms=IMPORT_BUDGET_MS, heavy_modules=HEAVY_MODULES):
+    """
+    Check parsed import times against a budget
+
+    Returns:
+        total_ms: time spent importing, summed over top-level imports
+        heavy: heavy modules which were imported
+        ok: whether total_ms is within budget and no heavy module was imported
+    """
+    total_ms = sum(cumulative for _, _, cumulative, depth in imports if depth == 0) / 1000
+    names = set(name for name, _, _, _ in imports)
+    heavy = [m for m in heavy_modules if m in names]
+    return total_ms, heavy, total_ms <= budget_ms and not heavy
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+            description='Check the startup import time of a transfer script')
+    parser.add_argument('--module', type=str, default=DEFAULT_MODULE,
+                        help=f'Module to import (default: {DEFAULT_MODULE}).')
+    parser.add_argument('--budget_ms', type=float, default=IMPORT_BUDGET_MS,
+                        help=f'Allowed import time in ms (default: {IMPORT_BUDGET_MS}).')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Number of slowest imports to list (default: 10).')
+    return parser.parse_args()
+
+
+def main():
+    """Main function to run the script"""
+    args = parse_arguments()
+    imports = measure_imports(args.module)
+    total_ms, heavy, ok = check_budget(imports, budget_ms=args.budget_ms)
+    print(f"Slowest imports of {args.module}:")
+    for name, _, cumulative, _ in sorted(imports, key=lambda x: -x[2])[:args.top]:
+        print(f"{cumulative / 1000:>9.1f} ms  {name}")
+    print("")
+    print(f"Import time: {total_ms:.1f} ms (budget: {args.budget_ms:.0f} ms)")
+    if heavy:
+        print(f"Heavy modules imported at startup: {', '.join(heavy)}")
+    if not ok:
+        print("Over budget")
+        sys.exit(1)
+    print("Within budget")
+
+
+if __name__ == "__main__":
+    main()
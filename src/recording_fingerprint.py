@@ -0,0 +1,108 @@
+"""
+Content fingerprint of a recording, to find duplicates whatever their name
+
+Checking for an existing recording by folder name misses renamed copies
+and flags different recordings which happen to share a name. The
+fingerprint is instead made from what the recording contains:
+
+- the contents of info.rhd and of .info files
+- the sizes of all raw files, sorted, so renaming files does not change it
+- blocks sampled from the start, middle and end of each large raw file
+
+Only the raw acquisition files (info.rhd, .info and .dat files) are used,
+so outputs of preprocessing on the rig (HDF5 files, plots, clustering
+results) do not change the fingerprint of a recording uploaded again.
+
+It only reads a few blocks per file, so it takes seconds even for large
+recordings, and is stored with each dataset frame entry.
+
+usage: python -m src.recording_fingerprint <data_folder>
+"""
+
+import os
+import hashlib
+import argparse
+from src.transfer_engine import scan_recording, DIGEST_ALGORITHM
+
+
+# Files hashed in full, all others only contribute their size and samples
+HASHED_NAMES = ('info.rhd',)
+HASHED_SUFFIXES = ('.info',)
+# Files written by acquisition, all others are left out
+RAW_SUFFIXES = ('.info', '.rhd', '.dat')
+# Files at least this large contribute sampled blocks
+SAMPLE_MIN_SIZE = 1024 * 1024
+SAMPLE_BLOCK_SIZE = 64 * 1024
+# Hex characters of the fingerprint
+FINGERPRINT_SIZE = 16
+
+##############################
+##############################
+
+def is_hashed(rel_path):
+    """Whether a file is hashed in full for the fingerprint."""
+    name = os.path.basename(rel_path)
+    return name in HASHED_NAMES or name.endswith(HASHED_SUFFIXES)
+
+
+def is_raw(rel_path):
+    """Whether a file was written by acquisition and is part of the fingerprint."""
+    return os.path.basename(rel_path).endswith(RAW_SUFFIXES)
+
+
+def sample_blocks(path, size):
+    """Hash blocks from the start, middle and end of a file."""
+    digest = hashlib.new(DIGEST_ALGORITHM)
+    offsets = sorted(set([0, (size - SAMPLE_BLOCK_SIZE) // 2, size - SAMPLE_BLOCK_SIZE]))
+    with open(path, 'rb') as f:
+        for offset in offsets:
+            f.seek(max(0, offset))
+            digest.update(f.read(SAMPLE_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def fingerprint_recording(data_folder):
+    """
+    Compute the content fingerprint of the recording in data_folder
+
+    Every part is sorted before it is hashed, so the fingerprint does
+    not depend on the names of the folder or of the files in it. Files
+    which are not raw acquisition files are skipped.
+
+    Returns the fingerprint as a hex string.
+    """
+    hashed = []
+    sizes = []
+    samples = []
+    for entry in scan_recording(data_folder):
+        if entry.is_dir or not is_raw(entry.rel_path):
+            continue
+        sizes.append(entry.size)
+        if is_hashed(entry.rel_path):
+            with open(entry.path, 'rb') as f:
+                hashed.append(hashlib.new(DIGEST_ALGORITHM, f.read()).hexdigest())
+        elif entry.size >= SAMPLE_MIN_SIZE:
+            samples.append(f"{entry.size}:{sample_blocks(entry.path, entry.size)}")
+
+    digest = hashlib.new(DIGEST_ALGORITHM)
+    for part in [sorted(hashed), sorted(sizes), sorted(samples)]:
+        digest.update(repr(part).encode())
+    return digest.hexdigest()[:FINGERPRINT_SIZE]
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+            description='Print the content fingerprint of a recording')
+    parser.add_argument('data_folder', type=str, help='Path to local data folder.')
+    return parser.parse_args()
+
+
+def main():
+    """Main function to run the script"""
+    args = parse_arguments()
+    print(fingerprint_recording(args.data_folder))
+
+
+if __name__ == "__main__":
+    main()
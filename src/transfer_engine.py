@@ -0,0 +1,1704 @@
+"""
+Copy engine used by blech_data_transfer.py
+
+Copies the files of a recording from the local machine to the server.
+Several files can be kept in flight at once so that a recording made of
+many per-channel files is not bound by the round-trip latency of each file
+on the CIFS mount.
+
+- Files are scheduled largest first to minimize the total transfer time
+- Progress is reported as a single byte-based bar for the whole recording
+- Errors are collected per file so one bad file does not stop the others
+- Files are written to a temporary name and renamed only once complete
+- Committed offsets are kept in a local journal so an interrupted
+    transfer resumes from the last committed chunk
+- Files already on the server are compared rsync-style (size + mtime,
+    optionally content hash) and only copied if they differ, against a
+    snapshot of the server folder taken in one walk rather than a stat
+    per file
+- Each file is hashed from the same buffers written to the server and a
+    manifest (path, size, mtime, digest) is written into the server copy
+- Recordings are walked with os.scandir in a single pass, and copying can
+    start while the walk is still running
+- Throughput can be capped, and the number of concurrent copies adapted
+    to the measured throughput and write latency
+- Amplifier files can be compressed on the way to the server
+    (see amp_compression.py)
+- Chunks are moved by a pluggable copy backend, kernel copies where the
+    filesystem allows them (see copy_backends.py)
+- Copied pages can be dropped from the page cache as the copy goes, so a
+    transfer does not evict the working set of acquisition software, and
+    the page cache is sampled during every transfer
+- Before copying, the bytes to transfer are checked against the free space
+    on the server and the duration is estimated from past throughput
+- Files hit by transient errors of a flaky mount (EIO, ESTALE, EAGAIN,
+    ...) are retried with exponential backoff and jitter, resuming from
+    the journal, and a failure budget stops a transfer going badly
+- A recording can be followed while it is being acquired, copying the
+    bytes appended to its .dat files as they are written and finishing
+    the copy once acquisition stops
+- Very large files can be split into segments copied concurrently with
+    pread/pwrite into a preallocated file, each retried on its own, so a
+    single file can use several connections of the link
+"""
+
+import os
+import csv
+import random
+import json
+import errno
+import hashlib
+import shutil
+import threading
+import time
+from collections import namedtuple
+from itertools import zip_longest
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from tqdm import tqdm
+from src.utils.utils import base_dir_path
+from src import amp_compression
+from src import copy_backends
+from src import transfer_rules
+
+
+# Size of the buffer used when copying a file
+COPY_BUFFER_SIZE = 1024 * 1024
+# Bytes written between journal commits
+JOURNAL_CHUNK_SIZE = 64 * COPY_BUFFER_SIZE
+# Suffix of files which are still being copied
+PARTIAL_SUFFIX = '.blech_partial'
+# Default location of transfer journals
+JOURNAL_DIR = os.path.join(base_dir_path, 'local_only_files', 'transfer_journals')
+# Largest mtime difference (in seconds) still treated as equal,
+# as CIFS does not store mtimes at the same resolution as local disks
+MTIME_TOLERANCE = 2.0
+# Hash used for file digests and the manifest fingerprint
+DIGEST_ALGORITHM = 'blake2b'
+# Name of the manifest written into the server copy of a recording
+MANIFEST_NAME = 'blech_transfer_manifest.csv'
+# Copies queued per worker when streaming, bounds memory on huge folders
+STREAM_QUEUE_PER_WORKER = 4
+# Seconds between adjustments of the adaptive concurrency limit
+ADAPT_INTERVAL = 5.0
+# Relative throughput change treated as an improvement / degradation
+ADAPT_IMPROVEMENT = 0.05
+ADAPT_DEGRADATION = 0.10
+# Write latency above this multiple of the best seen triggers a back-off
+ADAPT_LATENCY_FACTOR = 3.0
+
+# Log of throughput measured by past transfers, used to estimate durations
+THROUGHPUT_LOG = os.path.join(base_dir_path, 'local_only_files', 'transfer_throughput.csv')
+THROUGHPUT_COLUMNS = ['date', 'bytes_copied', 'mean_mb_per_s', 'max_workers', 'max_mb_per_s']
+# Past transfers used for the estimate
+THROUGHPUT_HISTORY = 10
+# Transfers smaller than this are dominated by overheads and not logged
+THROUGHPUT_MIN_BYTES = JOURNAL_CHUNK_SIZE
+# Free space kept on the server on top of the bytes to copy, as a fraction
+FREE_SPACE_MARGIN = 0.05
+
+# Bytes copied between drops of cached pages when dropping the cache
+CACHE_DROP_INTERVAL = JOURNAL_CHUNK_SIZE
+# Seconds between samples of the page cache size
+PAGE_CACHE_SAMPLE_INTERVAL = 0.5
+MEMINFO_PATH = '/proc/meminfo'
+# Files at least this large are split into segments if segment_workers > 1
+SEGMENT_THRESHOLD = 1024 * COPY_BUFFER_SIZE
+SEGMENT_SIZE = 256 * COPY_BUFFER_SIZE
+# Files copied as they grow when following a live recording,
+# other files are copied once the recording has settled
+LIVE_TAIL_SUFFIXES = ('.dat',)
+# Errors of a flaky mount after which a file is tried again
+RETRY_ERRNOS = {errno.EIO, errno.ESTALE, errno.EAGAIN, errno.ETIMEDOUT,
+                errno.ECONNRESET, errno.ECONNABORTED, errno.EHOSTUNREACH}
+# Attempts per file after the first
+FILE_RETRIES = 5
+# Backoff before retry n is up to RETRY_BASE_DELAY * 2**n, at most RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+
+# Entry of a transfer plan, size is None for directories
+PlanEntry = namedtuple('PlanEntry', ['path', 'rel_path', 'is_dir', 'size'])
+# State of a server folder: relative paths of its directories,
+# and stat results of its files keyed by relative path
+DestinationSnapshot = namedtuple('DestinationSnapshot', ['dirs', 'files'])
+
+##############################
+##############################
+
+def scan_recording(data_folder):
+    """
+    Walk data_folder with os.scandir and yield a PlanEntry per item
+
+    Directories are yielded before their contents, and entries within a
+    directory in sorted order. The type of each entry comes from the
+    cached DirEntry information, so each file costs at most one stat
+    (for its size). Hidden entries are skipped, as they were by glob.
+    """
+    stack = [data_folder]
+    while stack:
+        this_dir = stack.pop()
+        with os.scandir(this_dir) as it:
+            entries = sorted(
+                    (e for e in it if not e.name.startswith('.')),
+                    key=lambda e: e.name)
+        sub_dirs = []
+        for entry in entries:
+            rel_path = os.path.relpath(entry.path, data_folder)
+            if entry.is_dir():
+                yield PlanEntry(entry.path, rel_path, True, None)
+                sub_dirs.append(entry.path)
+            elif entry.is_file():
+                yield PlanEntry(entry.path, rel_path, False, entry.stat().st_size)
+        # Reversed so sub directories are walked in sorted order
+        stack.extend(reversed(sub_dirs))
+
+
+def snapshot_destination(server_data_folder):
+    """
+    Take the state of a server folder in a single recursive walk
+
+    Planning a transfer used to cost an exists/stat round trip on the
+    mount per file and per directory. Walking the folder once with
+    os.scandir lets the CIFS client fill its attribute cache from the
+    directory listings, so the stats taken here are served locally, and
+    later decisions are made in memory.
+
+    Hidden and partial files are included. An empty snapshot is returned
+    if the folder does not exist yet.
+    """
+    dirs = set()
+    files = {}
+    stack = [server_data_folder]
+    while stack:
+        this_dir = stack.pop()
+        try:
+            it = os.scandir(this_dir)
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                rel_path = os.path.relpath(entry.path, server_data_folder)
+                if entry.is_dir():
+                    dirs.add(rel_path)
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    files[rel_path] = entry.stat()
+    return DestinationSnapshot(dirs, files)
+
+
+def missing_dirs(rel_dir_list, snapshot):
+    """
+    Directories of rel_dir_list which are not on the server yet
+
+    Directories which are parents of another missing directory are
+    dropped, as os.makedirs of the child creates them too, so each
+    branch of the tree is created with a single call.
+    """
+    missing = sorted(set(d for d in rel_dir_list if d not in snapshot.dirs))
+    return [d for i, d in enumerate(missing)
+            if i + 1 == len(missing) or not missing[i + 1].startswith(d + os.sep)]
+
+
+def get_file_sizes(data_folder, rel_file_list):
+    """Get the size in bytes of each file in rel_file_list."""
+    return {f: os.path.getsize(os.path.join(data_folder, f)) for f in rel_file_list}
+
+
+def schedule_largest_first(rel_file_list, file_sizes):
+    """Order files so that the largest ones start first."""
+    return sorted(rel_file_list, key=lambda f: file_sizes[f], reverse=True)
+
+
+class RateLimiter:
+    """
+    Token bucket shared between threads to cap throughput in bytes/second
+    """
+    def __init__(self, bytes_per_second, burst_seconds=1.0):
+        self.bytes_per_second = bytes_per_second
+        self.capacity = bytes_per_second * burst_seconds
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n_bytes):
+        """Take n_bytes from the bucket, sleeping if it is empty."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.last_time) * self.bytes_per_second)
+            self.last_time = now
+            # Tokens may go negative, which reserves future capacity
+            # so that concurrent callers queue up behind each other
+            self.tokens -= n_bytes
+            wait = -self.tokens / self.bytes_per_second if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """
+    Hill-climbing limit on the number of files copied at once
+
+    Throughput and write latency are sampled every ADAPT_INTERVAL seconds.
+    The limit is raised while each step up still improves throughput, and
+    lowered when throughput drops or write latency grows well above the
+    best seen, e.g. when other rigs start using the link.
+    """
+    def __init__(self, max_workers, start_workers=2, interval=ADAPT_INTERVAL):
+        self.max_workers = max_workers
+        self.limit = min(start_workers, max_workers)
+        self.interval = interval
+        self.active = 0
+        self.cond = threading.Condition()
+        self.last_throughput = None
+        self.best_latency = None
+        self.history = []
+        self._reset_sample()
+
+    def _reset_sample(self):
+        self.sample_start = time.monotonic()
+        self.sample_bytes = 0
+        self.sample_latency = 0.0
+        self.sample_writes = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def record(self, n_bytes, latency):
+        """Record one write and adjust the limit if a sample is complete."""
+        with self.cond:
+            self.sample_bytes += n_bytes
+            self.sample_latency += latency
+            self.sample_writes += 1
+            elapsed = time.monotonic() - self.sample_start
+            if elapsed >= self.interval:
+                self._adjust(elapsed)
+
+    def _adjust(self, elapsed):
+        throughput = self.sample_bytes / elapsed
+        latency = self.sample_latency / self.sample_writes
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+
+        if self.last_throughput is None or \
+                throughput > self.last_throughput * (1 + ADAPT_IMPROVEMENT):
+            new_limit = min(self.max_workers, self.limit + 1)
+        elif throughput < self.last_throughput * (1 - ADAPT_DEGRADATION) or \
+                latency > self.best_latency * ADAPT_LATENCY_FACTOR:
+            new_limit = max(1, self.limit - 1)
+        else:
+            new_limit = self.limit
+
+        self.history.append(dict(workers=self.limit, throughput=throughput, latency=latency))
+        self.last_throughput = throughput
+        self.limit = new_limit
+        self._reset_sample()
+        self.cond.notify_all()
+
+
+class TransferControls:
+    """
+    Throughput cap and concurrency limit shared by all copies of a transfer
+    """
+    def __init__(self, n_workers=1, max_mb_per_s=None, adaptive=False, backend=None,
+                 drop_cache=False, segment_workers=1, segment_above=SEGMENT_THRESHOLD,
+                 retries=FILE_RETRIES, max_failures=None):
+        self.n_workers = max(1, n_workers)
+        self.backend = backend if backend is not None else copy_backends.DEFAULT_BACKEND
+        self.drop_cache = drop_cache
+        self.segment_workers = max(1, segment_workers)
+        self.segment_above = segment_above
+        self.retries = retries
+        self.max_failures = max_failures
+        self.n_failed = 0
+        self.lock = threading.Lock()
+        self.max_mb_per_s = max_mb_per_s
+        self.rate_limiter = None
+        if max_mb_per_s is not None:
+            self.rate_limiter = RateLimiter(max_mb_per_s * 1024**2)
+        self.concurrency = None
+        if adaptive:
+            self.concurrency = AdaptiveConcurrency(self.n_workers)
+        self.start_time = time.monotonic()
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the concurrent copy slots."""
+        if self.concurrency is None:
+            yield
+            return
+        self.concurrency.acquire()
+        try:
+            yield
+        finally:
+            self.concurrency.release()
+
+    def write(self, dst, buf):
+        """Write buf to dst, throttled and timed."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(len(buf))
+        start = time.monotonic()
+        dst.write(buf)
+        if self.concurrency is not None:
+            self.concurrency.record(len(buf), time.monotonic() - start)
+
+    def record(self, n_bytes, latency):
+        """Throttle and time a chunk already written by a copy backend."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(n_bytes)
+        if self.concurrency is not None:
+            self.concurrency.record(n_bytes, latency)
+
+    def retry(self, copy, progress=None, on_retry=None):
+        """
+        Run copy(progress) for one file, retrying transient errors
+
+        Each attempt reports to progress through an AttemptProgress, so the
+        bytes of a failed attempt are taken back before the next one. If
+        the failure budget is spent, the file is not attempted at all. A
+        file failing for good is counted against the budget before the
+        worker moves on. on_retry is called with the number of retries so far.
+        """
+        if self.budget_spent():
+            raise OSError(errno.ECANCELED, "Not attempted, failure budget spent")
+        for attempt in range(self.retries + 1):
+            attempt_progress = AttemptProgress(progress)
+            try:
+                return copy(attempt_progress)
+            except OSError as e:
+                attempt_progress.rollback()
+                if e.errno not in RETRY_ERRNOS or attempt == self.retries \
+                        or self.budget_spent():
+                    self.record_failure()
+                    raise
+            except ValueError:
+                # Failed verification, not transient
+                attempt_progress.rollback()
+                self.record_failure()
+                raise
+            if on_retry is not None:
+                on_retry(attempt + 1)
+            time.sleep(retry_delay(attempt))
+
+    def record_failure(self):
+        """Count a file which failed for good against the failure budget."""
+        with self.lock:
+            self.n_failed += 1
+
+    def budget_spent(self):
+        """Whether more files failed than max_failures allows."""
+        with self.lock:
+            return self.max_failures is not None and self.n_failed > self.max_failures
+
+    def summary(self, bytes_copied):
+        """Settings used for the transfer and the throughput reached."""
+        elapsed = time.monotonic() - self.start_time
+        summary = dict(
+                max_workers=self.n_workers,
+                max_mb_per_s=self.max_mb_per_s,
+                adaptive=self.concurrency is not None,
+                backend=self.backend,
+                drop_cache=self.drop_cache,
+                segment_workers=self.segment_workers,
+                retries=self.retries,
+                max_failures=self.max_failures,
+                budget_spent=self.budget_spent(),
+                mean_mb_per_s=bytes_copied / 1024**2 / max(elapsed, 1e-9),
+                elapsed=elapsed,
+                )
+        if self.concurrency is not None:
+            summary['final_workers'] = self.concurrency.limit
+            summary['history'] = self.concurrency.history
+        return summary
+
+
+def retry_delay(attempt):
+    """
+    Backoff before retry attempt + 1, with full jitter
+
+    The delay is drawn uniformly up to the exponential bound, so workers
+    failing at the same moment (e.g. a mount dropping) do not all come
+    back to the server in step.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+class AttemptProgress:
+    """
+    Progress of one attempt at copying a file, which can be taken back
+    """
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.n_bytes = 0
+
+    def update(self, n_bytes):
+        self.n_bytes += n_bytes
+        if self.progress is not None:
+            self.progress.update(n_bytes)
+
+    def rollback(self):
+        """Take back everything reported by this attempt."""
+        self.update(-self.n_bytes)
+
+
+def read_meminfo(meminfo_path=MEMINFO_PATH):
+    """Read the page cache fields of /proc/meminfo in bytes, None if unavailable."""
+    if not os.path.exists(meminfo_path):
+        return None
+    fields = {}
+    with open(meminfo_path, 'r') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            if key in ['Cached', 'Dirty', 'Writeback']:
+                fields[key] = int(value.split()[0]) * 1024
+    return fields
+
+
+class PageCacheMonitor:
+    """
+    Sample the size of the page cache in a background thread
+
+    The page cache is shared by the whole machine, so the numbers include
+    other programs, but on a rig the transfer is usually what moves them.
+    """
+    def __init__(self, interval=PAGE_CACHE_SAMPLE_INTERVAL, meminfo_path=MEMINFO_PATH):
+        self.interval = interval
+        self.meminfo_path = meminfo_path
+        self.baseline = read_meminfo(meminfo_path)
+        self.peak_cached = 0
+        self.peak_dirty = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        if self.baseline is not None:
+            self._sample()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _sample(self):
+        fields = read_meminfo(self.meminfo_path)
+        self.peak_cached = max(self.peak_cached, fields['Cached'])
+        self.peak_dirty = max(self.peak_dirty, fields['Dirty'] + fields['Writeback'])
+        return fields
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._sample()
+
+    def stop(self):
+        """
+        Stop sampling
+
+        Returns None if /proc/meminfo is unavailable, else a dict with the
+        page cache size before the transfer and its peak and final growth,
+        and the peak of dirty pages, in MB.
+        """
+        if self.thread is None:
+            return None
+        self.stop_event.set()
+        self.thread.join()
+        final = self._sample()
+        baseline_cached = self.baseline['Cached']
+        return dict(
+                baseline_mb=baseline_cached / 1024**2,
+                peak_increase_mb=(self.peak_cached - baseline_cached) / 1024**2,
+                final_increase_mb=(final['Cached'] - baseline_cached) / 1024**2,
+                peak_dirty_mb=self.peak_dirty / 1024**2,
+                )
+
+
+def advise_sequential(f):
+    """Tell the kernel f will be read sequentially, so it reads ahead further."""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+def drop_cached_pages(*files):
+    """
+    Drop the cached pages of files from the page cache
+
+    Files opened for writing are flushed to disk first, as dirty pages
+    cannot be dropped.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for f in files:
+        if f.writable():
+            f.flush()
+            os.fdatasync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def hash_file(path, n_bytes=None, digest=None, rate_limiter=None):
+    """
+    Hash the contents of path
+
+    If n_bytes is given, only the first n_bytes are hashed. If digest is
+    given, it is updated in place, otherwise a new one is created.
+    If rate_limiter is given, reads are throttled by it.
+
+    Returns the hex digest.
+    """
+    if digest is None:
+        digest = hashlib.new(DIGEST_ALGORITHM)
+    remaining = n_bytes
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            read_size = COPY_BUFFER_SIZE if remaining is None \
+                    else min(COPY_BUFFER_SIZE, remaining)
+            buf = f.read(read_size)
+            if not buf:
+                break
+            if rate_limiter is not None:
+                rate_limiter.consume(len(buf))
+            digest.update(buf)
+            if remaining is not None:
+                remaining -= len(buf)
+    return digest.hexdigest()
+
+
+def compare_files(src_path, dst_path, checksum=False, dst_stat=None):
+    """
+    Decide what to do with a file that may already be on the server
+
+    Files with the same size and mtime are assumed identical. If checksum
+    is True, files with the same size but a different mtime are compared
+    by content hash instead of being copied again. If dst_stat is given
+    (e.g. from snapshot_destination), the server file is not stat'ed.
+
+    Returns one of 'copy', 'skip' or 'overwrite'.
+    """
+    if dst_stat is None:
+        try:
+            dst_stat = os.stat(dst_path)
+        except FileNotFoundError:
+            return 'copy'
+    src_stat = os.stat(src_path)
+    if src_stat.st_size != dst_stat.st_size:
+        return 'overwrite'
+    if abs(src_stat.st_mtime - dst_stat.st_mtime) <= MTIME_TOLERANCE:
+        return 'skip'
+    if checksum and hash_file(src_path) == hash_file(dst_path):
+        return 'skip'
+    return 'overwrite'
+
+
+def compressed_is_current(src_path, compressed_path):
+    """Check whether compressed_path was made from src_path as it is now."""
+    try:
+        with open(compressed_path, 'rb') as f:
+            header = amp_compression.read_header(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    src_stat = os.stat(src_path)
+    return header['size'] == src_stat.st_size and \
+        abs(header['mtime'] - src_stat.st_mtime) <= MTIME_TOLERANCE
+
+
+def get_server_name(rel_file, compress=None):
+    """Name of rel_file on the server, given the compression mode."""
+    if compress is not None and amp_compression.is_compressible(rel_file):
+        return rel_file + amp_compression.COMPRESSED_SUFFIX
+    return rel_file
+
+
+def plan_delta_sync(data_folder, server_data_folder, rel_file_list, checksum=False,
+                    compress=None, snapshot=None):
+    """
+    Compare each file with its copy on the server
+
+    If compress is set, amplifier files are compared with the header of
+    their compressed copy instead. Server files are looked up in
+    snapshot, taken with snapshot_destination if not given.
+
+    Returns:
+        plan: dict with keys
+            copy: files missing on the server
+            overwrite: files which differ from the server copy
+            skip: files identical to the server copy
+            bytes_skipped: total size of skipped files
+    """
+    if snapshot is None:
+        snapshot = snapshot_destination(server_data_folder)
+    plan = dict(copy=[], overwrite=[], skip=[], bytes_skipped=0)
+    for rel_file in rel_file_list:
+        src_path = os.path.join(data_folder, rel_file)
+        server_name = get_server_name(rel_file, compress)
+        dst_path = os.path.join(server_data_folder, server_name)
+        dst_stat = snapshot.files.get(server_name)
+        if dst_stat is None:
+            action = 'copy'
+        elif server_name.endswith(amp_compression.COMPRESSED_SUFFIX):
+            action = 'skip' if compressed_is_current(src_path, dst_path) else 'overwrite'
+        else:
+            action = compare_files(src_path, dst_path, checksum=checksum,
+                                   dst_stat=dst_stat)
+        plan[action].append(rel_file)
+        if action == 'skip':
+            plan['bytes_skipped'] += os.path.getsize(src_path)
+    return plan
+
+
+def get_free_bytes(path):
+    """Bytes available to unprivileged users on the filesystem holding path."""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def record_throughput(settings, bytes_copied, log_path=THROUGHPUT_LOG):
+    """Append the throughput of a finished transfer to the throughput log."""
+    if bytes_copied < THROUGHPUT_MIN_BYTES:
+        return
+    write_header = not os.path.exists(log_path)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=THROUGHPUT_COLUMNS)
+        if write_header:
+            writer.writeheader()
+        writer.writerow(dict(
+            date=time.strftime('%Y-%m-%d %H:%M:%S'),
+            bytes_copied=bytes_copied,
+            mean_mb_per_s=f"{settings['mean_mb_per_s']:.2f}",
+            max_workers=settings['max_workers'],
+            max_mb_per_s=settings['max_mb_per_s'],
+            ))
+
+
+def estimate_mb_per_s(log_path=THROUGHPUT_LOG):
+    """Median throughput of recent transfers, None if none were logged."""
+    if not os.path.exists(log_path):
+        return None
+    with open(log_path, 'r', newline='') as f:
+        rows = list(csv.DictReader(f))[-THROUGHPUT_HISTORY:]
+    if not rows:
+        return None
+    speeds = sorted(float(r['mean_mb_per_s']) for r in rows)
+    return speeds[len(speeds) // 2]
+
+
+def preflight(server_data_folder, total_bytes, bytes_to_copy, max_mb_per_s=None,
+              log_path=THROUGHPUT_LOG):
+    """
+    Check that the server has room for a transfer and estimate its duration
+
+    Compressed files are counted at their original size, so the check is
+    conservative when compressing.
+
+    Returns:
+        check: dict with keys
+            total_bytes, bytes_to_copy: as given
+            free_bytes: bytes free on the server
+            enough_space: whether bytes_to_copy plus a margin fit
+            mb_per_s: expected throughput, None if unknown
+            eta_seconds: expected duration, None if unknown
+    """
+    free_bytes = get_free_bytes(server_data_folder)
+    mb_per_s = estimate_mb_per_s(log_path)
+    if max_mb_per_s is not None:
+        mb_per_s = max_mb_per_s if mb_per_s is None else min(mb_per_s, max_mb_per_s)
+    eta_seconds = None
+    if mb_per_s:
+        eta_seconds = bytes_to_copy / 1024**2 / mb_per_s
+    return dict(
+            total_bytes=total_bytes,
+            bytes_to_copy=bytes_to_copy,
+            free_bytes=free_bytes,
+            enough_space=bytes_to_copy * (1 + FREE_SPACE_MARGIN) <= free_bytes,
+            mb_per_s=mb_per_s,
+            eta_seconds=eta_seconds,
+            )
+
+
+def print_preflight(check):
+    """Print the size plan of a transfer."""
+    print(f"Recording size: {check['total_bytes'] / 1024**3:.2f} GB, "
+          f"to copy: {check['bytes_to_copy'] / 1024**3:.2f} GB, "
+          f"free on server: {check['free_bytes'] / 1024**3:.2f} GB")
+    if check['eta_seconds'] is None:
+        print("No throughput measured yet, cannot estimate the duration")
+    else:
+        print(f"Estimated duration: {check['eta_seconds'] / 60:.1f} minutes "
+              f"at {check['mb_per_s']:.1f} MB/s")
+    print("")
+
+
+class ByteProgress:
+    """
+    Thread-safe wrapper around a byte-based tqdm bar
+    """
+    def __init__(self, total_bytes, desc='Copying'):
+        self.lock = threading.Lock()
+        self.pbar = tqdm(
+                total=total_bytes,
+                unit='B',
+                unit_scale=True,
+                unit_divisor=1024,
+                desc=desc,
+                )
+
+    def update(self, n_bytes):
+        with self.lock:
+            self.pbar.update(n_bytes)
+
+    def add_total(self, n_bytes):
+        """Grow the total, for transfers planned while copying."""
+        with self.lock:
+            self.pbar.total += n_bytes
+            self.pbar.refresh()
+
+    def close(self):
+        self.pbar.close()
+
+
+class TransferJournal:
+    """
+    Local record of how far each file of a recording has been copied
+
+    The journal maps each relative file path to the source size and mtime
+    and the number of bytes committed to the partial file on the server.
+    Entries are removed once a file has been renamed to its final name.
+    """
+    def __init__(self, journal_path, server_data_folder):
+        self.journal_path = journal_path
+        self.server_data_folder = server_data_folder
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r') as f:
+                saved = json.load(f)
+            # A journal for another destination says nothing about this one
+            if saved.get('server_data_folder') == server_data_folder:
+                self.entries = saved.get('entries', {})
+
+    @classmethod
+    def for_recording(cls, data_folder, server_data_folder, journal_dir=JOURNAL_DIR):
+        """
+        Open the journal of copying the recording in data_folder to server_data_folder
+
+        Recordings with the same folder name in different places or going
+        to different destinations get journals of their own.
+        """
+        os.makedirs(journal_dir, exist_ok=True)
+        key = hashlib.new(DIGEST_ALGORITHM, repr(
+            (os.path.abspath(data_folder), server_data_folder)).encode()).hexdigest()
+        journal_name = f"{os.path.basename(data_folder)}-{key[:16]}.json"
+        return cls(os.path.join(journal_dir, journal_name), server_data_folder)
+
+    def _write(self):
+        if not self.entries:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            return
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(
+                    dict(server_data_folder=self.server_data_folder,
+                         entries=self.entries),
+                    f, indent=2)
+        os.replace(tmp_path, self.journal_path)
+
+    def get_offset(self, rel_file, src_stat):
+        """Get the committed offset of rel_file if the source is unchanged."""
+        with self.lock:
+            entry = self.entries.get(rel_file)
+        if entry is None:
+            return 0
+        if entry['size'] != src_stat.st_size or entry['mtime'] != src_stat.st_mtime:
+            return 0
+        return entry['offset']
+
+    def commit(self, rel_file, src_stat, offset):
+        """Record that offset bytes of rel_file are safely on the server."""
+        with self.lock:
+            self.entries[rel_file] = dict(
+                    size=src_stat.st_size,
+                    mtime=src_stat.st_mtime,
+                    offset=offset,
+                    )
+            self._write()
+
+    def get_segments(self, rel_file, src_stat):
+        """Get the segments of rel_file committed so far if the source is unchanged."""
+        with self.lock:
+            entry = self.entries.get(rel_file)
+        if entry is None:
+            return set()
+        if entry['size'] != src_stat.st_size or entry['mtime'] != src_stat.st_mtime:
+            return set()
+        return set(entry.get('segments', []))
+
+    def commit_segment(self, rel_file, src_stat, index):
+        """Record that segment index of rel_file is safely on the server."""
+        with self.lock:
+            entry = self.entries.get(rel_file)
+            if entry is None or entry['size'] != src_stat.st_size \
+                    or entry['mtime'] != src_stat.st_mtime:
+                entry = dict(size=src_stat.st_size, mtime=src_stat.st_mtime,
+                             offset=0, segments=[])
+                self.entries[rel_file] = entry
+            entry.setdefault('segments', [])
+            if index not in entry['segments']:
+                entry['segments'].append(index)
+            self._write()
+
+    def complete(self, rel_file):
+        """Forget rel_file once it has its final name."""
+        with self.lock:
+            if self.entries.pop(rel_file, None) is not None:
+                self._write()
+
+
+def copy_file(src_path, dst_path, progress=None, journal=None, rel_file=None,
+              controls=None, backend=None):
+    """
+    Copy a single file, reporting copied bytes to progress
+
+    The file is written to dst_path + PARTIAL_SUFFIX and renamed to dst_path
+    only once complete. If a journal is given, the offset is committed every
+    JOURNAL_CHUNK_SIZE bytes and a previous partial copy is resumed from
+    its last committed offset.
+
+    The file is hashed from the chunks written to the server, so no
+    second read of the source file is needed to get its digest. If
+    controls is given, chunks are throttled and timed by it.
+
+    backend is the copy backend to use (see copy_backends.py), by default
+    the one of controls, or copy_backends.DEFAULT_BACKEND. If controls has
+    drop_cache set, copied pages of both files are dropped from the page
+    cache every CACHE_DROP_INTERVAL bytes.
+
+    Returns:
+        n_bytes: number of bytes copied
+        digest: hex digest of the file contents
+    """
+    if backend is None:
+        backend = controls.backend if controls is not None \
+                else copy_backends.DEFAULT_BACKEND
+    drop_cache = controls is not None and controls.drop_cache
+    partial_path = dst_path + PARTIAL_SUFFIX
+    src_stat = os.stat(src_path)
+    if controls is not None and controls.segment_workers > 1 \
+            and src_stat.st_size >= controls.segment_above:
+        return copy_file_segmented(src_path, dst_path, progress, journal, rel_file,
+                                   controls)
+    digest = hashlib.new(DIGEST_ALGORITHM)
+
+    offset = 0
+    if journal is not None:
+        offset = journal.get_offset(rel_file, src_stat)
+    if offset:
+        # Only look for the partial file if the journal says it was started
+        try:
+            if os.path.getsize(partial_path) < offset:
+                offset = 0
+        except FileNotFoundError:
+            offset = 0
+    if offset:
+        # Hash the already committed part from the local source
+        hash_file(src_path, n_bytes=offset, digest=digest)
+
+    n_bytes = 0
+    with open(src_path, 'rb', buffering=0) as src, \
+            open(partial_path, 'r+b' if offset else 'wb', buffering=0) as dst:
+        if offset:
+            # Drop anything written after the last commit
+            dst.truncate(offset)
+            dst.seek(offset)
+            src.seek(offset)
+            if progress is not None:
+                progress.update(offset)
+        if drop_cache:
+            advise_sequential(src)
+        uncommitted = 0
+        uncached = 0
+        start = time.monotonic()
+        for buf in copy_backends.copy_chunks(src, dst, offset, backend):
+            if controls is not None:
+                controls.record(len(buf), time.monotonic() - start)
+            digest.update(buf)
+            n_bytes += len(buf)
+            uncommitted += len(buf)
+            if progress is not None:
+                progress.update(len(buf))
+            if journal is not None and uncommitted >= JOURNAL_CHUNK_SIZE:
+                os.fsync(dst.fileno())
+                journal.commit(rel_file, src_stat, offset + n_bytes)
+                uncommitted = 0
+            uncached += len(buf)
+            if drop_cache and uncached >= CACHE_DROP_INTERVAL:
+                drop_cached_pages(src, dst)
+                uncached = 0
+            start = time.monotonic()
+        os.fsync(dst.fileno())
+        if drop_cache:
+            drop_cached_pages(src, dst)
+    shutil.copystat(src_path, partial_path)
+    os.replace(partial_path, dst_path)
+    if journal is not None:
+        journal.complete(rel_file)
+    return n_bytes, digest.hexdigest()
+
+
+def plan_segments(size, segment_size=None):
+    """Split a file of size bytes into (start, end) byte ranges of SEGMENT_SIZE by default."""
+    if segment_size is None:
+        segment_size = SEGMENT_SIZE
+    return [(start, min(start + segment_size, size))
+            for start in range(0, size, segment_size)]
+
+
+def preallocate(f, size):
+    """Reserve size bytes for f, only extending it where allocation is not supported."""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError as e:
+            if e.errno not in copy_backends.FALLBACK_ERRNOS:
+                raise
+    os.ftruncate(f.fileno(), size)
+
+
+def copy_segment(src_fd, dst_fd, start, end, progress=None, controls=None):
+    """
+    Copy bytes start to end of src_fd into dst_fd with pread/pwrite
+
+    File positions are not used, so any number of segments of the same
+    pair of files can be copied at once. If the copy fails, the bytes it
+    reported to progress are taken back, so the segment can be retried.
+
+    Returns the hex digest of the segment.
+    """
+    digest = hashlib.new(DIGEST_ALGORITHM)
+    view = copy_backends.get_buffer()
+    offset = start
+    try:
+        while offset < end:
+            begin = time.monotonic()
+            data = copy_backends.pread_into(
+                    src_fd, view[:min(len(view), end - offset)], offset)
+            if not len(data):
+                raise OSError(errno.EIO, f"Source file ended at byte {offset}")
+            written = 0
+            while written < len(data):
+                written += os.pwrite(dst_fd, data[written:], offset + written)
+            if controls is not None:
+                controls.record(len(data), time.monotonic() - begin)
+            digest.update(data)
+            offset += len(data)
+            if progress is not None:
+                progress.update(len(data))
+    except OSError:
+        if progress is not None:
+            progress.update(start - offset)
+        raise
+    return digest.hexdigest()
+
+
+def copy_file_segmented(src_path, dst_path, progress=None, journal=None, rel_file=None,
+                        controls=None):
+    """
+    Copy a single large file as segments copied concurrently
+
+    The partial file is preallocated to its final size and each segment of
+    SEGMENT_SIZE bytes is copied by one of controls.segment_workers threads
+    with pread/pwrite. If a journal is given, finished segments are
+    committed to it, so an interrupted copy only redoes the segments which
+    had not finished. A failed segment fails the copy, segments not yet
+    started are cancelled, and retrying the file (see
+    TransferControls.retry) copies the segments the journal lacks.
+
+    Segments finish out of order, so the digest of the whole file is taken
+    by reading the server partial file back at the end. This pass also
+    checks each segment against the digest of the bytes written for it,
+    and the server file against the size of the source.
+
+    Returns:
+        n_bytes: number of bytes copied
+        digest: hex digest of the file contents
+    """
+    partial_path = dst_path + PARTIAL_SUFFIX
+    src_stat = os.stat(src_path)
+    segments = plan_segments(src_stat.st_size)
+    drop_cache = controls is not None and controls.drop_cache
+
+    done = set()
+    if journal is not None:
+        done = journal.get_segments(rel_file, src_stat)
+    if done:
+        try:
+            if os.path.getsize(partial_path) != src_stat.st_size:
+                done = set()
+        except FileNotFoundError:
+            done = set()
+    if progress is not None:
+        progress.update(sum(end - start for i, (start, end) in enumerate(segments)
+                            if i in done))
+
+    segment_digests = {}
+    with open(src_path, 'rb', buffering=0) as src, \
+            open(partial_path, 'r+b' if done else 'w+b', buffering=0) as dst:
+        preallocate(dst, src_stat.st_size)
+
+        def _copy(index):
+            start, end = segments[index]
+            segment_digest = copy_segment(
+                    src.fileno(), dst.fileno(), start, end, progress, controls)
+            os.fdatasync(dst.fileno())
+            if drop_cache and hasattr(os, 'posix_fadvise'):
+                for fd in [src.fileno(), dst.fileno()]:
+                    os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_DONTNEED)
+            if journal is not None:
+                journal.commit_segment(rel_file, src_stat, index)
+            return segment_digest
+
+        todo = [i for i in range(len(segments)) if i not in done]
+        with ThreadPoolExecutor(max_workers=controls.segment_workers) as executor:
+            futures = {executor.submit(_copy, i): i for i in todo}
+            try:
+                for future in as_completed(futures):
+                    segment_digests[futures[future]] = future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        os.fsync(dst.fileno())
+        dst_size = os.fstat(dst.fileno()).st_size
+
+        # Final check of the server copy against what was written to it
+        if dst_size != src_stat.st_size:
+            raise OSError(errno.EIO, f"Server file has {dst_size} bytes, "
+                          f"expected {src_stat.st_size}")
+        digest = hashlib.new(DIGEST_ALGORITHM)
+        view = copy_backends.get_buffer()
+        for index, (start, end) in enumerate(segments):
+            segment_digest = hashlib.new(DIGEST_ALGORITHM)
+            offset = start
+            while offset < end:
+                data = copy_backends.pread_into(
+                        dst.fileno(), view[:min(len(view), end - offset)], offset)
+                if not len(data):
+                    break
+                digest.update(data)
+                segment_digest.update(data)
+                offset += len(data)
+            if index in segment_digests \
+                    and segment_digest.hexdigest() != segment_digests[index]:
+                if journal is not None:
+                    journal.complete(rel_file)
+                raise OSError(errno.EIO, f"Segment {index} on the server differs "
+                              "from the bytes written")
+        if drop_cache:
+            drop_cached_pages(src, dst)
+    if os.stat(src_path).st_mtime != src_stat.st_mtime:
+        raise OSError(errno.EIO, "Source file changed during the copy")
+    shutil.copystat(src_path, partial_path)
+    os.replace(partial_path, dst_path)
+    if journal is not None:
+        journal.complete(rel_file)
+    n_bytes = sum(segments[i][1] - segments[i][0] for i in segment_digests)
+    return n_bytes, digest.hexdigest()
+
+
+def compress_file(src_path, dst_path, codec, progress=None, controls=None):
+    """
+    Compress src_path into dst_path, which should end in COMPRESSED_SUFFIX
+
+    Like copy_file, the output is written under a temporary name and
+    renamed once complete, but compressed copies are not journaled, so an
+    interrupted compression starts over.
+
+    Returns:
+        n_bytes: number of compressed bytes written
+        digest: hex digest of the compressed file
+    """
+    partial_path = dst_path + PARTIAL_SUFFIX
+    src_stat = os.stat(src_path)
+    digest = hashlib.new(DIGEST_ALGORITHM)
+
+    def _write(dst, buf):
+        if controls is not None:
+            controls.write(dst, buf)
+        else:
+            dst.write(buf)
+        digest.update(buf)
+
+    drop_cache = controls is not None and controls.drop_cache
+    uncached = 0
+
+    def _on_block(n_block):
+        nonlocal uncached
+        if progress is not None:
+            progress.update(n_block)
+        uncached += n_block
+        if drop_cache and uncached >= CACHE_DROP_INTERVAL:
+            drop_cached_pages(src)
+            uncached = 0
+
+    with open(src_path, 'rb') as src, open(partial_path, 'wb') as dst:
+        if drop_cache:
+            advise_sequential(src)
+        n_bytes, _ = amp_compression.compress_stream(
+                src, dst, src_stat.st_size, src_stat.st_mtime, codec=codec,
+                on_block=_on_block, write=_write)
+        dst.flush()
+        os.fsync(dst.fileno())
+        if drop_cache:
+            drop_cached_pages(src, dst)
+    shutil.copystat(src_path, partial_path)
+    os.replace(partial_path, dst_path)
+    return n_bytes, digest.hexdigest()
+
+
+def copy_files(data_folder, server_data_folder, rel_file_list, n_workers=1,
+               journal=None, max_mb_per_s=None, adaptive=False, compress=None,
+               backend=None, drop_cache=False, segment_workers=1,
+               segment_above=SEGMENT_THRESHOLD, retries=FILE_RETRIES, max_failures=None):
+    """
+    Copy rel_file_list from data_folder to server_data_folder
+
+    Inputs:
+        data_folder: local recording folder
+        server_data_folder: destination folder on the server
+        rel_file_list: paths relative to data_folder
+        n_workers: number of files copied concurrently,
+            the upper limit if adaptive is True
+        journal: TransferJournal used to resume interrupted copies
+        max_mb_per_s: cap on total write throughput
+        adaptive: adapt the number of concurrent copies to the
+            measured throughput and latency
+        compress: codec used to compress amplifier files ('zlib' or 'lzma'),
+            or None to copy them as they are
+        backend: copy backend (see copy_backends.py), by default the one
+            calibrated for the server mount
+        drop_cache: drop copied pages from the page cache as the copy goes
+        segment_workers: number of segments of one large file copied
+            concurrently, 1 to copy every file in one piece
+        segment_above: size in bytes from which files are split into segments
+        retries: attempts after the first for files hit by transient errors
+            (RETRY_ERRNOS)
+        max_failures: number of files allowed to fail before the files not
+            yet started are given up, None for no limit
+
+    Returns:
+        report: dict with keys
+            copied: list of files copied
+            failed: dict mapping file to error message
+            bytes_copied: total bytes written to the server
+            digests: dict mapping the server name of each copied file
+                to its digest
+            retried: dict mapping files which hit transient errors
+                to their number of retries
+            settings: see TransferControls.summary
+    """
+    job = dict(
+            data_folder=data_folder,
+            server_data_folder=server_data_folder,
+            rel_file_list=rel_file_list,
+            journal=journal,
+            )
+    return copy_batch([job], n_workers=n_workers, max_mb_per_s=max_mb_per_s,
+                      adaptive=adaptive, compress=compress, backend=backend,
+                      drop_cache=drop_cache, segment_workers=segment_workers,
+                      segment_above=segment_above, retries=retries,
+                      max_failures=max_failures)[0]
+
+
+def schedule_fair(job_schedules):
+    """
+    Interleave the schedules of several recordings round robin
+
+    Files are started in submission order, so interleaving gives every
+    recording an equal share of the workers instead of copying the
+    recordings one after the other.
+
+    Returns a list of (job index, rel_file) pairs.
+    """
+    merged = []
+    for group in zip_longest(*job_schedules):
+        merged.extend((i, f) for i, f in enumerate(group) if f is not None)
+    return merged
+
+
+def copy_batch(jobs, n_workers=1, max_mb_per_s=None, adaptive=False, compress=None,
+               backend=None, drop_cache=False, segment_workers=1,
+               segment_above=SEGMENT_THRESHOLD, retries=FILE_RETRIES, max_failures=None):
+    """
+    Copy files of several recordings under one shared concurrency budget
+
+    Inputs:
+        jobs: list of dicts with keys
+            data_folder, server_data_folder, rel_file_list as in copy_files
+            journal: optional TransferJournal of the recording
+        others as in copy_files
+
+    Returns:
+        reports: list with one report per job, as returned by copy_files
+    """
+    job_sizes = [get_file_sizes(j['data_folder'], j['rel_file_list']) for j in jobs]
+    job_schedules = [schedule_largest_first(j['rel_file_list'], sizes)
+                     for j, sizes in zip(jobs, job_sizes)]
+    schedule = schedule_fair(job_schedules)
+    progress = ByteProgress(sum(sum(sizes.values()) for sizes in job_sizes))
+
+    if backend is None and jobs:
+        backend = copy_backends.get_backend(jobs[0]['server_data_folder'])
+    controls = TransferControls(n_workers, max_mb_per_s, adaptive, backend, drop_cache,
+                                segment_workers, segment_above, retries, max_failures)
+    cache_monitor = PageCacheMonitor()
+    reports = [dict(copied=[], failed={}, bytes_copied=0, digests={}, retried={})
+               for _ in jobs]
+
+    def _copy(i, rel_file):
+        job = jobs[i]
+        src_path = os.path.join(job['data_folder'], rel_file)
+        server_name = get_server_name(rel_file, compress)
+        dst_path = os.path.join(job['server_data_folder'], server_name)
+
+        def _attempt(attempt_progress):
+            with controls.slot():
+                if server_name != rel_file:
+                    return compress_file(src_path, dst_path, compress,
+                                         attempt_progress, controls)
+                return copy_file(src_path, dst_path, attempt_progress,
+                                 job.get('journal'), rel_file, controls)
+
+        def _on_retry(n_retries):
+            reports[i]['retried'][rel_file] = n_retries
+
+        return controls.retry(_attempt, progress, _on_retry)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        futures = {executor.submit(_copy, i, f): (i, f) for i, f in schedule}
+        for future in as_completed(futures):
+            i, rel_file = futures[future]
+            report = reports[i]
+            try:
+                n_bytes, digest = future.result()
+                report['bytes_copied'] += n_bytes
+                report['digests'][get_server_name(rel_file, compress)] = digest
+                report['copied'].append(rel_file)
+            except (OSError, ValueError) as e:
+                report['failed'][rel_file] = str(e)
+    progress.close()
+    settings = controls.summary(sum(r['bytes_copied'] for r in reports))
+    settings['page_cache'] = cache_monitor.stop()
+    for report in reports:
+        report['settings'] = settings
+
+    return reports
+
+
+def stream_copy(data_folder, server_data_folder, plan, n_workers=1,
+                journal=None, checksum=False, max_mb_per_s=None, adaptive=False,
+                backend=None, drop_cache=False, segment_workers=1,
+                segment_above=SEGMENT_THRESHOLD, retries=FILE_RETRIES, max_failures=None):
+    """
+    Copy a recording while it is still being planned
+
+    Directories from plan are created on the server as they are yielded,
+    as is the folder of a file whose directory was left out of the plan
+    (e.g. by a rule excluding the directory but not the file), and each
+    file is compared with its server copy and copied if needed
+    by the worker pool, so the first bytes move before the walk of the
+    recording has finished.
+
+    Inputs:
+        plan: iterable of PlanEntry, e.g. scan_recording(data_folder)
+        others as in copy_files
+
+    Returns:
+        report: dict with the keys of copy_files plus
+            files: all files in the plan
+            skipped: files identical on the server
+            bytes_skipped: total size of skipped files
+    """
+    progress = ByteProgress(0)
+    if backend is None:
+        backend = copy_backends.get_backend(server_data_folder)
+    controls = TransferControls(n_workers, max_mb_per_s, adaptive, backend, drop_cache,
+                                segment_workers, segment_above, retries, max_failures)
+    cache_monitor = PageCacheMonitor()
+    report = dict(copied=[], failed={}, bytes_copied=0, digests={}, retried={},
+                  files=[], skipped=[], bytes_skipped=0)
+    max_pending = max(1, n_workers) * STREAM_QUEUE_PER_WORKER
+    snapshot = snapshot_destination(server_data_folder)
+
+    def _sync(entry):
+        dst_path = os.path.join(server_data_folder, entry.rel_path)
+        dst_stat = snapshot.files.get(entry.rel_path)
+        if dst_stat is not None and compare_files(
+                entry.path, dst_path, checksum=checksum, dst_stat=dst_stat) == 'skip':
+            progress.update(entry.size)
+            return None
+
+        def _attempt(attempt_progress):
+            with controls.slot():
+                return copy_file(entry.path, dst_path, attempt_progress, journal,
+                                 entry.rel_path, controls)
+
+        def _on_retry(n_retries):
+            report['retried'][entry.rel_path] = n_retries
+
+        return controls.retry(_attempt, progress, _on_retry)
+
+    def _collect(futures, done):
+        for future in done:
+            entry = futures.pop(future)
+            try:
+                result = future.result()
+            except (OSError, ValueError) as e:
+                report['failed'][entry.rel_path] = str(e)
+                continue
+            if result is None:
+                report['skipped'].append(entry.rel_path)
+                report['bytes_skipped'] += entry.size
+            else:
+                report['bytes_copied'] += result[0]
+                report['digests'][entry.rel_path] = result[1]
+                report['copied'].append(entry.rel_path)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        futures = {}
+        created = set(snapshot.dirs)
+        for entry in plan:
+            rel_dir = entry.rel_path if entry.is_dir else os.path.dirname(entry.rel_path)
+            if rel_dir and rel_dir not in created:
+                os.makedirs(os.path.join(server_data_folder, rel_dir), exist_ok=True)
+                created.add(rel_dir)
+            if entry.is_dir:
+                continue
+            report['files'].append(entry.rel_path)
+            progress.add_total(entry.size)
+            futures[executor.submit(_sync, entry)] = entry
+            if len(futures) >= max_pending:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                _collect(futures, done)
+        _collect(futures, list(futures))
+    progress.close()
+    report['settings'] = controls.summary(report['bytes_copied'])
+    report['settings']['page_cache'] = cache_monitor.stop()
+
+    return report
+
+
+class LiveRecording:
+    """
+    Follow a recording while it is still being acquired
+
+    Each poll copies the bytes appended to growing .dat files since the
+    previous poll into their partial files on the server, hashing them on
+    the way. Other files (.info, settings, ...) may be rewritten in place
+    by the acquisition software, so they are only copied by finalize.
+
+    Once the recording has settled, finalize copies the last appended
+    bytes and checks each tail-copied file against the size and a fresh
+    digest of its source. A file rewritten rather than appended to during
+    acquisition fails the check and is copied again in full.
+    """
+    def __init__(self, data_folder, server_data_folder, controls=None, progress=None,
+                 rules=None):
+        self.data_folder = data_folder
+        self.rules = rules or []
+        self.server_data_folder = server_data_folder
+        self.controls = controls if controls is not None else TransferControls()
+        self.progress = progress
+        # rel_path -> dict(offset, digest) of tail-copied files
+        self.tails = {}
+        # rel_path -> (size, mtime) of every file at the last poll
+        self.seen = {}
+        # rel_path -> size of files excluded by rules at the last poll
+        self.excluded = {}
+        self.last_change = time.monotonic()
+        self.failed = {}
+        self.bytes_copied = 0
+        # Directories created on the server, so each is only created once
+        self.dirs = snapshot_destination(server_data_folder).dirs
+
+    def _tail(self, entry):
+        """Copy the bytes appended to entry since the last poll."""
+        tail = self.tails.get(entry.rel_path)
+        if tail is None or entry.size < tail['offset']:
+            # New file, or shrunk, so it was rewritten: start over
+            tail = dict(offset=0, digest=hashlib.new(DIGEST_ALGORITHM))
+        dst_path = os.path.join(self.server_data_folder, entry.rel_path) + PARTIAL_SUFFIX
+        offset = tail['offset']
+        digest = tail['digest'].copy()
+        with open(entry.path, 'rb', buffering=0) as src, \
+                open(dst_path, 'r+b' if offset else 'wb', buffering=0) as dst:
+            # Drop anything written by a failed earlier poll
+            dst.truncate(offset)
+            dst.seek(offset)
+            src.seek(offset)
+            start = time.monotonic()
+            for buf in copy_backends.copy_chunks(src, dst, offset, self.controls.backend):
+                self.controls.record(len(buf), time.monotonic() - start)
+                digest.update(buf)
+                offset += len(buf)
+                start = time.monotonic()
+            os.fsync(dst.fileno())
+        n_bytes = offset - tail['offset']
+        self.tails[entry.rel_path] = dict(offset=offset, digest=digest)
+        return n_bytes
+
+    def poll(self, now=None):
+        """
+        Copy what was appended since the last poll
+
+        Returns the number of bytes copied.
+        """
+        if now is None:
+            now = time.monotonic()
+        seen = {}
+        excluded = {}
+        growing = []
+        for entry in scan_recording(self.data_folder):
+            if not transfer_rules.is_included(entry.rel_path, self.rules):
+                if not entry.is_dir:
+                    excluded[entry.rel_path] = entry.size
+                continue
+            # The folder of an included file may be excluded itself
+            rel_dir = entry.rel_path if entry.is_dir else os.path.dirname(entry.rel_path)
+            if rel_dir and rel_dir not in self.dirs:
+                os.makedirs(os.path.join(self.server_data_folder, rel_dir), exist_ok=True)
+                self.dirs.add(rel_dir)
+            if entry.is_dir:
+                continue
+            seen[entry.rel_path] = (entry.size, os.stat(entry.path).st_mtime)
+            if entry.rel_path.endswith(LIVE_TAIL_SUFFIXES):
+                tail = self.tails.get(entry.rel_path)
+                if tail is None or tail['offset'] != entry.size:
+                    growing.append(entry)
+        if seen != self.seen:
+            self.last_change = now
+            if self.progress is not None:
+                old_total = sum(size for size, _ in self.seen.values())
+                self.progress.add_total(sum(size for size, _ in seen.values()) - old_total)
+        self.seen = seen
+        self.excluded = excluded
+
+        n_bytes = 0
+        with ThreadPoolExecutor(max_workers=self.controls.n_workers) as executor:
+            futures = {executor.submit(self._tail, entry): entry for entry in growing}
+            for future in as_completed(futures):
+                entry = futures[future]
+                try:
+                    n_bytes += future.result()
+                    self.failed.pop(entry.rel_path, None)
+                except OSError as e:
+                    # Tried again at the next poll
+                    self.failed[entry.rel_path] = str(e)
+        self.bytes_copied += n_bytes
+        if self.progress is not None:
+            self.progress.update(n_bytes)
+        return n_bytes
+
+    def is_settled(self, settle_seconds, now=None):
+        """Whether no file has changed for settle_seconds."""
+        if now is None:
+            now = time.monotonic()
+        return bool(self.seen) and now - self.last_change >= settle_seconds
+
+    def _finalize_tail(self, rel_file):
+        """Check a tail-copied file against its source and give it its final name."""
+        src_path = os.path.join(self.data_folder, rel_file)
+        dst_path = os.path.join(self.server_data_folder, rel_file)
+        tail = self.tails[rel_file]
+        src_digest = hash_file(src_path)
+        dst_size = os.path.getsize(dst_path + PARTIAL_SUFFIX)
+        if dst_size != os.path.getsize(src_path) \
+                or src_digest != tail['digest'].hexdigest():
+            # Rewritten during acquisition, so the appended bytes are stale
+            # and taken back from progress before the file is copied again
+            if self.progress is not None:
+                self.progress.update(-tail['offset'])
+            n_bytes, digest = self.controls.retry(
+                    lambda attempt_progress: copy_file(
+                        src_path, dst_path, attempt_progress, controls=self.controls),
+                    self.progress)
+            self.bytes_copied += n_bytes
+            return digest
+        shutil.copystat(src_path, dst_path + PARTIAL_SUFFIX)
+        os.replace(dst_path + PARTIAL_SUFFIX, dst_path)
+        return src_digest
+
+    def finalize(self):
+        """
+        Finish the copy of a recording which has stopped growing
+
+        Returns:
+            report: dict with the keys of copy_files plus files, all
+                files of the recording
+        """
+        self.poll()
+        report = dict(copied=[], failed={}, bytes_copied=0, digests={}, retried={},
+                      files=sorted(self.seen), excluded=sorted(self.excluded),
+                      bytes_excluded=sum(self.excluded.values()))
+        for rel_file in report['files']:
+            try:
+                if rel_file in self.tails:
+                    digest = self._finalize_tail(rel_file)
+                else:
+                    src_path = os.path.join(self.data_folder, rel_file)
+                    dst_path = os.path.join(self.server_data_folder, rel_file)
+                    n_bytes, digest = self.controls.retry(
+                            lambda attempt_progress: copy_file(
+                                src_path, dst_path, attempt_progress,
+                                controls=self.controls),
+                            self.progress)
+                    self.bytes_copied += n_bytes
+            except (OSError, ValueError) as e:
+                report['failed'][rel_file] = str(e)
+                continue
+            report['digests'][rel_file] = digest
+            report['copied'].append(rel_file)
+        report['bytes_copied'] = self.bytes_copied
+        report['settings'] = self.controls.summary(self.bytes_copied)
+        return report
+
+
+def follow_recording(data_folder, server_data_folder, poll_seconds=30, settle_seconds=300,
+                     n_workers=1, max_mb_per_s=None, backend=None, drop_cache=False,
+                     retries=FILE_RETRIES, rules=None):
+    """
+    Copy a recording while it is being acquired and finish once it settles
+
+    The recording is polled every poll_seconds with a LiveRecording and
+    finalized once no file has changed for settle_seconds. Files excluded
+    by rules (see transfer_rules.py) are left out.
+
+    Returns:
+        report: dict as returned by LiveRecording.finalize
+    """
+    if backend is None:
+        backend = copy_backends.get_backend(server_data_folder)
+    controls = TransferControls(n_workers, max_mb_per_s, backend=backend,
+                                drop_cache=drop_cache, retries=retries)
+    cache_monitor = PageCacheMonitor()
+    progress = ByteProgress(0, desc='Following')
+    live = LiveRecording(data_folder, server_data_folder, controls, progress, rules)
+    while True:
+        live.poll()
+        if live.is_settled(settle_seconds):
+            break
+        time.sleep(poll_seconds)
+    report = live.finalize()
+    progress.close()
+    report['settings']['page_cache'] = cache_monitor.stop()
+    return report
+
+
+def read_manifest(server_data_folder):
+    """Read the manifest of a server recording into a dict keyed by path."""
+    manifest_path = os.path.join(server_data_folder, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r', newline='') as f:
+        return {row['path']: row for row in csv.DictReader(f)}
+
+
+def write_manifest(data_folder, server_data_folder, rel_file_list, digests,
+                   server_files=None):
+    """
+    Write the manifest of a recording into its server copy
+
+    Digests of files which were not copied in this run (e.g. skipped
+    because they were already on the server) are taken from the previous
+    manifest if the size and mtime still match, otherwise the local
+    source file is hashed.
+
+    server_files are files written directly on the server with no local
+    counterpart (e.g. the small-file bundle); they are listed with the
+    size and mtime of the server copy.
+
+    Returns the fingerprint of the manifest, i.e. the digest of its contents.
+    """
+    previous = read_manifest(server_data_folder)
+    file_dirs = [(f, data_folder) for f in rel_file_list]
+    file_dirs += [(f, server_data_folder) for f in (server_files or [])]
+    rows = []
+    for rel_file, file_dir in sorted(file_dirs):
+        if rel_file == MANIFEST_NAME:
+            continue
+        src_path = os.path.join(file_dir, rel_file)
+        src_stat = os.stat(src_path)
+        row = dict(
+                path=rel_file,
+                size=str(src_stat.st_size),
+                mtime=repr(src_stat.st_mtime),
+                )
+        if rel_file in digests:
+            row['digest'] = digests[rel_file]
+        elif rel_file in previous and \
+                previous[rel_file]['size'] == row['size'] and \
+                previous[rel_file]['mtime'] == row['mtime']:
+            row['digest'] = previous[rel_file]['digest']
+        else:
+            row['digest'] = hash_file(src_path)
+        rows.append(row)
+
+    manifest_path = os.path.join(server_data_folder, MANIFEST_NAME)
+    tmp_path = manifest_path + PARTIAL_SUFFIX
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['path', 'size', 'mtime', 'digest'])
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, manifest_path)
+    return hash_file(manifest_path)
+
+
+def print_transfer_report(report):
+    """Print a summary of a transfer report."""
+    print(f"Copied {len(report['copied'])} files "
+          f"({report['bytes_copied'] / 1024**2:.1f} MB)")
+    if 'skipped' in report:
+        print(f"Skipped {len(report['skipped'])} files identical on the server "
+              f"({report['bytes_skipped'] / 1024**2:.1f} MB)")
+    if report.get('excluded'):
+        print(f"Excluded {len(report['excluded'])} files by transfer rules "
+              f"({report['bytes_excluded'] / 1024**2:.1f} MB not sent)")
+    retried = report.get('retried', {})
+    if retried:
+        n_recovered = len([f for f in retried if f not in report['failed']])
+        print(f"Retried {len(retried)} files after transient errors, "
+              f"{n_recovered} of them copied")
+    if report['failed']:
+        print(f"Failed to copy {len(report['failed'])} files:")
+        for rel_file, error in sorted(report['failed'].items()):
+            retry_str = f" (after {retried[rel_file]} retries)" if rel_file in retried else ''
+            print(f"    {rel_file}: {error}{retry_str}")
+    if 'settings' in report:
+        settings = report['settings']
+        cap_str = f"{settings['max_mb_per_s']} MB/s" \
+                if settings['max_mb_per_s'] is not None else 'none'
+        workers_str = f"{settings['max_workers']}"
+        if settings['adaptive']:
+            workers_str = f"adaptive, ended at {settings['final_workers']} " \
+                    f"of max {settings['max_workers']}"
+        segments_str = ''
+        if settings.get('segment_workers', 1) > 1:
+            segments_str = f", segments per large file={settings['segment_workers']}"
+        print(f"Transfer settings: workers={workers_str}, bandwidth cap={cap_str}, "
+              f"copy backend={settings['backend']}{segments_str}")
+        print(f"Mean throughput: {settings['mean_mb_per_s']:.1f} MB/s "
+              f"over {settings['elapsed']:.1f} s")
+        if settings.get('budget_spent'):
+            print(f"More than {settings['max_failures']} files failed, "
+                  "files not yet started were given up")
+        page_cache = settings.get('page_cache')
+        if page_cache is not None:
+            drop_str = 'dropped as copied' if settings['drop_cache'] else 'kept'
+            print(f"Page cache ({drop_str}): grew by up to "
+                  f"{page_cache['peak_increase_mb']:.0f} MB, "
+                  f"{page_cache['final_increase_mb']:.0f} MB at the end, "
+                  f"dirty pages peaked at {page_cache['peak_dirty_mb']:.0f} MB")
+    print("")
@@ -0,0 +1,182 @@
+"""
+Include/exclude rules deciding which files of a recording are transferred
+
+Users often preprocess on the rig before uploading, leaving large derived
+files (HDF5 outputs, plots, temp files) in the data folder which can be
+regenerated from the raw data. Rules keep them off the server.
+
+Rules are read in this order, one rule per line:
+1. local_only_files/transfer_rules.txt, the rules of the rig
+2. local_only_files/transfer_rules_<user>.txt, for the user a recording
+   is transferred for
+Without either file every file is transferred. The lab-wide defaults,
+which leave out blech_clust outputs (HDF5 files, plots, spike and
+clustering folders) and temp files, are shipped as
+local_only_files/transfer_rules.txt.template; a rig opts in by copying
+it to transfer_rules.txt. For example:
+    exclude *.h5
+    exclude plots
+    include important_plots/*.png
+
+Patterns are matched with fnmatch against paths relative to the data
+folder. A pattern without a '/' matches the name of a file or of any
+directory above it, so 'plots' excludes everything in plots folders. A
+pattern with a '/' matches the path from the top of the data folder. The
+last rule matching a path decides, so user rules override the rig ones,
+and files no rule matches are transferred.
+
+usage: python -m src.transfer_rules <data_folder> [--user USER]
+"""
+
+import os
+import argparse
+from fnmatch import fnmatchcase
+from src.utils.utils import base_dir_path
+
+
+RULES_NAME = 'transfer_rules.txt'
+RULE_ACTIONS = ['include', 'exclude']
+# Lab-wide defaults, copied to RULES_NAME to use them
+TEMPLATE_NAME = RULES_NAME + '.template'
+
+##############################
+##############################
+
+def get_rules_paths(user=None, dir_path=base_dir_path):
+    """Paths of the global rules file and of the user's rules file."""
+    rules_dir = os.path.join(dir_path, 'local_only_files')
+    paths = [os.path.join(rules_dir, RULES_NAME)]
+    if user is not None:
+        name, ext = os.path.splitext(RULES_NAME)
+        paths.append(os.path.join(rules_dir, f'{name}_{user}{ext}'))
+    return paths
+
+
+def parse_rules(lines):
+    """
+    Parse rule lines into a list of (action, pattern)
+
+    Blank lines and lines starting with # are skipped.
+    """
+    rules = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        action, _, pattern = line.partition(' ')
+        pattern = pattern.strip().rstrip('/')
+        if action not in RULE_ACTIONS or not pattern:
+            raise ValueError(f"Invalid transfer rule: {line}")
+        rules.append((action, pattern))
+    return rules
+
+
+def load_rules(user=None, dir_path=base_dir_path):
+    """Load the rig rules followed by the rules of user, if any."""
+    rules = []
+    for rules_path in get_rules_paths(user, dir_path):
+        if os.path.exists(rules_path):
+            with open(rules_path, 'r') as f:
+                rules.extend(parse_rules(f))
+    return rules
+
+
+def print_rules(rules, user=None):
+    """Print the rules a transfer applies."""
+    user_str = f" for {user}" if user is not None else ""
+    if not rules:
+        print(f"No transfer rules{user_str}, transferring all files")
+    else:
+        print(f"Transfer rules{user_str}:")
+        for action, pattern in rules:
+            print(f"    {action} {pattern}")
+    print("")
+
+
+def matches(pattern, rel_path):
+    """Check whether pattern matches rel_path or one of the folders above it."""
+    parts = rel_path.split(os.sep)
+    if '/' in pattern:
+        candidates = ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+    else:
+        candidates = parts
+    return any(fnmatchcase(c, pattern) for c in candidates)
+
+
+def is_included(rel_path, rules):
+    """Decide whether rel_path is transferred: the last matching rule wins."""
+    included = True
+    for action, pattern in rules:
+        if matches(pattern, rel_path):
+            included = action == 'include'
+    return included
+
+
+def included_dirs(rel_dir_list, included_files, rules):
+    """
+    Directories to create on the server for a recording
+
+    A directory excluded by a rule is still needed if a later rule
+    includes a file in it again, so these are the directories the rules
+    include (which may be empty) and the folders of the included files.
+    """
+    dirs = set(d for d in rel_dir_list if is_included(d, rules))
+    for rel_file in included_files:
+        parent = os.path.dirname(rel_file)
+        if parent:
+            dirs.add(parent)
+    return sorted(dirs)
+
+
+def filter_files(rel_file_list, file_sizes, rules):
+    """
+    Split files into those transferred and those excluded by rules
+
+    Returns:
+        included: files to transfer
+        excluded: files left out
+        bytes_excluded: total size of excluded files
+    """
+    included = []
+    excluded = []
+    for rel_file in rel_file_list:
+        if is_included(rel_file, rules):
+            included.append(rel_file)
+        else:
+            excluded.append(rel_file)
+    return included, excluded, sum(file_sizes[f] for f in excluded)
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+            description='Show which files of a recording the transfer rules leave out')
+    parser.add_argument('data_folder', type=str, help='Path to local data folder.')
+    parser.add_argument('--user', type=str, default=None,
+                        help='Also apply the rules of this user.')
+    return parser.parse_args()
+
+
+def main():
+    """Main function to run the script"""
+    from src.transfer_engine import scan_recording
+    args = parse_arguments()
+    rules = load_rules(args.user)
+    for rules_path in get_rules_paths(args.user):
+        found_str = 'found' if os.path.exists(rules_path) else 'not found'
+        print(f"Rules file {found_str}: {rules_path}")
+    if not os.path.exists(get_rules_paths()[0]):
+        print(f"Copy local_only_files/{TEMPLATE_NAME} to {RULES_NAME} "
+              "to use the lab-wide defaults")
+    print_rules(rules, args.user)
+    file_sizes = {entry.rel_path: entry.size
+                  for entry in scan_recording(args.data_folder) if not entry.is_dir}
+    _, excluded, bytes_excluded = filter_files(sorted(file_sizes), file_sizes, rules)
+    for rel_file in excluded:
+        print(f"{file_sizes[rel_file]:>12}  {rel_file}")
+    print(f"Excluded {len(excluded)} of {len(file_sizes)} files "
+          f"({bytes_excluded / 1024**2:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import pytest
+import os
+import tempfile
+import shutil
+
+@pytest.fixture
+def temp_dir():
+    """Create a temporary directory for testing"""
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+@pytest.fixture
+def mock_recording(temp_dir):
+    """Create a mock recording with files of different sizes"""
+    data_folder = os.path.join(temp_dir, 'test_data')
+    os.makedirs(os.path.join(data_folder, 'session1'), exist_ok=True)
+    file_sizes = {
+        'test.info': 10,
+        'amp-A-000.dat': 3000,
+        'amp-A-001.dat': 5000,
+        os.path.join('session1', 'test_file.txt'): 100,
+    }
+    for rel_file, size in file_sizes.items():
+        with open(os.path.join(data_folder, rel_file), 'wb') as f:
+            f.write(os.urandom(size))
+
+    server_data_folder = os.path.join(temp_dir, 'server', 'test_data')
+    os.makedirs(os.path.join(server_data_folder, 'session1'), exist_ok=True)
+    return data_folder, server_data_folder, file_sizes
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
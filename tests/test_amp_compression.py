@@ -0,0 +1,137 @@
+import pytest
+import os
+import hashlib
+import numpy as np
+from unittest.mock import patch
+from io import StringIO
+
+from src.amp_compression import (
+    is_compressible,
+    delta_shuffle,
+    undo_delta_shuffle,
+    compress_block,
+    decompress_block,
+    decompress_file,
+    read_header,
+    benchmark,
+    COMPRESSED_SUFFIX,
+)
+from src.transfer_engine import (
+    compress_file,
+    compressed_is_current,
+    copy_files,
+    plan_delta_sync,
+)
+from tests.conftest import read_bytes
+
+def make_amp_bytes(n_samples, seed=0):
+    """Make int16 data resembling an amplifier channel"""
+    rng = np.random.default_rng(seed)
+    samples = np.cumsum(rng.normal(0, 20, n_samples)).astype('<i2')
+    return samples.tobytes()
+
+@pytest.fixture
+def amp_recording(temp_dir):
+    """Create a mock recording with amplifier and other files"""
+    data_folder = os.path.join(temp_dir, 'test_data')
+    os.makedirs(data_folder, exist_ok=True)
+    with open(os.path.join(data_folder, 'amp-A-000.dat'), 'wb') as f:
+        f.write(make_amp_bytes(300000))
+    with open(os.path.join(data_folder, 'time.dat'), 'wb') as f:
+        f.write(os.urandom(1000))
+    server_data_folder = os.path.join(temp_dir, 'server', 'test_data')
+    os.makedirs(server_data_folder, exist_ok=True)
+    return data_folder, server_data_folder
+
+def test_is_compressible():
+    """Test which files are compressed"""
+    assert is_compressible('amp-A-000.dat')
+    assert is_compressible(os.path.join('session1', 'amp-B-031.dat'))
+    assert not is_compressible('time.dat')
+    assert not is_compressible('info.rhd')
+
+@pytest.mark.parametrize('n_bytes', [0, 1, 2, 1001, 20000])
+def test_delta_shuffle_roundtrip(n_bytes):
+    """Test that the prefilter is exactly reversible, including wraparound"""
+    buf = os.urandom(n_bytes)
+    assert undo_delta_shuffle(delta_shuffle(buf)) == buf
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+def test_compress_block(codec):
+    """Test that the prefilter improves compression of amplifier data"""
+    buf = make_amp_bytes(100000)
+    filtered = compress_block(buf, codec, 1, 'delta_shuffle')
+    unfiltered = compress_block(buf, codec, 1, 'none')
+    assert decompress_block(filtered, codec, 'delta_shuffle') == buf
+    assert decompress_block(unfiltered, codec, 'none') == buf
+    assert len(filtered) < len(unfiltered) < len(buf)
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+def test_compress_file_roundtrip(amp_recording, codec):
+    """Test compressing to the server and restoring the original"""
+    data_folder, server_data_folder = amp_recording
+    src_path = os.path.join(data_folder, 'amp-A-000.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-000.dat' + COMPRESSED_SUFFIX)
+
+    # Use small blocks so the file spans several
+    with patch('src.amp_compression.BLOCK_SIZE', 100000):
+        n_bytes, digest = compress_file(src_path, dst_path, codec)
+
+    assert n_bytes == os.path.getsize(dst_path)
+    assert n_bytes < os.path.getsize(src_path)
+    assert digest == hashlib.blake2b(read_bytes(dst_path)).hexdigest()
+    with open(dst_path, 'rb') as f:
+        header = read_header(f)
+    assert header['codec'] == codec
+    assert header['size'] == os.path.getsize(src_path)
+    assert compressed_is_current(src_path, dst_path)
+
+    restored = decompress_file(dst_path)
+    assert restored == os.path.join(server_data_folder, 'amp-A-000.dat')
+    assert read_bytes(restored) == read_bytes(src_path)
+    assert os.path.getmtime(restored) == os.path.getmtime(src_path)
+
+def test_decompress_detects_corruption(amp_recording):
+    """Test that a corrupted compressed file is not silently restored"""
+    data_folder, server_data_folder = amp_recording
+    src_path = os.path.join(data_folder, 'amp-A-000.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-000.dat' + COMPRESSED_SUFFIX)
+    compress_file(src_path, dst_path, 'zlib')
+    # Flip the last byte of the digest trailer
+    with open(dst_path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last_byte = f.read(1)[0]
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last_byte ^ 0xFF]))
+    with pytest.raises(ValueError):
+        decompress_file(dst_path)
+
+def test_copy_files_compressed(amp_recording):
+    """Test a compressed transfer and its delta sync"""
+    data_folder, server_data_folder = amp_recording
+    rel_file_list = ['amp-A-000.dat', 'time.dat']
+
+    plan = plan_delta_sync(data_folder, server_data_folder, rel_file_list, compress='zlib')
+    assert sorted(plan['copy']) == rel_file_list
+
+    with patch('sys.stderr', new=StringIO()):
+        report = copy_files(data_folder, server_data_folder, rel_file_list, compress='zlib')
+
+    assert sorted(os.listdir(server_data_folder)) == \
+        ['amp-A-000.dat' + COMPRESSED_SUFFIX, 'time.dat']
+    assert sorted(report['digests']) == ['amp-A-000.dat' + COMPRESSED_SUFFIX, 'time.dat']
+    assert report['bytes_copied'] < sum(
+            os.path.getsize(os.path.join(data_folder, f)) for f in rel_file_list)
+
+    plan = plan_delta_sync(data_folder, server_data_folder, rel_file_list, compress='zlib')
+    assert sorted(plan['skip']) == rel_file_list
+
+def test_benchmark(amp_recording):
+    """Test that the benchmark reports ratio and speed"""
+    data_folder, _ = amp_recording
+    results = benchmark(os.path.join(data_folder, 'amp-A-000.dat'),
+                        codecs=[('zlib', 1)])
+    assert len(results) == 2
+    by_filter = {r['filter']: r for r in results}
+    assert by_filter['delta_shuffle']['ratio'] > by_filter['none']['ratio'] > 1
+    assert all(r['compress_mb_per_s'] > 0 for r in results)
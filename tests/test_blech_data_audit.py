@@ -0,0 +1,145 @@
+import pytest
+import os
+import pandas as pd
+import tempfile
+import shutil
+import hashlib
+from unittest.mock import patch
+from io import StringIO
+
+from src import blech_data_audit
+from src.blech_data_audit import (
+    parse_arguments,
+    list_recording_files,
+    load_baseline,
+    load_progress,
+    run_audit,
+    PROGRESS_NAME,
+)
+from src.transfer_engine import MANIFEST_NAME, RateLimiter
+
+@pytest.fixture
+def temp_dir():
+    """Create a temporary directory for testing"""
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+@pytest.fixture
+def mock_server(temp_dir):
+    """Create a server with two recordings listed in the dataset frame"""
+    server_home_dir = os.path.join(temp_dir, 'data_management')
+    os.makedirs(server_home_dir)
+
+    recording_paths = []
+    for name in ['rec1', 'rec2']:
+        recording_path = os.path.join(temp_dir, 'user1_dir', name)
+        os.makedirs(os.path.join(recording_path, 'session1'))
+        for rel_file in ['info.rhd', os.path.join('session1', 'amp-A-000.dat')]:
+            with open(os.path.join(recording_path, rel_file), 'wb') as f:
+                f.write(os.urandom(1000))
+        recording_paths.append(recording_path)
+
+    pd.DataFrame(dict(
+        user=['user1', 'user1'],
+        recording=['rec1', 'rec2'],
+        recording_path=recording_paths,
+        )).to_csv(os.path.join(server_home_dir, 'dataset_frame.csv'), index=False)
+    return server_home_dir, recording_paths
+
+def run_quiet(*args, **kwargs):
+    with patch('sys.stdout', new=StringIO()), \
+         patch('sys.stderr', new=StringIO()):
+        return run_audit(*args, **kwargs)
+
+def test_parse_arguments():
+    """Test argument parsing"""
+    with patch('sys.argv', ['blech_data_audit.py']):
+        args = parse_arguments()
+        assert args.n_workers == 4
+        assert args.max_mb_per_s is None
+        assert not args.resume
+
+    with patch('sys.argv', ['blech_data_audit.py', '--resume', '--max_mb_per_s', '50']):
+        args = parse_arguments()
+        assert args.resume
+        assert args.max_mb_per_s == 50
+
+def test_list_recording_files(mock_server):
+    """Test that manifests and partial files are not audited"""
+    _, recording_paths = mock_server
+    with open(os.path.join(recording_paths[0], MANIFEST_NAME), 'w') as f:
+        f.write('path,size,mtime,digest\n')
+    with open(os.path.join(recording_paths[0], 'x.dat.blech_partial'), 'w') as f:
+        f.write('partial')
+
+    assert list_recording_files(recording_paths[0]) == \
+        ['info.rhd', os.path.join('session1', 'amp-A-000.dat')]
+
+def test_run_audit_baseline_then_compare(mock_server):
+    """Test recording a baseline and detecting changes against it"""
+    server_home_dir, recording_paths = mock_server
+
+    report_path, problems = run_quiet(server_home_dir, n_workers=2)
+    assert problems == []
+    assert not os.path.exists(os.path.join(server_home_dir, PROGRESS_NAME))
+    report = pd.read_csv(report_path)
+    assert set(report['status']) == {'new'}
+    assert len(load_baseline(server_home_dir)) == 4
+
+    # Simulate bit rot and a lost file
+    amp_path = os.path.join(recording_paths[0], 'session1', 'amp-A-000.dat')
+    with open(amp_path, 'r+b') as f:
+        f.write(b'rot')
+    os.remove(os.path.join(recording_paths[1], 'info.rhd'))
+
+    _, problems = run_quiet(server_home_dir)
+    statuses = {(p['recording_path'], p['path']): p['status'] for p in problems}
+    assert statuses == {
+        (recording_paths[0], os.path.join('session1', 'amp-A-000.dat')): 'digest_mismatch',
+        (recording_paths[1], 'info.rhd'): 'missing_file',
+        }
+    # Baseline is only recorded once
+    assert len(load_baseline(server_home_dir)) == 4
+
+def test_run_audit_uses_manifest(mock_server):
+    """Test that a partial copy is caught against the transfer manifest"""
+    server_home_dir, recording_paths = mock_server
+    info_path = os.path.join(recording_paths[0], 'info.rhd')
+    with open(info_path, 'rb') as f:
+        info_bytes = f.read()
+    with open(os.path.join(recording_paths[0], MANIFEST_NAME), 'w') as f:
+        f.write('path,size,mtime,digest\n')
+        f.write(f'info.rhd,2000,0.0,{hashlib.blake2b(info_bytes).hexdigest()}\n')
+
+    _, problems = run_quiet(server_home_dir)
+    assert [(p['path'], p['status']) for p in problems] == [('info.rhd', 'size_mismatch')]
+    baseline = load_baseline(server_home_dir)
+    assert baseline[(recording_paths[0], 'info.rhd')]['source'] == 'manifest'
+
+def test_run_audit_resume(mock_server):
+    """Test resuming an interrupted audit"""
+    server_home_dir, recording_paths = mock_server
+    # Simulate an audit interrupted after the first recording
+    with open(os.path.join(server_home_dir, PROGRESS_NAME), 'w') as f:
+        f.write('recording_path,path,status,expected,found\n')
+        f.write(f'{recording_paths[0]},info.rhd,ok,x,x\n')
+
+    with patch('src.blech_data_audit.audit_recording',
+               wraps=blech_data_audit.audit_recording) as mock_audit:
+        report_path, _ = run_quiet(server_home_dir, resume=True)
+    assert mock_audit.call_count == 1
+    assert mock_audit.call_args[0][0] == recording_paths[1]
+    report = pd.read_csv(report_path)
+    assert set(report['recording_path']) == set(recording_paths)
+    assert load_progress(server_home_dir) == []
+
+def test_rate_limiter():
+    """Test that the rate limiter sleeps once the bucket is empty"""
+    limiter = RateLimiter(1000)
+    with patch('src.transfer_engine.time.sleep') as mock_sleep:
+        limiter.consume(500)
+        mock_sleep.assert_not_called()
+        limiter.consume(1500)
+        mock_sleep.assert_called_once()
+        assert mock_sleep.call_args[0][0] == pytest.approx(1.0, abs=0.05)
@@ -1,5 +1,6 @@
 import pytest
 import os
+import errno
 import pandas as pd
 import tempfile
 import shutil
@@ -335,3 +336,192 @@ def test_add_log_entry(mock_dataset_handler, mock_server_path, mock_data_folder)
     assert args['recording'] == os.path.basename(mock_data_folder)
     assert args['recording_path'] == server_data_folder
     assert args['info_file_exists'] == True
+
+def test_get_data_folders(temp_dir):
+    """Test collecting data folders from arguments and a queue file"""
+    from src.blech_data_transfer import get_data_folders
+
+    queue_file = os.path.join(temp_dir, 'queue.txt')
+    with open(queue_file, 'w') as f:
+        f.write("# Recordings from Monday\n/data/rec2/\n\n/data/rec3\n/data/rec1\n")
+
+    with patch('sys.argv', ['blech_data_transfer.py', '/data/rec1',
+                            '--batch', '/data/rec2', '--queue_file', queue_file]):
+        from src.blech_data_transfer import parse_arguments
+        args = parse_arguments()
+    with patch('easygui.diropenbox') as mock_gui:
+        data_folders = get_data_folders(args)
+        mock_gui.assert_not_called()
+    assert data_folders == ['/data/rec1', '/data/rec2', '/data/rec3']
+
+def test_batch_transfer_data(temp_dir, mock_data_folder, mock_server_path):
+    """Test transferring several recordings in one batch"""
+    from src import transfer_engine
+    from src.blech_data_transfer import batch_transfer_data
+
+    _, server_path, _ = mock_server_path
+    data_folder_2 = os.path.join(temp_dir, 'test_data_2')
+    shutil.copytree(mock_data_folder, data_folder_2)
+    copy_dir = os.path.join(server_path, 'user1_dir', 'subfolder1')
+    destinations = [
+        dict(data_folder=mock_data_folder, user='user1', copy_dir=copy_dir),
+        dict(data_folder=data_folder_2, user='user1', copy_dir=copy_dir),
+    ]
+
+    journal_dir = os.path.join(temp_dir, 'transfer_journals')
+    def for_recording(data_folder, server_data_folder):
+        return transfer_engine.TransferJournal(
+                os.path.join(journal_dir, os.path.basename(data_folder) + '.json'),
+                server_data_folder)
+
+    os.makedirs(journal_dir)
+    with patch('sys.stdout', new=StringIO()), \
+         patch('sys.stderr', new=StringIO()), \
+         patch('src.transfer_engine.TransferJournal.for_recording', side_effect=for_recording), \
+         patch('src.transfer_engine.copy_batch',
+               wraps=transfer_engine.copy_batch) as mock_batch:
+        reports = batch_transfer_data(destinations, n_workers=2)
+
+    # All recordings share a single copy pool
+    mock_batch.assert_called_once()
+    assert len(reports) == 2
+    for data_folder, report in zip([mock_data_folder, data_folder_2], reports):
+        server_data_folder = os.path.join(copy_dir, os.path.basename(data_folder))
+        assert report['server_data_folder'] == server_data_folder
+        assert report['failed'] == {}
+        assert report['manifest_digest'] is not None
+        assert os.path.exists(os.path.join(server_data_folder, 'session1', 'test_file.txt'))
+
+def test_transfer_data_not_enough_space(mock_data_folder, mock_server_path):
+    """Test that nothing is written when the server does not have room"""
+    from src.blech_data_transfer import transfer_data, prepare_file_transfer
+
+    _, server_path, _ = mock_server_path
+    copy_dir = os.path.join(server_path, 'user1_dir', 'subfolder1')
+    with patch('sys.stdout', new=StringIO()):
+        dir_list, _, rel_file_list, server_data_folder = prepare_file_transfer(
+                mock_data_folder, copy_dir)
+        with patch('src.transfer_engine.get_free_bytes', return_value=10), \
+             pytest.raises(OSError) as excinfo:
+            transfer_data(mock_data_folder, server_data_folder, dir_list, rel_file_list)
+    assert excinfo.value.errno == errno.ENOSPC
+    assert excinfo.value.filename == server_data_folder
+
+    assert os.listdir(server_data_folder) == []
+
+def test_print_failed_files():
+    """Test the end-of-run list of files which could not be copied"""
+    from src.blech_data_transfer import print_failed_files
+
+    destinations = [dict(data_folder='/data/rec1'), dict(data_folder='/data/rec2')]
+    reports = [dict(failed={}), dict(failed={'amp-A-000.dat': '[Errno 5] Input/output error'})]
+    with patch('sys.stdout', new=StringIO()) as mock_stdout:
+        print_failed_files(destinations, reports)
+    output = mock_stdout.getvalue()
+    assert '/data/rec1' not in output
+    assert '/data/rec2:' in output
+    assert 'amp-A-000.dat: [Errno 5] Input/output error' in output
+
+    with patch('sys.stdout', new=StringIO()) as mock_stdout:
+        print_failed_files(destinations[:1], reports[:1])
+    assert mock_stdout.getvalue() == ''
+
+def test_create_server_dirs(temp_dir):
+    """Test creating only the missing directories of the server tree"""
+    from src.blech_data_transfer import create_server_dirs
+
+    data_folder = os.path.join(temp_dir, 'test_data')
+    rel_dirs = ['session1', os.path.join('session1', 'raw'), 'session2']
+    dir_list = [os.path.join(data_folder, d) for d in rel_dirs]
+    server_data_folder = os.path.join(temp_dir, 'server', 'test_data')
+    os.makedirs(os.path.join(server_data_folder, 'session2'))
+
+    with patch('sys.stdout', new=StringIO()) as mock_stdout, \
+         patch('sys.stderr', new=StringIO()), \
+         patch('os.makedirs', wraps=os.makedirs) as mock_makedirs:
+        create_server_dirs(data_folder, server_data_folder, dir_list)
+    # A single call for the missing branch (makedirs creates the parent itself)
+    assert mock_makedirs.call_args_list[0].args == (
+        os.path.join(server_data_folder, 'session1', 'raw'),)
+    assert os.path.join(server_data_folder, 'session2') not in [
+        c.args[0] for c in mock_makedirs.call_args_list]
+    assert '1 directories already exist on the server' in mock_stdout.getvalue()
+    for rel_dir in rel_dirs:
+        assert os.path.isdir(os.path.join(server_data_folder, rel_dir))
+
+def test_plan_transfer_rules(mock_data_folder, mock_server_path):
+    """Test that files excluded by transfer rules are left out of the plan"""
+    from src.blech_data_transfer import plan_transfer
+
+    _, server_path, _ = mock_server_path
+    server_data_folder = os.path.join(server_path, 'user1_dir', 'subfolder1', 'test_data')
+    with open(os.path.join(mock_data_folder, 'derived.h5'), 'wb') as f:
+        f.write(os.urandom(4000))
+    rel_file_list = ['test.info', os.path.join('session1', 'test_file.txt'), 'derived.h5']
+
+    with patch('sys.stdout', new=StringIO()) as mock_stdout:
+        transfer_plan = plan_transfer(mock_data_folder, server_data_folder, rel_file_list,
+                                      rules=[('exclude', '*.h5')])
+    assert 'Excluded 1 files' in mock_stdout.getvalue()
+    assert transfer_plan['excluded'] == ['derived.h5']
+    assert transfer_plan['bytes_excluded'] == 4000
+    assert sorted(transfer_plan['copy_list']) == sorted(rel_file_list[:2])
+    assert transfer_plan['total_bytes'] == sum(
+        os.path.getsize(os.path.join(mock_data_folder, f)) for f in rel_file_list[:2])
+
+@pytest.mark.parametrize('mode', ['copy', 'stream'])
+def test_transfer_recording(mock_data_folder, mock_server_path, mode):
+    """Test transferring a recording through the API without prompting"""
+    from src.blech_data_transfer import transfer_recording
+
+    _, server_path, _ = mock_server_path
+    copy_dir = os.path.join(server_path, 'user1_dir', 'subfolder1')
+
+    with patch('sys.stdout', new=StringIO()), \
+         patch('sys.stderr', new=StringIO()), \
+         patch('builtins.input', side_effect=AssertionError('prompted')), \
+         patch('src.transfer_rules.load_rules', return_value=[]) as mock_rules:
+        # compress is not supported in stream mode and is left out
+        report = transfer_recording(mock_data_folder, copy_dir, user='user1', mode=mode,
+                                    n_workers=2, compress=None)
+
+    mock_rules.assert_called_once_with('user1')
+    server_data_folder = os.path.join(copy_dir, os.path.basename(mock_data_folder))
+    assert report['server_data_folder'] == server_data_folder
+    assert not report['failed']
+    assert os.path.exists(os.path.join(server_data_folder, 'session1', 'test_file.txt'))
+    assert report['manifest_digest'] is not None
+
+    with pytest.raises(ValueError):
+        transfer_recording(mock_data_folder, copy_dir, mode='unknown')
+
+@pytest.mark.parametrize('mode', ['copy', 'stream', 'live'])
+def test_transfer_recording_reincluded_file(mock_data_folder, mock_server_path, mode):
+    """Test that a file included again inside an excluded directory gets its folder"""
+    from src.blech_data_transfer import transfer_recording
+
+    _, server_path, _ = mock_server_path
+    copy_dir = os.path.join(server_path, 'user1_dir', 'subfolder1')
+    os.makedirs(os.path.join(mock_data_folder, 'Plots'))
+    for name in ['summary.png', 'unit_1.png']:
+        with open(os.path.join(mock_data_folder, 'Plots', name), 'wb') as f:
+            f.write(os.urandom(100))
+    rules = [('exclude', 'Plots'), ('include', 'Plots/summary.png')]
+
+    with patch('sys.stdout', new=StringIO()), \
+         patch('sys.stderr', new=StringIO()), \
+         patch('src.transfer_rules.load_rules', return_value=rules):
+        report = transfer_recording(mock_data_folder, copy_dir, user='user1', mode=mode,
+                                    poll_seconds=0, settle_seconds=0)
+
+    server_data_folder = os.path.join(copy_dir, os.path.basename(mock_data_folder))
+    assert report['failed'] == {}
+    assert os.path.exists(os.path.join(server_data_folder, 'Plots', 'summary.png'))
+    assert not os.path.exists(os.path.join(server_data_folder, 'Plots', 'unit_1.png'))
+
+def test_import_without_heavy_modules():
+    """Test that importing the transfer script leaves out pandas, numpy and easygui"""
+    from src.import_budget import measure_imports, check_budget
+
+    _, heavy, _ = check_budget(measure_imports('src.blech_data_transfer'))
+    assert heavy == []
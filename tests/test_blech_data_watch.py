@@ -0,0 +1,217 @@
+import pytest
+import os
+import time
+import pandas as pd
+import tempfile
+import shutil
+from unittest.mock import patch, MagicMock
+from io import StringIO
+
+from src import transfer_engine
+from src.blech_data_watch import (
+    load_watch_defaults,
+    recording_signature,
+    RecordingWatcher,
+    get_rig_destination,
+    ingest_recordings,
+    run_watch,
+    is_transferred,
+    WATCH_DEFAULTS_NAME,
+)
+
+@pytest.fixture
+def temp_dir():
+    """Create a temporary directory for testing"""
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+@pytest.fixture
+def watch_dir(temp_dir):
+    """Create an acquisition folder with one finished and one unfinished recording"""
+    watch_dir = os.path.join(temp_dir, 'acquisition')
+    for name, has_info in [('rec_done', True), ('rec_no_info', False)]:
+        data_folder = os.path.join(watch_dir, name)
+        os.makedirs(os.path.join(data_folder, 'session1'))
+        with open(os.path.join(data_folder, 'amp-A-000.dat'), 'wb') as f:
+            f.write(os.urandom(2000))
+        with open(os.path.join(data_folder, 'session1', 'events.txt'), 'w') as f:
+            f.write('events')
+        if has_info:
+            with open(os.path.join(data_folder, f'{name}.info'), 'w') as f:
+                f.write('info')
+    return watch_dir
+
+@pytest.fixture
+def server(temp_dir):
+    """Create a server with a users list"""
+    server_path = os.path.join(temp_dir, 'server')
+    os.makedirs(os.path.join(server_path, 'user1_dir'))
+    users_list = pd.DataFrame(dict(
+        Username=['user1'], Directory=['user1_dir'], Email=['user1@example.com']))
+    return server_path, users_list
+
+def test_load_watch_defaults(temp_dir):
+    """Test reading rig defaults"""
+    assert load_watch_defaults(temp_dir) == {}
+    os.makedirs(os.path.join(temp_dir, 'local_only_files'))
+    with open(os.path.join(temp_dir, 'local_only_files', WATCH_DEFAULTS_NAME), 'w') as f:
+        f.write("# Rig 1\nwatch_dir = /media/acq\nuser=user1\n\nsubfolder=rig1\n")
+    assert load_watch_defaults(temp_dir) == dict(
+        watch_dir='/media/acq', user='user1', subfolder='rig1')
+
+def test_recording_watcher(watch_dir):
+    """Test that recordings are ready only once unchanged and with an .info file"""
+    rec_done = os.path.join(watch_dir, 'rec_done')
+    now = time.time()
+    watcher = RecordingWatcher(watch_dir, settle_seconds=600)
+
+    # Files were just written, so nothing has settled yet
+    assert watcher.poll(now) == []
+    # Still growing, so the settle time restarts
+    with open(os.path.join(rec_done, 'amp-A-000.dat'), 'ab') as f:
+        f.write(b'more')
+    assert watcher.poll(now + 300) == []
+    assert watcher.poll(now + 600) == []
+    # Unchanged long enough, but only the recording with an .info file is ready
+    assert watcher.poll(now + 901) == [rec_done]
+
+    watcher.mark_done(rec_done)
+    assert watcher.poll(now + 2000) == []
+
+    # Recordings already on the server are never picked up
+    watcher = RecordingWatcher(watch_dir, settle_seconds=600, logged_names={'rec_done'})
+    with patch('sys.stdout', new=StringIO()):
+        assert watcher.poll(now + 2000) == []
+    assert rec_done in watcher.done
+
+def test_recording_watcher_reused_name(watch_dir):
+    """Test that a logged name is only skipped if the contents were transferred"""
+    rec_done = os.path.join(watch_dir, 'rec_done')
+    now = time.time() + 2000
+    is_transferred = MagicMock(return_value=False)
+    watcher = RecordingWatcher(watch_dir, settle_seconds=600, logged_names={'rec_done'},
+                               is_transferred=is_transferred)
+    # A new recording under a logged name is transferred
+    assert watcher.poll(now) == [rec_done]
+    is_transferred.assert_called_once_with(rec_done)
+
+    is_transferred.return_value = True
+    watcher = RecordingWatcher(watch_dir, settle_seconds=600, logged_names={'rec_done'},
+                               is_transferred=is_transferred)
+    with patch('sys.stdout', new=StringIO()):
+        assert watcher.poll(now) == []
+        assert watcher.poll(now + 60) == []
+    assert is_transferred.call_count == 2
+
+    # Once the folder is removed, a new recording can take its name
+    shutil.rmtree(rec_done)
+    watcher.poll(now + 120)
+    assert watcher.done == set()
+
+def test_recording_watcher_old_recording(watch_dir):
+    """Test that a recording finished before the watcher started is ready at once"""
+    rec_done = os.path.join(watch_dir, 'rec_done')
+    old = time.time() - 3600
+    for root, dirs, files in os.walk(rec_done):
+        for name in dirs + files:
+            os.utime(os.path.join(root, name), (old, old))
+    os.utime(rec_done, (old, old))
+
+    watcher = RecordingWatcher(watch_dir, settle_seconds=600)
+    assert watcher.poll() == [rec_done]
+    assert recording_signature(rec_done)[:2] == (3, 2000 + len('events') + len('info'))
+
+def test_get_rig_destination(server):
+    """Test creating the rig subfolder"""
+    server_path, users_list = server
+    with patch('sys.stdout', new=StringIO()):
+        copy_dir = get_rig_destination(users_list, server_path, 'user1', 'rig1')
+        assert copy_dir == os.path.join(server_path, 'user1_dir', 'rig1')
+        assert os.path.isdir(copy_dir)
+
+        with pytest.raises(SystemExit):
+            get_rig_destination(users_list, server_path, 'unknown', 'rig1')
+
+def test_run_watch_once(temp_dir, watch_dir, server):
+    """Test transferring and logging complete recordings"""
+    server_path, users_list = server
+    copy_dir = os.path.join(server_path, 'user1_dir', 'rig1')
+    os.makedirs(copy_dir)
+    handler = MagicMock()
+    watcher = RecordingWatcher(watch_dir, settle_seconds=0)
+
+    journal_dir = os.path.join(temp_dir, 'transfer_journals')
+    os.makedirs(journal_dir)
+    def for_recording(data_folder, server_data_folder):
+        return transfer_engine.TransferJournal(
+                os.path.join(journal_dir, os.path.basename(data_folder) + '.json'),
+                server_data_folder)
+
+    with patch('sys.stdout', new=StringIO()), \
+         patch('sys.stderr', new=StringIO()), \
+         patch('src.transfer_engine.TransferJournal.for_recording', side_effect=for_recording):
+        run_watch(handler, users_list, watcher, 'user1', copy_dir, once=True,
+                  transfer_kwargs=dict(n_workers=2))
+
+    server_data_folder = os.path.join(copy_dir, 'rec_done')
+    assert os.path.exists(os.path.join(server_data_folder, 'session1', 'events.txt'))
+    assert not os.path.exists(os.path.join(copy_dir, 'rec_no_info'))
+    handler.add_entries.assert_called_once()
+    entries = handler.add_entries.call_args[0][0]
+    assert [e['recording'] for e in entries] == ['rec_done']
+    assert entries[0]['recording_path'] == server_data_folder
+    assert os.path.join(watch_dir, 'rec_done') in watcher.done
+
+def test_ingest_recordings_failed(watch_dir, server):
+    """Test that recordings with failed files are not logged"""
+    server_path, users_list = server
+    handler = MagicMock()
+    report = dict(failed={'amp-A-000.dat': 'EIO'}, server_data_folder='x',
+                  manifest_digest='y')
+    with patch('sys.stdout', new=StringIO()), \
+         patch('src.blech_data_transfer.batch_transfer_data', return_value=[report]):
+        transferred = ingest_recordings(
+                handler, users_list, 'user1', server_path,
+                [os.path.join(watch_dir, 'rec_done')], {})
+    assert transferred == []
+    handler.add_entries.assert_not_called()
+
+def test_run_watch_survives_failed_transfer(watch_dir, server):
+    """Test that a failed transfer leaves the recording pending for the next poll"""
+    server_path, users_list = server
+    handler = MagicMock()
+    watcher = RecordingWatcher(watch_dir, settle_seconds=0)
+    rec_done = os.path.join(watch_dir, 'rec_done')
+    with patch('sys.stdout', new=StringIO()) as mock_stdout, \
+         patch('src.blech_data_transfer.batch_transfer_data',
+               side_effect=OSError(28, 'No space left on device')):
+        run_watch(handler, users_list, watcher, 'user1', server_path, once=True)
+    assert 'Transfer failed, will retry' in mock_stdout.getvalue()
+    assert rec_done not in watcher.done
+    assert rec_done in watcher.pending
+    handler.add_entries.assert_not_called()
+
+def test_run_watch_stops_exited_transfer(watch_dir, server):
+    """Test that a transfer exiting stops watching its recording, not the watcher"""
+    server_path, users_list = server
+    handler = MagicMock()
+    watcher = RecordingWatcher(watch_dir, settle_seconds=0)
+    rec_done = os.path.join(watch_dir, 'rec_done')
+    with patch('sys.stdout', new=StringIO()) as mock_stdout, \
+         patch('src.blech_data_transfer.batch_transfer_data', side_effect=SystemExit()):
+        run_watch(handler, users_list, watcher, 'user1', server_path, once=True)
+    assert 'Transfer stopped, no longer watching: rec_done' in mock_stdout.getvalue()
+    assert rec_done in watcher.done
+    assert rec_done not in watcher.pending
+    handler.add_entries.assert_not_called()
+
+def test_is_transferred(watch_dir):
+    """Test that only the same contents, or a legacy entry of the same name, count as transferred"""
+    rec_done = os.path.join(watch_dir, 'rec_done')
+    handler = MagicMock()
+    for kind, expected in [('fingerprint', True), ('name', True),
+                           ('conflict', False), (None, False)]:
+        handler.match_recording.return_value = (kind, pd.DataFrame())
+        with patch('sys.stdout', new=StringIO()):
+            assert is_transferred(handler, rec_done) == expected
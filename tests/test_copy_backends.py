@@ -0,0 +1,149 @@
+import pytest
+import os
+import errno
+import json
+import hashlib
+from unittest.mock import patch
+
+from src import copy_backends
+from src.copy_backends import (
+    BACKENDS,
+    copy_chunks,
+    is_available,
+    get_backend,
+    calibrate,
+)
+from src.transfer_engine import copy_file, TransferJournal
+from tests.conftest import read_bytes
+
+@pytest.fixture(autouse=True)
+def reset_refused():
+    """Forget backends refused by earlier tests"""
+    copy_backends._refused.clear()
+    yield
+    copy_backends._refused.clear()
+
+@pytest.fixture
+def src_file(temp_dir):
+    """Create a file spanning several backend chunks"""
+    src_path = os.path.join(temp_dir, 'amp-A-000.dat')
+    data = os.urandom(2 * copy_backends.BACKEND_BUFFER_SIZE + 12345)
+    with open(src_path, 'wb') as f:
+        f.write(data)
+    return src_path, data
+
+@pytest.mark.parametrize('backend', [b for b in BACKENDS if is_available(b)])
+def test_copy_file_backends(temp_dir, src_file, backend):
+    """Test that every backend copies and hashes the file exactly"""
+    src_path, data = src_file
+    dst_path = os.path.join(temp_dir, 'copy.dat')
+    n_bytes, digest = copy_file(src_path, dst_path, backend=backend)
+    assert n_bytes == len(data)
+    assert read_bytes(dst_path) == data
+    assert digest == hashlib.blake2b(data).hexdigest()
+
+@pytest.mark.parametrize('backend', [b for b in BACKENDS if is_available(b)])
+def test_copy_chunks_from_offset(temp_dir, src_file, backend):
+    """Test resuming a copy part way through the file"""
+    src_path, data = src_file
+    dst_path = os.path.join(temp_dir, 'copy.dat')
+    offset = 1000
+    with open(dst_path, 'wb') as f:
+        f.write(data[:offset])
+    with open(src_path, 'rb', buffering=0) as src, \
+            open(dst_path, 'r+b', buffering=0) as dst:
+        src.seek(offset)
+        dst.seek(offset)
+        copied = b''.join(bytes(c) for c in copy_chunks(src, dst, offset, backend))
+    assert copied == data[offset:]
+    assert read_bytes(dst_path) == data
+
+def test_fallback_when_refused(temp_dir, src_file):
+    """Test that a refused backend falls back and is not retried"""
+    if not is_available('copy_file_range'):
+        pytest.skip('copy_file_range not available')
+    src_path, data = src_file
+    refused = OSError(errno.EXDEV, 'Invalid cross-device link')
+    with patch('src.copy_backends.os.copy_file_range', side_effect=refused) as mock_cfr:
+        for name in ['a.dat', 'b.dat']:
+            dst_path = os.path.join(temp_dir, name)
+            copy_file(src_path, dst_path, backend='copy_file_range')
+            assert read_bytes(dst_path) == data
+    assert mock_cfr.call_count == 1
+    assert ('copy_file_range', os.stat(temp_dir).st_dev) in copy_backends._refused
+
+def test_fallback_mid_file(temp_dir, src_file):
+    """Test falling back after part of the file was copied"""
+    src_path, data = src_file
+    dst_path = os.path.join(temp_dir, 'copy.dat')
+    real_chunk = copy_backends.CHUNK_FUNCS['readinto']
+    calls = []
+    def flaky_chunk(src, dst, offset, view):
+        calls.append(offset)
+        if len(calls) > 1:
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        return real_chunk(src, dst, offset, view)
+    with patch.dict(copy_backends.CHUNK_FUNCS, readinto=flaky_chunk):
+        n_bytes, digest = copy_file(src_path, dst_path, backend='readinto')
+    assert n_bytes == len(data)
+    assert read_bytes(dst_path) == data
+    assert digest == hashlib.blake2b(data).hexdigest()
+
+def test_real_errors_are_raised(temp_dir, src_file):
+    """Test that I/O errors are not mistaken for a refused backend"""
+    src_path, _ = src_file
+    def broken_chunk(src, dst, offset, view):
+        raise OSError(errno.EIO, 'Input/output error')
+    with patch.dict(copy_backends.CHUNK_FUNCS, readinto=broken_chunk):
+        with pytest.raises(OSError):
+            copy_file(src_path, os.path.join(temp_dir, 'copy.dat'), backend='readinto')
+    assert copy_backends._refused == set()
+
+def test_journal_resume_with_kernel_backend(temp_dir, src_file):
+    """Test that journal commits and resume work with kernel copies"""
+    backend = next(b for b in BACKENDS if is_available(b))
+    src_path, data = src_file
+    dst_path = os.path.join(temp_dir, 'copy.dat')
+    journal = TransferJournal(os.path.join(temp_dir, 'journal.json'), temp_dir)
+    src_stat = os.stat(src_path)
+    offset = copy_backends.BACKEND_BUFFER_SIZE
+    with open(dst_path + '.blech_partial', 'wb') as f:
+        f.write(data[:offset] + b'garbage')
+    journal.commit('amp-A-000.dat', src_stat, offset)
+
+    n_bytes, digest = copy_file(src_path, dst_path, journal=journal,
+                                rel_file='amp-A-000.dat', backend=backend)
+    assert n_bytes == len(data) - offset
+    assert read_bytes(dst_path) == data
+    assert digest == hashlib.blake2b(data).hexdigest()
+    assert journal.entries == {}
+
+def test_get_backend(temp_dir):
+    """Test that the calibration of the closest mount is used"""
+    path = os.path.join(temp_dir, 'copy_backends.json')
+    assert get_backend(temp_dir, path) == copy_backends.DEFAULT_BACKEND
+    server = os.path.realpath(os.path.join(temp_dir, 'server'))
+    with open(path, 'w') as f:
+        json.dump({
+            server: dict(backend='sendfile', mb_per_s=100, date=''),
+            os.path.join(server, 'fast'): dict(backend='copy_file_range', mb_per_s=900, date=''),
+            }, f)
+    assert get_backend(os.path.join(server, 'user1', 'rec1'), path) == 'sendfile'
+    assert get_backend(os.path.join(server, 'fast', 'rec1'), path) == 'copy_file_range'
+    assert get_backend(server + '_other', path) == copy_backends.DEFAULT_BACKEND
+
+def test_calibrate(temp_dir):
+    """Test that calibration measures each backend and remembers the fastest"""
+    path = os.path.join(temp_dir, 'local_only_files', 'copy_backends.json')
+    target_dir = os.path.join(temp_dir, 'server')
+    os.makedirs(target_dir)
+    refused = OSError(errno.EXDEV, 'Invalid cross-device link')
+    with patch('src.copy_backends.os.copy_file_range', side_effect=refused, create=True):
+        results = calibrate(target_dir, size_mb=1, path=path)
+
+    if is_available('copy_file_range'):
+        assert results['copy_file_range'] is None
+    measured = {b: s for b, s in results.items() if s is not None}
+    assert set(measured) >= {'readinto', 'shutil'}
+    assert get_backend(target_dir, path) == max(measured, key=measured.get)
+    assert os.listdir(target_dir) == []
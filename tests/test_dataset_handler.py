@@ -3,7 +3,7 @@ import os
 import pandas as pd
 import tempfile
 import shutil
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 from src.dataset_handler import DatasetFrameLogger, DatasetFrameHandler, get_time_pretty
 
 class TestDatasetFrameLogger:
@@ -131,6 +131,7 @@ class TestDatasetFrameHandler:
         
         # Sync logs
         handler.sync_logs()
+        handler.flush()
         
         # Check if local dataset frame was created
         local_df_path = os.path.join(self.temp_dir, 'dataset_frame.csv')
@@ -160,6 +161,7 @@ class TestDatasetFrameHandler:
         
         # Sync logs
         handler.sync_logs()
+        handler.flush()
         
         # Check if server dataset frame was created
         server_df_path = os.path.join(self.server_home_dir, 'dataset_frame.csv')
@@ -202,6 +204,7 @@ class TestDatasetFrameHandler:
         
         # Sync logs
         handler.sync_logs()
+        handler.flush()
         
         # Verify the merged content
         merged_df = pd.read_csv(server_df_path)
@@ -244,11 +247,128 @@ class TestDatasetFrameHandler:
             handler.add_entry(entry)
         
         # Verify the entry was added
-        updated_df = pd.read_csv(df_path)
+        updated_df = handler.read_dataset_frame()
         assert len(updated_df) == 1
         assert updated_df.iloc[0]['recording'] == 'test_recording'
         assert updated_df.iloc[0]['user'] == 'test_user'
-        
+
+    @patch('src.dataset_handler.DatasetFrameLogger')
+    def test_add_entries(self, mock_logger):
+        handler = DatasetFrameHandler(self.temp_dir)
+
+        df_path = os.path.join(self.temp_dir, 'dataset_frame.csv')
+        pd.DataFrame(columns=['date', 'time', 'user', 'email', 'recording',
+                              'recording_path']).to_csv(df_path, index=False)
+        handler.dataset_frame_path = df_path
+
+        entries = [
+            {
+                'date': '2025-04-28',
+                'time': '12:00:00',
+                'user': 'test_user',
+                'email': 'test@example.com',
+                'recording': f'test_recording_{i}',
+                'recording_path': f'/path/to/test_recording_{i}'
+            }
+            for i in range(3)
+        ]
+
+        with patch.object(handler, 'sync_logs') as mock_sync, \
+             patch('src.dataset_handler.pd.read_csv', wraps=pd.read_csv) as mock_read, \
+             patch('src.dataset_handler.os.write', wraps=os.write) as mock_write:
+            handler.add_entries(entries)
+        # A single append to the journal, the csv is neither read nor synced
+        assert mock_read.call_count == 0
+        assert mock_write.call_count == 1
+        mock_sync.assert_not_called()
+        assert len(pd.read_csv(df_path)) == 0
+
+        updated_df = handler.read_dataset_frame()
+        assert list(updated_df['recording']) == [f'test_recording_{i}' for i in range(3)]
+
+        # Nothing is written if any entry is missing keys
+        with patch.object(handler, 'sync_logs'):
+            with pytest.raises(ValueError):
+                handler.add_entries([entries[0], {'user': 'test_user'}])
+        assert len(handler.read_dataset_frame()) == 3
+
+    @patch('src.dataset_handler.DatasetFrameLogger')
+    def test_compact_journal(self, mock_logger):
+        handler = DatasetFrameHandler(self.temp_dir)
+
+        server_df_path = os.path.join(self.server_home_dir, 'dataset_frame.csv')
+        local_df_path = os.path.join(self.temp_dir, 'dataset_frame.csv')
+        pd.DataFrame({
+            'date': ['2025-04-27'],
+            'time': ['12:00:00'],
+            'user': ['test_user'],
+            'email': ['test@example.com'],
+            'recording': ['old_recording'],
+            'recording_path': ['/path/to/old_recording'],
+        }).to_csv(server_df_path, index=False)
+        shutil.copy(server_df_path, local_df_path)
+        handler.dataset_frame_path = local_df_path
+
+        entries = [
+            {
+                'date': '2025-04-28',
+                'time': '12:00:00',
+                'user': 'test_user',
+                'email': 'test@example.com',
+                'recording': f'test_recording_{i}',
+                'recording_path': f'/path/to/test_recording_{i}'
+            }
+            for i in range(3)
+        ]
+        # Crossing the size threshold starts a background compaction
+        with patch('src.dataset_handler.COMPACT_ABOVE_BYTES', 1):
+            handler.add_entries(entries[:2])
+        handler.compaction.join()
+        assert not os.path.exists(handler.journal_path)
+        for df_path in [server_df_path, local_df_path]:
+            assert list(pd.read_csv(df_path)['recording']) == \
+                    ['old_recording', 'test_recording_0', 'test_recording_1']
+
+        # A journal left mid-compaction by a crash is finished by the next one
+        handler.add_entries(entries[2:])
+        os.rename(handler.journal_path, handler.journal_path + '.compacting')
+        with open(handler.journal_path + '.compacting', 'a') as f:
+            f.write('{"date": "2025-04-28", "time": "12:0')
+        assert len(handler.read_dataset_frame()) == 4
+        assert handler.compact() == 1
+        assert list(pd.read_csv(server_df_path)['recording'])[-1] == 'test_recording_2'
+        assert len(handler.read_dataset_frame()) == 4
+
+        # Another process holding the lock is left to compact
+        handler.add_entries(entries[:1])
+        open(os.path.join(self.server_home_dir, 'dataset_frame_compact.lock'), 'w').close()
+        assert handler.compact() == 0
+        assert os.path.exists(handler.journal_path)
+
+    @patch('src.dataset_handler.DatasetFrameLogger')
+    def test_compaction_leaves_session_to_main_thread(self, mock_logger):
+        import threading
+        handler = DatasetFrameHandler(self.temp_dir)
+        local_df_path = os.path.join(self.temp_dir, 'dataset_frame.csv')
+        frame = pd.DataFrame({'recording': ['recording_0']})
+
+        started, release = threading.Event(), threading.Event()
+        def slow_compaction(*args):
+            started.set()
+            release.wait(5)
+            return 0
+        with patch('src.dataset_handler.compact_journal', side_effect=slow_compaction):
+            handler.start_compaction()
+            started.wait(5)
+            # Written by the main thread while the compaction runs
+            handler.session.write_csv(local_df_path, frame)
+            release.set()
+            handler.compaction.join()
+            assert local_df_path in handler.session.pending
+            assert handler.flush() == [local_df_path]
+        assert handler.compaction is None
+        assert list(pd.read_csv(local_df_path)['recording']) == ['recording_0']
+
     @patch('dataset_handler.DatasetFrameLogger')
     def test_check_experiment_exists_true(self, mock_logger):
         handler = DatasetFrameHandler(self.temp_dir)
@@ -297,6 +417,195 @@ class TestDatasetFrameHandler:
         result = handler.check_experiment_exists('/path/to/non_existing_recording')
         assert result is False
 
+    @patch('src.dataset_handler.DatasetFrameLogger')
+    def test_check_experiment_exists_fingerprint(self, mock_logger):
+        handler = DatasetFrameHandler(self.temp_dir)
+
+        df_path = os.path.join(self.temp_dir, 'dataset_frame.csv')
+        pd.DataFrame({
+            'date': ['2025-04-28'] * 3,
+            'time': ['12:00:00'] * 3,
+            'user': ['test_user'] * 3,
+            'email': ['test@example.com'] * 3,
+            'recording': ['legacy_recording', 'same_name', 'original_name'],
+            'recording_path': ['/server/legacy_recording', '/server/same_name',
+                               '/server/original_name'],
+            'fingerprint': [None, 'aaaa', 'bbbb'],
+        }).to_csv(df_path, index=False)
+        handler.dataset_frame_path = df_path
+
+        with patch('sys.stdout'), \
+             patch('src.dataset_handler.pd.read_csv', wraps=pd.read_csv) as mock_read:
+            # Renamed copy of a recording on the server
+            assert handler.check_experiment_exists('/data/renamed', fingerprint='bbbb')
+            assert handler.find_fingerprint('bbbb')[0]['recording_path'] == '/server/original_name'
+            # Same name, different contents, reported for the caller to decide
+            assert handler.check_experiment_exists('/data/same_name', fingerprint='cccc')
+            assert handler.match_recording('/data/same_name', fingerprint='cccc')[0] == 'conflict'
+            assert handler.match_recording('/data/renamed', fingerprint='bbbb')[0] == 'fingerprint'
+            assert handler.match_recording('/data/legacy_recording', 'dddd')[0] == 'name'
+            assert handler.match_recording('/data/missing', 'dddd')[0] is None
+            # Entries without a fingerprint are still matched by name
+            assert handler.check_experiment_exists('/data/legacy_recording', fingerprint='dddd')
+            assert handler.check_experiment_exists('/data/same_name')
+        # The csv is read once for all lookups
+        assert mock_read.call_count == 1
+
+        # New entries are added to the index without reading the frame again
+        entry = dict(date='2025-04-29', time='12:00:00', user='test_user',
+                     email='test@example.com', recording='new_recording',
+                     recording_path='/server/new_recording', fingerprint='eeee')
+        with patch.object(handler, 'sync_logs'):
+            handler.add_entries([entry])
+        assert handler.find_fingerprint('eeee') == [entry]
+
+    @patch('src.dataset_handler.DatasetFrameLogger')
+    def test_sqlite_backend(self, mock_logger):
+        from src.dataset_handler import append_records
+        handler = DatasetFrameHandler(self.temp_dir, backend='sqlite')
+
+        df_path = os.path.join(self.temp_dir, 'dataset_frame.csv')
+        pd.DataFrame({
+            'date': ['2025-04-28'],
+            'time': ['12:00:00'],
+            'user': ['test_user'],
+            'email': ['test@example.com'],
+            'recording': ['csv_recording'],
+            'recording_path': ['/server/csv_recording'],
+        }).to_csv(df_path, index=False)
+        handler.dataset_frame_path = df_path
+
+        entry = dict(date='2025-04-29', time='12:00:00', user='test_user',
+                     email='test@example.com', recording='new_recording',
+                     recording_path='/server/new_recording', fingerprint='aaaa')
+        with patch('sys.stdout'):
+            # The first lookup imports the csv
+            assert handler.check_experiment_exists('/data/csv_recording')
+            with patch('src.dataset_handler.pd.read_csv', wraps=pd.read_csv) as mock_read:
+                handler.add_entries([entry])
+                # Another rig appends to the journal
+                append_records(handler.journal_path,
+                               [dict(entry, recording='other_rig', entry_id='other')])
+                assert handler.check_experiment_exists('/data/new', fingerprint='aaaa')
+                assert handler.check_experiment_exists('/data/other_rig')
+                assert not handler.check_experiment_exists('/data/missing')
+            # New journal records are read incrementally, the csv is not read again
+            assert mock_read.call_count == 0
+
+            # A changed csv is imported again
+            pd.DataFrame([dict(entry, recording='synced_recording', entry_id='synced')]).to_csv(
+                    df_path, index=False)
+            assert handler.check_experiment_exists('/data/synced_recording')
+            assert not handler.check_experiment_exists('/data/csv_recording')
+            assert len(handler.read_dataset_frame()) == 3
+
+            # A csv waiting for flush is looked up from memory, not written early
+            pending = dict(entry, recording='pending_recording', entry_id='pending')
+            handler.session.write_csv(df_path, pd.DataFrame([pending]))
+            with patch('src.dataset_handler.os.replace') as mock_replace:
+                assert handler.check_experiment_exists('/data/pending_recording')
+                assert not handler.check_experiment_exists('/data/synced_recording')
+            mock_replace.assert_not_called()
+            assert df_path in handler.session.pending
+            handler.flush()
+            assert handler.check_experiment_exists('/data/pending_recording')
+
+    @patch('src.dataset_handler.DatasetFrameLogger')
+    def test_session_reads_each_file_once(self, mock_logger):
+        handler = DatasetFrameHandler(self.temp_dir)
+
+        server_df_path = os.path.join(self.server_home_dir, 'dataset_frame.csv')
+        local_df_path = os.path.join(self.temp_dir, 'dataset_frame.csv')
+        pd.DataFrame({
+            'date': ['2025-04-28', '2025-04-28'],
+            'time': ['12:00:00', '13:00:00'],
+            'user': ['test_user', 'test_user'],
+            'email': ['test@example.com', 'test@example.com'],
+            'recording': ['recording_0', 'recording_1'],
+            'recording_path': ['/server/recording_0', '/server/recording_1'],
+            'info_file_exists': [True, True],
+        }).to_csv(server_df_path, index=False)
+        shutil.copy(server_df_path, local_df_path)
+
+        entry = dict(date='2025-04-29', time='12:00:00', user='test_user',
+                     email='test@example.com', recording='recording_2',
+                     recording_path='/server/recording_2', info_file_exists=True)
+        with patch('sys.stdout'), \
+             patch('src.dataset_handler.os.replace', wraps=os.replace) as mock_replace:
+            # What a transfer run does with the dataset frame
+            handler.check_dataset_frame()
+            handler.sync_logs()
+            for recording in ['recording_0', 'recording_1', 'new_recording']:
+                handler.check_experiment_exists(f'/data/{recording}')
+            handler.add_entries([entry])
+            assert handler.check_experiment_exists('/data/recording_2')
+            handler.flush()
+        # Both csvs and the journal once, and the copies were already in sync
+        assert handler.session.n_reads == 3
+        csv_writes = [c for c in mock_replace.call_args_list
+                      if c.args[1] in [server_df_path, local_df_path]]
+        assert csv_writes == []
+        assert list(handler.find_recording('recording_1')['time']) == ['13:00:00']
+
+        # A csv changed by another process is read again, and not overwritten
+        pd.DataFrame([entry]).to_csv(local_df_path, index=False)
+        assert len(handler.read_dataset_frame()) == 1
+        assert handler.session.n_reads == 4
+        handler.session.write_csv(server_df_path, pd.DataFrame([entry]))
+        pd.DataFrame([entry, entry]).to_csv(server_df_path, index=False)
+        with patch('sys.stdout'):
+            assert handler.flush() == []
+        assert len(pd.read_csv(server_df_path)) == 2
+
+    @patch('src.dataset_handler.DatasetFrameLogger')
+    def test_sync_logs_tails(self, mock_logger):
+        from src.dataset_handler import append_csv_rows, read_csv_header
+        handler = DatasetFrameHandler(self.temp_dir)
+
+        server_df_path = os.path.join(self.server_home_dir, 'dataset_frame.csv')
+        local_df_path = os.path.join(self.temp_dir, 'dataset_frame.csv')
+        entry = dict(date='2025-04-28', time='12:00:00', user='test_user',
+                     email='test@example.com', recording='recording_0',
+                     recording_path='/server/recording_0', info_file_exists=True,
+                     entry_id='id_0', seq=1)
+        pd.DataFrame([entry]).to_csv(server_df_path, index=False)
+        pd.DataFrame([dict(entry, recording='recording_1', entry_id='id_1', seq=2)]).to_csv(
+                local_df_path, index=False)
+
+        # The first sync merges both copies in full
+        handler.sync_logs()
+        handler.flush()
+        assert len(pd.read_csv(server_df_path)) == 2
+        assert len(pd.read_csv(local_df_path)) == 2
+
+        # Nothing is read or written when neither copy changed
+        with patch('src.dataset_handler.pd.read_csv') as mock_read, \
+             patch('src.dataset_handler.os.replace') as mock_replace:
+            handler.sync_logs()
+            assert handler.flush() == []
+        assert mock_read.call_count == 0
+        assert mock_replace.call_count == 0
+
+        # Rows another rig appended are appended to the other copy only,
+        # and a recording transferred again keeps both of its entries
+        header = read_csv_header(server_df_path)[0]
+        append_csv_rows(server_df_path, header, [
+            dict(entry, entry_id='id_2', seq=3),
+            dict(entry, recording='recording_2', entry_id='id_3', seq=4)])
+        with patch('src.dataset_handler.pd.read_csv') as mock_read:
+            handler.sync_logs()
+        assert mock_read.call_count == 0
+        local_df = pd.read_csv(local_df_path)
+        assert list(local_df['entry_id'][-2:]) == ['id_2', 'id_3']
+        assert (local_df['recording'] == 'recording_0').sum() == 2
+        assert len(pd.read_csv(server_df_path)) == 4
+
+        # A rewritten copy falls back to a full merge
+        pd.DataFrame([entry]).to_csv(server_df_path, index=False)
+        handler.sync_logs()
+        handler.flush()
+        assert len(pd.read_csv(server_df_path)) == 4
+
 def test_get_time_pretty():
     # This is a simple test to ensure the function returns a string in the expected format
     time_str = get_time_pretty()
@@ -305,3 +614,10 @@ def test_get_time_pretty():
     assert time_str[4] == '-' and time_str[7] == '-'
     assert time_str[10] == ' '
     assert time_str[13] == ':' and time_str[16] == ':'
+
+def test_import_without_gui():
+    """Test that the dataset handler, imported on every transfer, does not load easygui"""
+    from src.import_budget import measure_imports
+
+    names = set(name for name, _, _, _ in measure_imports('src.dataset_handler'))
+    assert 'easygui' not in names
@@ -0,0 +1,82 @@
+import pytest
+import os
+import tempfile
+import shutil
+import pandas as pd
+
+from src.dataset_store import DatasetStore, INDEXED_COLUMNS
+
+@pytest.fixture
+def temp_dir():
+    """Create a temporary directory for testing"""
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+@pytest.fixture
+def store(temp_dir):
+    """Create an empty store"""
+    store = DatasetStore(os.path.join(temp_dir, 'dataset_frame.sqlite'))
+    yield store
+    store.close()
+
+def make_entry(i, user='user1', **kwargs):
+    entry = dict(date=f'2025-04-{i + 1:02d}', time='12:00:00', user=user,
+                 email=f'{user}@example.com', recording=f'recording_{i}',
+                 recording_path=f'/server/recording_{i}', info_file_exists=True)
+    entry.update(kwargs)
+    return entry
+
+def test_store_wal_and_indexes(store):
+    """Test that the database uses WAL and indexes lookups"""
+    assert store.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    for column in INDEXED_COLUMNS:
+        plan = store.conn.execute(
+                f'EXPLAIN QUERY PLAN SELECT * FROM entries WHERE {column} = ?',
+                ('x',)).fetchall()
+        assert f'entries_{column}' in str(plan)
+
+def test_store_insert_and_find(store):
+    """Test that entries come back as they were inserted"""
+    entries = [
+        make_entry(0, fingerprint='aaaa', manifest_digest='digest'),
+        make_entry(1, user='user2', new_column='kept'),
+        make_entry(2),
+    ]
+    store.insert(entries)
+    assert store.find_recording('recording_0') == [entries[0]]
+    assert store.find_fingerprint('aaaa') == [entries[0]]
+    assert store.find_recording('recording_1') == [entries[1]]
+    assert store.find_user('user1') == [entries[0], entries[2]]
+    assert store.find_recording('missing') == []
+
+def test_store_csv_round_trip(temp_dir, store):
+    """Test importing from and exporting to the dataset frame csv"""
+    csv_path = os.path.join(temp_dir, 'dataset_frame.csv')
+    pd.DataFrame([make_entry(0, fingerprint='aaaa'), make_entry(1)]).to_csv(csv_path, index=False)
+    store.insert([make_entry(5)])
+    store.import_csv(csv_path)
+    # Importing replaces what was there
+    assert [e['recording'] for e in store.query()] == ['recording_0', 'recording_1']
+    assert 'fingerprint' not in store.find_recording('recording_1')[0]
+
+    export_path = os.path.join(temp_dir, 'export.csv')
+    store.export_csv(export_path)
+    pd.testing.assert_frame_equal(pd.read_csv(export_path), pd.read_csv(csv_path))
+
+def test_store_user_report(store):
+    """Test counting recordings per user"""
+    store.insert([make_entry(0), make_entry(1, user='user2'), make_entry(2)])
+    report = store.user_report()
+    assert list(report['user']) == ['user1', 'user2']
+    assert list(report['n_recordings']) == [2, 1]
+    assert list(report['first_date']) == ['2025-04-01', '2025-04-02']
+    assert list(report['last_date']) == ['2025-04-03', '2025-04-02']
+
+def test_store_meta(store):
+    """Test that meta values are kept with the entries"""
+    assert store.get_meta('source') is None
+    store.insert([make_entry(0)], meta=dict(source=dict(offset=10)))
+    assert store.get_meta('source') == dict(offset=10)
+    store.set_meta('source', None)
+    assert store.get_meta('source') is None
@@ -0,0 +1,106 @@
+import pytest
+import os
+import hashlib
+import tarfile
+from unittest.mock import patch
+from io import StringIO
+
+from src.file_bundle import (
+    split_small_files,
+    write_bundle,
+    read_bundle_index,
+    bundle_is_current,
+    extract_from_bundle,
+    main,
+    BUNDLE_NAME,
+)
+from tests.conftest import read_bytes
+
+@pytest.fixture
+def bundle_recording(temp_dir):
+    """Create a mock recording with many small files and one large file"""
+    data_folder = os.path.join(temp_dir, 'test_data')
+    os.makedirs(os.path.join(data_folder, 'trials'), exist_ok=True)
+    file_sizes = {'amp-A-000.dat': 50000, 'settings.xml': 300}
+    for i in range(20):
+        file_sizes[os.path.join('trials', f'trial_{i:02}.txt')] = 100 + i
+    for rel_file, size in file_sizes.items():
+        with open(os.path.join(data_folder, rel_file), 'wb') as f:
+            f.write(os.urandom(size))
+
+    server_data_folder = os.path.join(temp_dir, 'server', 'test_data')
+    os.makedirs(server_data_folder, exist_ok=True)
+    return data_folder, server_data_folder, file_sizes
+
+def test_split_small_files(bundle_recording):
+    """Test splitting files by size threshold"""
+    _, _, file_sizes = bundle_recording
+    small, large = split_small_files(file_sizes, 1024)
+    assert large == ['amp-A-000.dat']
+    assert len(small) == 21
+    assert 'settings.xml' in small
+
+def test_write_bundle(bundle_recording):
+    """Test bundling small files with an index of member offsets"""
+    data_folder, server_data_folder, file_sizes = bundle_recording
+    small, _ = split_small_files(file_sizes, 1024)
+
+    digest, bundle_size = write_bundle(data_folder, server_data_folder, small)
+
+    bundle_path = os.path.join(server_data_folder, BUNDLE_NAME)
+    bundle_bytes = read_bytes(bundle_path)
+    assert bundle_size == len(bundle_bytes)
+    assert digest == hashlib.blake2b(bundle_bytes).hexdigest()
+
+    # Bundle is a valid tar
+    with tarfile.open(bundle_path) as tar:
+        assert sorted(tar.getnames()) == small
+
+    # Index offsets point at each member's data
+    index = read_bundle_index(server_data_folder)
+    assert sorted(index) == small
+    for rel_file in small:
+        entry = index[rel_file]
+        start = int(entry['offset'])
+        src_bytes = read_bytes(os.path.join(data_folder, rel_file))
+        assert bundle_bytes[start:start + int(entry['size'])] == src_bytes
+        assert entry['digest'] == hashlib.blake2b(src_bytes).hexdigest()
+
+def test_bundle_is_current(bundle_recording):
+    """Test detecting whether the bundle needs rewriting"""
+    data_folder, server_data_folder, file_sizes = bundle_recording
+    small, _ = split_small_files(file_sizes, 1024)
+    assert not bundle_is_current(data_folder, server_data_folder, small)
+
+    write_bundle(data_folder, server_data_folder, small)
+    assert bundle_is_current(data_folder, server_data_folder, small)
+
+    # A new small file
+    assert not bundle_is_current(data_folder, server_data_folder, small + ['new.txt'])
+
+    # A modified small file
+    with open(os.path.join(data_folder, 'settings.xml'), 'ab') as f:
+        f.write(b'changed')
+    assert not bundle_is_current(data_folder, server_data_folder, small)
+
+def test_extract_from_bundle(bundle_recording, temp_dir):
+    """Test extracting single files from the bundle"""
+    data_folder, server_data_folder, file_sizes = bundle_recording
+    small, _ = split_small_files(file_sizes, 1024)
+    write_bundle(data_folder, server_data_folder, small)
+
+    rel_file = os.path.join('trials', 'trial_07.txt')
+    out_path = os.path.join(temp_dir, 'extracted', rel_file)
+    extract_from_bundle(server_data_folder, rel_file, out_path)
+    src_path = os.path.join(data_folder, rel_file)
+    assert read_bytes(out_path) == read_bytes(src_path)
+    assert os.path.getmtime(out_path) == os.path.getmtime(src_path)
+
+    with pytest.raises(KeyError):
+        extract_from_bundle(server_data_folder, 'amp-A-000.dat', out_path)
+
+    # Listing from the command line
+    with patch('sys.argv', ['file_bundle.py', 'list', server_data_folder]), \
+         patch('sys.stdout', new=StringIO()) as mock_stdout:
+        main()
+    assert 'settings.xml' in mock_stdout.getvalue()
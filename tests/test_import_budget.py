@@ -0,0 +1,35 @@
+import pytest
+
+from src.import_budget import parse_importtime, check_budget
+
+IMPORTTIME_OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:       500 |        500 | argparse
+import time:      1000 |       1000 |     numpy._core
+import time:      2000 |       3000 |   numpy
+import time:       100 |       3100 | src.amp_compression
+import time:       400 |       4000 | src.transfer_engine
+"""
+
+def test_parse_importtime():
+    """Test parsing -X importtime output"""
+    imports = parse_importtime(IMPORTTIME_OUTPUT)
+    assert imports[0] == ('argparse', 500, 500, 0)
+    assert imports[1] == ('numpy._core', 1000, 1000, 2)
+    assert imports[2] == ('numpy', 2000, 3000, 1)
+    assert len(imports) == 5
+
+@pytest.mark.parametrize('budget_ms, heavy_modules, expected_ok', [
+    (10, (), True),
+    (7, (), False),
+    (10, ('numpy',), False),
+    (10, ('pandas',), True),
+])
+def test_check_budget(budget_ms, heavy_modules, expected_ok):
+    """Test that only top-level imports count towards the budget"""
+    total_ms, heavy, ok = check_budget(
+            parse_importtime(IMPORTTIME_OUTPUT), budget_ms=budget_ms,
+            heavy_modules=heavy_modules)
+    assert total_ms == pytest.approx(7.6)
+    assert heavy == [m for m in heavy_modules if m == 'numpy']
+    assert ok == expected_ok
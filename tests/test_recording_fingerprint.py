@@ -0,0 +1,91 @@
+import pytest
+import os
+import tempfile
+import shutil
+
+from src import recording_fingerprint
+from src.recording_fingerprint import fingerprint_recording, is_hashed, is_raw
+
+@pytest.fixture
+def temp_dir():
+    """Create a temporary directory for testing"""
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+@pytest.fixture
+def mock_recording(temp_dir):
+    """Create a mock recording with a large amplifier file"""
+    data_folder = os.path.join(temp_dir, 'test_data')
+    os.makedirs(os.path.join(data_folder, 'session1'))
+    files = {
+        'test_data.info': b'{"taste_params": ["water"]}',
+        'info.rhd': os.urandom(500),
+        'amp-A-000.dat': os.urandom(2 * recording_fingerprint.SAMPLE_MIN_SIZE),
+        os.path.join('session1', 'events.txt'): b'events',
+    }
+    for rel_file, data in files.items():
+        with open(os.path.join(data_folder, rel_file), 'wb') as f:
+            f.write(data)
+    return data_folder
+
+def test_is_hashed():
+    """Test which files are hashed in full"""
+    assert is_hashed('info.rhd')
+    assert is_hashed('test_data.info')
+    assert not is_hashed('amp-A-000.dat')
+
+def test_is_raw():
+    """Test which files are part of the fingerprint"""
+    assert is_raw('info.rhd')
+    assert is_raw('test_data.info')
+    assert is_raw(os.path.join('session1', 'amp-A-000.dat'))
+    assert not is_raw('test_data.h5')
+    assert not is_raw(os.path.join('Plots', 'unit_1.png'))
+
+def test_fingerprint_ignores_names(temp_dir, mock_recording):
+    """Test that renaming a recording or its files keeps its fingerprint"""
+    fingerprint = fingerprint_recording(mock_recording)
+    assert len(fingerprint) == recording_fingerprint.FINGERPRINT_SIZE
+
+    renamed = os.path.join(temp_dir, 'renamed')
+    shutil.copytree(mock_recording, renamed)
+    os.rename(os.path.join(renamed, 'test_data.info'), os.path.join(renamed, 'renamed.info'))
+    os.rename(os.path.join(renamed, 'session1'), os.path.join(renamed, 'session_a'))
+    assert fingerprint_recording(renamed) == fingerprint
+
+@pytest.mark.parametrize('rel_file, offset', [
+    ('amp-A-000.dat', 0),
+    ('amp-A-000.dat', recording_fingerprint.SAMPLE_MIN_SIZE),
+    ('amp-A-000.dat', 2 * recording_fingerprint.SAMPLE_MIN_SIZE - 1),
+    ('info.rhd', 100),
+    ('test_data.info', 5),
+])
+def test_fingerprint_detects_content_changes(temp_dir, mock_recording, rel_file, offset):
+    """Test that headers and sampled blocks are part of the fingerprint"""
+    other = os.path.join(temp_dir, 'other')
+    shutil.copytree(mock_recording, other)
+    with open(os.path.join(other, rel_file), 'r+b') as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    assert fingerprint_recording(other) != fingerprint_recording(mock_recording)
+
+def test_fingerprint_detects_size_changes(temp_dir, mock_recording):
+    """Test that file sizes are part of the fingerprint"""
+    other = os.path.join(temp_dir, 'other')
+    shutil.copytree(mock_recording, other)
+    with open(os.path.join(other, 'amp-A-000.dat'), 'ab') as f:
+        f.write(b'!')
+    assert fingerprint_recording(other) != fingerprint_recording(mock_recording)
+
+def test_fingerprint_ignores_derived_files(temp_dir, mock_recording):
+    """Test that preprocessing outputs do not change the fingerprint"""
+    fingerprint = fingerprint_recording(mock_recording)
+    os.makedirs(os.path.join(mock_recording, 'Plots'))
+    for rel_file in ['test_data.h5', os.path.join('Plots', 'unit_1.png'),
+                     os.path.join('session1', 'events.txt')]:
+        with open(os.path.join(mock_recording, rel_file), 'ab') as f:
+            f.write(os.urandom(1000))
+    assert fingerprint_recording(mock_recording) == fingerprint
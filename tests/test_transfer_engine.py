@@ -0,0 +1,800 @@
+import pytest
+import os
+import errno
+import shutil
+import hashlib
+import threading
+from unittest.mock import patch, MagicMock
+from io import StringIO
+
+from src import transfer_engine
+from src.transfer_engine import (
+    get_file_sizes,
+    schedule_largest_first,
+    copy_file,
+    copy_files,
+    TransferJournal,
+    PARTIAL_SUFFIX,
+    compare_files,
+    plan_delta_sync,
+    write_manifest,
+    read_manifest,
+    MANIFEST_NAME,
+    scan_recording,
+    stream_copy,
+    AdaptiveConcurrency,
+    TransferControls,
+    record_throughput,
+    estimate_mb_per_s,
+    preflight,
+    read_meminfo,
+    PageCacheMonitor,
+    plan_segments,
+    copy_file_segmented,
+    retry_delay,
+    FILE_RETRIES,
+    LiveRecording,
+    follow_recording,
+    snapshot_destination,
+    missing_dirs,
+)
+from tests.conftest import read_bytes
+
+def test_schedule_largest_first(mock_recording):
+    """Test that files are ordered by decreasing size"""
+    data_folder, _, file_sizes = mock_recording
+    rel_file_list = sorted(file_sizes)
+    sizes = get_file_sizes(data_folder, rel_file_list)
+    assert sizes == file_sizes
+
+    schedule = schedule_largest_first(rel_file_list, sizes)
+    assert schedule[0] == 'amp-A-001.dat'
+    assert schedule[-1] == 'test.info'
+
+def test_copy_file(mock_recording):
+    """Test copying a single file"""
+    data_folder, server_data_folder, _ = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-000.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-000.dat')
+
+    n_bytes, digest = copy_file(src_path, dst_path)
+
+    assert n_bytes == 3000
+    assert digest == hashlib.blake2b(read_bytes(src_path)).hexdigest()
+    assert read_bytes(src_path) == read_bytes(dst_path)
+    assert os.path.getmtime(src_path) == os.path.getmtime(dst_path)
+
+@pytest.mark.parametrize('n_workers', [1, 4])
+def test_copy_files(mock_recording, n_workers):
+    """Test copying a recording with one or more workers"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+
+    with patch('sys.stderr', new=StringIO()):
+        report = copy_files(data_folder, server_data_folder,
+                            list(file_sizes), n_workers=n_workers)
+
+    assert sorted(report['copied']) == sorted(file_sizes)
+    assert report['failed'] == {}
+    assert report['bytes_copied'] == sum(file_sizes.values())
+    for rel_file in file_sizes:
+        assert read_bytes(os.path.join(data_folder, rel_file)) == \
+            read_bytes(os.path.join(server_data_folder, rel_file))
+
+@pytest.mark.parametrize('error', [OSError(5, 'Input/output error'),
+                                   ValueError('Digest mismatch')])
+def test_copy_files_collects_errors(mock_recording, error):
+    """Test that a failing file does not stop the other files"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    real_copy_file = transfer_engine.copy_file
+
+    def flaky_copy_file(src_path, dst_path, *args):
+        if src_path.endswith('amp-A-001.dat'):
+            raise error
+        return real_copy_file(src_path, dst_path, *args)
+
+    with patch('src.transfer_engine.copy_file', side_effect=flaky_copy_file), \
+         patch('src.transfer_engine.retry_delay', return_value=0), \
+         patch('sys.stderr', new=StringIO()):
+        report = copy_files(data_folder, server_data_folder,
+                            list(file_sizes), n_workers=2)
+
+    assert list(report['failed']) == ['amp-A-001.dat']
+    assert len(report['copied']) == len(file_sizes) - 1
+    assert not os.path.exists(os.path.join(server_data_folder, 'amp-A-001.dat'))
+
+def test_copy_file_resumes_from_journal(mock_recording, temp_dir):
+    """Test that an interrupted copy resumes from the last committed offset"""
+    data_folder, server_data_folder, _ = mock_recording
+    rel_file = 'amp-A-001.dat'
+    src_path = os.path.join(data_folder, rel_file)
+    dst_path = os.path.join(server_data_folder, rel_file)
+    src_bytes = read_bytes(src_path)
+
+    # Simulate a copy killed after committing 2000 bytes, with some
+    # uncommitted garbage written after the commit
+    with open(dst_path + PARTIAL_SUFFIX, 'wb') as f:
+        f.write(src_bytes[:2000] + b'garbage')
+    journal = TransferJournal(
+            os.path.join(temp_dir, 'journal.json'), server_data_folder)
+    journal.commit(rel_file, os.stat(src_path), 2000)
+
+    # Journal is reloaded from disk, as on a rerun
+    journal = TransferJournal(
+            os.path.join(temp_dir, 'journal.json'), server_data_folder)
+    n_bytes, digest = copy_file(src_path, dst_path, journal=journal, rel_file=rel_file)
+
+    assert n_bytes == len(src_bytes) - 2000
+    # Digest covers the whole file, not only the resumed part
+    assert digest == hashlib.blake2b(src_bytes).hexdigest()
+    assert read_bytes(dst_path) == src_bytes
+    assert not os.path.exists(dst_path + PARTIAL_SUFFIX)
+    # Journal is removed once nothing is left in flight
+    assert not os.path.exists(journal.journal_path)
+
+def test_journal_ignores_changed_source(mock_recording, temp_dir):
+    """Test that a journal entry is ignored if the source has changed"""
+    data_folder, server_data_folder, _ = mock_recording
+    rel_file = 'amp-A-001.dat'
+    src_path = os.path.join(data_folder, rel_file)
+
+    journal = TransferJournal(
+            os.path.join(temp_dir, 'journal.json'), server_data_folder)
+    journal.commit(rel_file, os.stat(src_path), 2000)
+    assert journal.get_offset(rel_file, os.stat(src_path)) == 2000
+
+    with open(src_path, 'ab') as f:
+        f.write(b'more data')
+    assert journal.get_offset(rel_file, os.stat(src_path)) == 0
+
+    # A journal for a different destination is not used
+    other_journal = TransferJournal(journal.journal_path, '/other/destination')
+    assert other_journal.entries == {}
+
+def test_journal_for_recording(temp_dir):
+    """Test that recordings with the same name do not share a journal"""
+    journal_dir = os.path.join(temp_dir, 'journals')
+    paths = set(
+        TransferJournal.for_recording(data_folder, server_data_folder, journal_dir).journal_path
+        for data_folder, server_data_folder in [
+            ('/rig1/test', '/server/user1/test'),
+            ('/rig2/test', '/server/user1/test'),
+            ('/rig1/test', '/server/user2/test'),
+        ])
+    assert len(paths) == 3
+    assert all(os.path.basename(p).startswith('test-') for p in paths)
+    assert TransferJournal.for_recording(
+            '/rig1/test', '/server/user1/test', journal_dir).journal_path in paths
+
+def test_compare_files(mock_recording):
+    """Test deciding whether to skip, copy or overwrite a file"""
+    data_folder, server_data_folder, _ = mock_recording
+    rel_file = 'amp-A-000.dat'
+    src_path = os.path.join(data_folder, rel_file)
+    dst_path = os.path.join(server_data_folder, rel_file)
+
+    assert compare_files(src_path, dst_path) == 'copy'
+
+    copy_file(src_path, dst_path)
+    assert compare_files(src_path, dst_path) == 'skip'
+
+    # Same contents, different mtime
+    src_stat = os.stat(src_path)
+    os.utime(dst_path, (src_stat.st_atime, src_stat.st_mtime - 100))
+    assert compare_files(src_path, dst_path) == 'overwrite'
+    assert compare_files(src_path, dst_path, checksum=True) == 'skip'
+
+    # Same size, different contents
+    with open(dst_path, 'r+b') as f:
+        f.write(b'x')
+    os.utime(dst_path, (src_stat.st_atime, src_stat.st_mtime - 100))
+    assert compare_files(src_path, dst_path, checksum=True) == 'overwrite'
+
+    # Truncated copy
+    with open(dst_path, 'wb') as f:
+        f.write(b'x')
+    assert compare_files(src_path, dst_path) == 'overwrite'
+
+def test_plan_delta_sync(mock_recording):
+    """Test planning a re-upload after new files were added"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    with patch('sys.stderr', new=StringIO()):
+        copy_files(data_folder, server_data_folder, list(file_sizes))
+
+    with open(os.path.join(data_folder, 'post_hoc.txt'), 'w') as f:
+        f.write('new file')
+
+    plan = plan_delta_sync(data_folder, server_data_folder,
+                           list(file_sizes) + ['post_hoc.txt'])
+    assert plan['copy'] == ['post_hoc.txt']
+    assert plan['overwrite'] == []
+    assert sorted(plan['skip']) == sorted(file_sizes)
+    assert plan['bytes_skipped'] == sum(file_sizes.values())
+
+def test_snapshot_destination(mock_recording):
+    """Test taking the state of a server folder in one walk"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    assert snapshot_destination(os.path.join(server_data_folder, 'missing')) == ((set(), {}))
+
+    with patch('sys.stderr', new=StringIO()):
+        copy_files(data_folder, server_data_folder, list(file_sizes))
+    snapshot = snapshot_destination(server_data_folder)
+    assert snapshot.dirs == {'session1'}
+    assert sorted(snapshot.files) == sorted(file_sizes)
+    for rel_file, size in file_sizes.items():
+        assert snapshot.files[rel_file].st_size == size
+
+def test_plan_delta_sync_uses_snapshot(mock_recording):
+    """Test that planning from a snapshot does not touch the server per file"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    with patch('sys.stderr', new=StringIO()):
+        copy_files(data_folder, server_data_folder, ['amp-A-000.dat'])
+    snapshot = snapshot_destination(server_data_folder)
+
+    with patch('os.stat', wraps=os.stat) as mock_stat, \
+         patch('os.path.exists', wraps=os.path.exists) as mock_exists:
+        plan = plan_delta_sync(data_folder, server_data_folder, list(file_sizes),
+                               snapshot=snapshot)
+    server_calls = [c for c in mock_stat.call_args_list + mock_exists.call_args_list
+                    if str(c.args[0]).startswith(server_data_folder)]
+    assert server_calls == []
+    assert plan['skip'] == ['amp-A-000.dat']
+    assert sorted(plan['copy']) == sorted(f for f in file_sizes if f != 'amp-A-000.dat')
+
+def test_missing_dirs():
+    """Test that only the deepest missing directory of each branch is created"""
+    snapshot = transfer_engine.DestinationSnapshot({'a'}, {})
+    rel_dirs = ['a', os.path.join('a', 'b'), os.path.join('a', 'b', 'c'),
+                'ab', 'd', os.path.join('d', 'e')]
+    assert missing_dirs(rel_dirs, snapshot) == [
+        os.path.join('a', 'b', 'c'), 'ab', os.path.join('d', 'e')]
+    assert missing_dirs([], snapshot) == []
+
+def test_write_manifest(mock_recording):
+    """Test writing a manifest from streamed and previous digests"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    with patch('sys.stderr', new=StringIO()):
+        report = copy_files(data_folder, server_data_folder, list(file_sizes))
+    assert sorted(report['digests']) == sorted(file_sizes)
+
+    fingerprint = write_manifest(
+            data_folder, server_data_folder, list(file_sizes), report['digests'])
+    manifest_path = os.path.join(server_data_folder, MANIFEST_NAME)
+    assert fingerprint == hashlib.blake2b(read_bytes(manifest_path)).hexdigest()
+
+    manifest = read_manifest(server_data_folder)
+    assert sorted(manifest) == sorted(file_sizes)
+    for rel_file, size in file_sizes.items():
+        src_bytes = read_bytes(os.path.join(data_folder, rel_file))
+        assert manifest[rel_file]['size'] == str(size)
+        assert manifest[rel_file]['digest'] == hashlib.blake2b(src_bytes).hexdigest()
+
+    # Rewriting without streamed digests reuses the previous manifest
+    with patch('src.transfer_engine.hash_file', wraps=transfer_engine.hash_file) as mock_hash:
+        new_fingerprint = write_manifest(
+                data_folder, server_data_folder, list(file_sizes), {})
+    assert new_fingerprint == fingerprint
+    # Only the manifest itself is hashed
+    assert mock_hash.call_count == 1
+
+def test_scan_recording(mock_recording):
+    """Test walking a recording in a single scandir pass"""
+    data_folder, _, file_sizes = mock_recording
+    with open(os.path.join(data_folder, '.hidden'), 'w') as f:
+        f.write('hidden')
+
+    plan = list(scan_recording(data_folder))
+
+    dirs = [e.rel_path for e in plan if e.is_dir]
+    files = {e.rel_path: e.size for e in plan if not e.is_dir}
+    assert dirs == ['session1']
+    assert files == file_sizes
+    # Directories come before their contents
+    rel_paths = [e.rel_path for e in plan]
+    assert rel_paths.index('session1') < \
+        rel_paths.index(os.path.join('session1', 'test_file.txt'))
+
+def test_stream_copy(mock_recording):
+    """Test copying while the plan is being generated"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    shutil.rmtree(os.path.join(server_data_folder, 'session1'))
+
+    # Copying must start before the plan is exhausted
+    copied_during_walk = []
+    def slow_plan():
+        for entry in scan_recording(data_folder):
+            yield entry
+        copied_during_walk.extend(os.listdir(server_data_folder))
+
+    with patch('sys.stderr', new=StringIO()), \
+         patch('src.transfer_engine.STREAM_QUEUE_PER_WORKER', 1):
+        report = stream_copy(data_folder, server_data_folder, slow_plan(), n_workers=1)
+
+    assert copied_during_walk
+    assert sorted(report['files']) == sorted(file_sizes)
+    assert sorted(report['copied']) == sorted(file_sizes)
+    assert report['bytes_copied'] == sum(file_sizes.values())
+    for rel_file in file_sizes:
+        assert read_bytes(os.path.join(data_folder, rel_file)) == \
+            read_bytes(os.path.join(server_data_folder, rel_file))
+
+    # A second pass skips everything
+    with patch('sys.stderr', new=StringIO()):
+        report = stream_copy(data_folder, server_data_folder,
+                             scan_recording(data_folder), n_workers=2)
+    assert report['copied'] == []
+    assert sorted(report['skipped']) == sorted(file_sizes)
+    assert report['bytes_skipped'] == sum(file_sizes.values())
+
+def test_adaptive_concurrency():
+    """Test that the worker limit follows measured throughput and latency"""
+    clock = [0.0]
+    with patch('src.transfer_engine.time.monotonic', side_effect=lambda: clock[0]):
+        concurrency = AdaptiveConcurrency(max_workers=4, start_workers=2, interval=1)
+
+        def record_second(n_bytes, latency):
+            clock[0] += 1
+            concurrency.record(n_bytes, latency)
+
+        # Throughput keeps improving, limit rises up to the maximum
+        for n_bytes in [100, 200, 300]:
+            record_second(n_bytes, 0.01)
+        assert concurrency.limit == 4
+        # No further improvement, limit stays
+        record_second(300, 0.01)
+        assert concurrency.limit == 4
+        # Throughput collapses, limit backs off
+        record_second(100, 0.01)
+        assert concurrency.limit == 3
+        # Stable throughput but latency far above the best seen
+        record_second(100, 1.0)
+        assert concurrency.limit == 2
+
+    assert [h['workers'] for h in concurrency.history] == [2, 3, 4, 4, 4, 3]
+
+def test_adaptive_concurrency_slots():
+    """Test that no more than limit copies hold a slot"""
+    controls = TransferControls(n_workers=4, adaptive=True)
+    controls.concurrency.limit = 1
+    with controls.slot():
+        assert controls.concurrency.active == 1
+        acquired = threading.Event()
+        def worker():
+            with controls.slot():
+                acquired.set()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert not acquired.wait(0.1)
+    thread.join(1)
+    assert acquired.is_set()
+
+def test_copy_files_throttled(mock_recording):
+    """Test copying with a bandwidth cap and adaptive concurrency"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    with patch('sys.stderr', new=StringIO()), \
+         patch('src.transfer_engine.RateLimiter.consume') as mock_consume:
+        report = copy_files(data_folder, server_data_folder, list(file_sizes),
+                            n_workers=3, max_mb_per_s=10, adaptive=True)
+
+    assert sorted(report['copied']) == sorted(file_sizes)
+    assert sum(c[0][0] for c in mock_consume.call_args_list) == sum(file_sizes.values())
+    settings = report['settings']
+    assert settings['max_workers'] == 3
+    assert settings['max_mb_per_s'] == 10
+    assert settings['adaptive']
+    assert 1 <= settings['final_workers'] <= 3
+
+def test_schedule_fair():
+    """Test that schedules of several recordings are interleaved"""
+    schedule = transfer_engine.schedule_fair([['a1', 'a2', 'a3'], ['b1'], ['c1', 'c2']])
+    assert schedule == [(0, 'a1'), (1, 'b1'), (2, 'c1'), (0, 'a2'), (2, 'c2'), (0, 'a3')]
+
+def test_copy_batch(temp_dir, mock_recording):
+    """Test copying two recordings with one shared pool"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    data_folder_2 = os.path.join(temp_dir, 'test_data_2')
+    shutil.copytree(data_folder, data_folder_2)
+    server_data_folder_2 = os.path.join(temp_dir, 'server', 'test_data_2')
+    os.makedirs(os.path.join(server_data_folder_2, 'session1'))
+
+    jobs = [
+        dict(data_folder=data_folder, server_data_folder=server_data_folder,
+             rel_file_list=list(file_sizes)),
+        dict(data_folder=data_folder_2, server_data_folder=server_data_folder_2,
+             rel_file_list=['amp-A-001.dat']),
+    ]
+    with patch('sys.stderr', new=StringIO()):
+        reports = transfer_engine.copy_batch(jobs, n_workers=3, max_mb_per_s=100)
+
+    assert sorted(reports[0]['copied']) == sorted(file_sizes)
+    assert reports[1]['copied'] == ['amp-A-001.dat']
+    assert reports[1]['bytes_copied'] == file_sizes['amp-A-001.dat']
+    assert read_bytes(os.path.join(server_data_folder_2, 'amp-A-001.dat')) == \
+        read_bytes(os.path.join(data_folder_2, 'amp-A-001.dat'))
+    # Settings describe the whole batch
+    assert reports[0]['settings'] is reports[1]['settings']
+    assert reports[0]['settings']['max_mb_per_s'] == 100
+
+def test_record_and_estimate_throughput(temp_dir):
+    """Test that the estimate is the median of recent logged transfers"""
+    log_path = os.path.join(temp_dir, 'local_only_files', 'transfer_throughput.csv')
+    assert estimate_mb_per_s(log_path) is None
+
+    settings = dict(max_workers=4, max_mb_per_s=None)
+    # Small transfers are not representative and are not logged
+    record_throughput(dict(settings, mean_mb_per_s=1.0), 1000, log_path)
+    assert not os.path.exists(log_path)
+
+    for mean_mb_per_s in [10, 50, 30] + [40] * transfer_engine.THROUGHPUT_HISTORY:
+        record_throughput(dict(settings, mean_mb_per_s=mean_mb_per_s),
+                          transfer_engine.THROUGHPUT_MIN_BYTES, log_path)
+    assert estimate_mb_per_s(log_path) == pytest.approx(40)
+
+def test_preflight(temp_dir):
+    """Test the free space check and duration estimate"""
+    log_path = os.path.join(temp_dir, 'transfer_throughput.csv')
+    gb = 1024**3
+    with patch('src.transfer_engine.get_free_bytes', return_value=10 * gb):
+        check = preflight(temp_dir, 20 * gb, 5 * gb, log_path=log_path)
+        assert check['enough_space']
+        assert check['free_bytes'] == 10 * gb
+        assert check['eta_seconds'] is None
+
+        # Margin is kept on top of the bytes to copy
+        check = preflight(temp_dir, 20 * gb, 10 * gb, log_path=log_path)
+        assert not check['enough_space']
+
+        # The cap bounds the expected throughput
+        record_throughput(dict(max_workers=1, max_mb_per_s=None, mean_mb_per_s=100),
+                          5 * gb, log_path)
+        check = preflight(temp_dir, 20 * gb, 5 * gb, max_mb_per_s=50, log_path=log_path)
+        assert check['mb_per_s'] == 50
+        assert check['eta_seconds'] == pytest.approx(5 * 1024 / 50)
+
+    # Free space is read from the filesystem
+    assert preflight(temp_dir, 0, 0, log_path=log_path)['free_bytes'] > 0
+
+def write_meminfo(path, cached_kb, dirty_kb):
+    with open(path, 'w') as f:
+        f.write(f"MemTotal:       16000000 kB\n"
+                f"Cached:         {cached_kb} kB\n"
+                f"Dirty:          {dirty_kb} kB\n"
+                f"Writeback:             0 kB\n")
+
+def test_read_meminfo(temp_dir):
+    """Test parsing page cache fields in bytes"""
+    meminfo_path = os.path.join(temp_dir, 'meminfo')
+    assert read_meminfo(meminfo_path) is None
+    write_meminfo(meminfo_path, 2048, 16)
+    assert read_meminfo(meminfo_path) == dict(
+        Cached=2048 * 1024, Dirty=16 * 1024, Writeback=0)
+
+def test_page_cache_monitor(temp_dir):
+    """Test that the monitor reports growth of the page cache over its baseline"""
+    meminfo_path = os.path.join(temp_dir, 'meminfo')
+    assert PageCacheMonitor(meminfo_path=meminfo_path).stop() is None
+
+    write_meminfo(meminfo_path, 1024**2, 0)
+    monitor = PageCacheMonitor(interval=60, meminfo_path=meminfo_path)
+    write_meminfo(meminfo_path, 3 * 1024**2, 1024)
+    monitor._sample()
+    write_meminfo(meminfo_path, 1024**2 + 1024, 0)
+    page_cache = monitor.stop()
+    assert page_cache['baseline_mb'] == 1024
+    assert page_cache['peak_increase_mb'] == 2048
+    assert page_cache['final_increase_mb'] == 1
+    assert page_cache['peak_dirty_mb'] == 1
+
+@pytest.mark.skipif(not hasattr(os, 'posix_fadvise'), reason='needs posix_fadvise')
+def test_copy_file_drop_cache(mock_recording):
+    """Test that copied pages are dropped from the page cache as the copy goes"""
+    data_folder, server_data_folder, _ = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-001.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-001.dat')
+    controls = TransferControls(drop_cache=True)
+
+    with patch('src.transfer_engine.CACHE_DROP_INTERVAL', 1000), \
+         patch('src.copy_backends.BACKEND_BUFFER_SIZE', 1000), \
+         patch('src.copy_backends._thread_buffers', threading.local()), \
+         patch('os.posix_fadvise', wraps=os.posix_fadvise) as mock_fadvise:
+        n_bytes, _ = copy_file(src_path, dst_path, controls=controls)
+
+    assert n_bytes == 5000
+    assert read_bytes(src_path) == read_bytes(dst_path)
+    advice = [c.args[3] for c in mock_fadvise.call_args_list]
+    assert advice[0] == os.POSIX_FADV_SEQUENTIAL
+    # Both files are dropped after every 1000 bytes and at the end
+    assert advice.count(os.POSIX_FADV_DONTNEED) == 2 * (5 + 1)
+
+def test_copy_files_reports_page_cache(mock_recording):
+    """Test that transfers report page cache growth when it can be measured"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    with patch('sys.stdout', new=StringIO()):
+        report = copy_files(data_folder, server_data_folder, sorted(file_sizes),
+                            drop_cache=True)
+    assert report['settings']['drop_cache']
+    if os.path.exists(transfer_engine.MEMINFO_PATH):
+        assert report['settings']['page_cache']['baseline_mb'] > 0
+    else:
+        assert report['settings']['page_cache'] is None
+
+def test_plan_segments():
+    """Test splitting a file into byte ranges"""
+    assert plan_segments(2500, 1000) == [(0, 1000), (1000, 2000), (2000, 2500)]
+    assert plan_segments(0, 1000) == []
+
+@pytest.fixture
+def small_segments():
+    """Use small segments so the mock recording is split"""
+    with patch('src.transfer_engine.SEGMENT_SIZE', 1000):
+        yield
+
+def test_copy_file_segmented(mock_recording, small_segments):
+    """Test that large files are copied in segments with the same digest"""
+    data_folder, server_data_folder, _ = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-001.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-001.dat')
+    controls = TransferControls(segment_workers=3, segment_above=4000)
+
+    with patch('src.transfer_engine.copy_file_segmented',
+               wraps=copy_file_segmented) as mock_segmented:
+        n_bytes, digest = copy_file(src_path, dst_path, controls=controls)
+        # Files below segment_above are copied in one piece
+        copy_file(os.path.join(data_folder, 'amp-A-000.dat'),
+                  os.path.join(server_data_folder, 'amp-A-000.dat'), controls=controls)
+    assert mock_segmented.call_count == 1
+
+    assert n_bytes == 5000
+    assert digest == hashlib.blake2b(read_bytes(src_path)).hexdigest()
+    assert read_bytes(src_path) == read_bytes(dst_path)
+    assert os.path.getmtime(src_path) == os.path.getmtime(dst_path)
+    assert not os.path.exists(dst_path + PARTIAL_SUFFIX)
+
+def test_copy_file_segmented_retries(mock_recording, temp_dir, small_segments):
+    """Test that a retried file only copies again the segments which had not finished"""
+    data_folder, server_data_folder, _ = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-001.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-001.dat')
+    journal = TransferJournal(os.path.join(temp_dir, 'journal.json'), server_data_folder)
+    controls = TransferControls(segment_workers=1)
+    pwrite = os.pwrite
+    calls = []
+
+    def flaky_pwrite(fd, data, offset):
+        calls.append(offset)
+        if len(calls) == 3:
+            raise OSError(errno.EIO, 'Input/output error')
+        return pwrite(fd, data, offset)
+
+    def copy(progress):
+        return copy_file_segmented(src_path, dst_path, progress, journal,
+                                   'amp-A-001.dat', controls)
+
+    with patch('os.pwrite', side_effect=flaky_pwrite), \
+         patch('src.transfer_engine.retry_delay', return_value=0):
+        n_bytes, digest = controls.retry(copy)
+    # Only the failed segment is copied twice, finished ones are in the journal
+    assert sorted(calls) == [0, 1000, 2000, 2000, 3000, 4000]
+    assert n_bytes < 5000
+    assert read_bytes(src_path) == read_bytes(dst_path)
+
+    # Errors which are not transient are not retried
+    calls.clear()
+    with patch('os.pwrite', side_effect=OSError(errno.ENOSPC, 'No space left on device')), \
+         patch('src.transfer_engine.retry_delay', return_value=0):
+        with pytest.raises(OSError):
+            controls.retry(lambda progress: copy_file_segmented(
+                src_path, dst_path + '.copy', progress, controls=controls))
+    assert controls.n_failed == 1
+
+def test_copy_file_segmented_resumes(mock_recording, temp_dir, small_segments):
+    """Test that only unfinished segments are copied again"""
+    data_folder, server_data_folder, _ = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-001.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-001.dat')
+    journal = TransferJournal(os.path.join(temp_dir, 'journal.json'), server_data_folder)
+    controls = TransferControls(segment_workers=1)
+
+    # Simulate an interrupted copy with segments 0 and 3 on the server
+    src_stat = os.stat(src_path)
+    with open(dst_path + PARTIAL_SUFFIX, 'wb') as f:
+        f.truncate(5000)
+        data = read_bytes(src_path)
+        for index in [0, 3]:
+            f.seek(index * 1000)
+            f.write(data[index * 1000:(index + 1) * 1000])
+            journal.commit_segment('amp-A-001.dat', src_stat, index)
+    assert journal.get_segments('amp-A-001.dat', src_stat) == {0, 3}
+
+    n_bytes, digest = copy_file_segmented(src_path, dst_path, journal=journal,
+                                          rel_file='amp-A-001.dat', controls=controls)
+    assert n_bytes == 3000
+    assert digest == hashlib.blake2b(data).hexdigest()
+    assert read_bytes(dst_path) == data
+    assert journal.entries == {}
+
+def test_copy_file_segmented_verifies_server_file(mock_recording, small_segments):
+    """Test that the digest is taken from the server file and bad segments are caught"""
+    data_folder, server_data_folder, _ = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-001.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-001.dat')
+    controls = TransferControls(segment_workers=2)
+    pwrite = os.pwrite
+
+    def corrupt_pwrite(fd, data, offset):
+        if offset == 2000:
+            data = bytes(len(data))
+        return pwrite(fd, data, offset)
+
+    with patch('os.pwrite', side_effect=corrupt_pwrite):
+        with pytest.raises(OSError, match='Segment 2'):
+            copy_file_segmented(src_path, dst_path, controls=controls)
+    assert not os.path.exists(dst_path)
+
+def test_copy_file_segmented_interrupted(mock_recording, small_segments):
+    """Test that segments not yet started are cancelled on any exception"""
+    data_folder, server_data_folder, _ = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-001.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-001.dat')
+    controls = TransferControls(segment_workers=1)
+    calls = []
+
+    def interrupted_copy_segment(*args):
+        calls.append(args[2])
+        raise KeyboardInterrupt
+
+    with patch('src.transfer_engine.copy_segment', side_effect=interrupted_copy_segment):
+        with pytest.raises(KeyboardInterrupt):
+            copy_file_segmented(src_path, dst_path, controls=controls)
+    assert len(calls) < 5
+    assert not os.path.exists(dst_path)
+
+def test_retry_delay():
+    """Test that backoff grows exponentially up to the maximum, with jitter"""
+    for attempt in range(10):
+        bound = min(transfer_engine.RETRY_MAX_DELAY,
+                    transfer_engine.RETRY_BASE_DELAY * 2**attempt)
+        delays = [retry_delay(attempt) for _ in range(20)]
+        assert all(0 <= d <= bound for d in delays)
+        assert len(set(delays)) > 1
+
+def test_copy_files_retries_transient_errors(mock_recording):
+    """Test that files hit by transient errors are retried and resumed"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    real_copy_file = transfer_engine.copy_file
+    attempts = []
+
+    def flaky_copy_file(src_path, dst_path, progress, *args):
+        if src_path.endswith('amp-A-001.dat'):
+            attempts.append(src_path)
+            if len(attempts) <= 2:
+                # Fail part way, after some bytes were reported
+                progress.update(1000)
+                raise OSError(116, 'Stale file handle')
+        return real_copy_file(src_path, dst_path, progress, *args)
+
+    with patch('src.transfer_engine.copy_file', side_effect=flaky_copy_file), \
+         patch('src.transfer_engine.retry_delay', return_value=0) as mock_delay, \
+         patch('sys.stderr', new=StringIO()):
+        report = copy_files(data_folder, server_data_folder, list(file_sizes))
+
+    assert report['failed'] == {}
+    assert report['retried'] == {'amp-A-001.dat': 2}
+    assert len(attempts) == 3
+    assert [c.args[0] for c in mock_delay.call_args_list] == [0, 1]
+    assert read_bytes(os.path.join(data_folder, 'amp-A-001.dat')) == \
+        read_bytes(os.path.join(server_data_folder, 'amp-A-001.dat'))
+
+    with patch('sys.stdout', new=StringIO()) as mock_stdout:
+        transfer_engine.print_transfer_report(report)
+    assert 'Retried 1 files after transient errors, 1 of them copied' in mock_stdout.getvalue()
+
+def test_copy_files_permanent_errors_not_retried(mock_recording):
+    """Test that errors which are not transient fail the file at once"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    with patch('src.transfer_engine.copy_file',
+               side_effect=PermissionError(13, 'Permission denied')) as mock_copy, \
+         patch('sys.stderr', new=StringIO()):
+        report = copy_files(data_folder, server_data_folder, ['amp-A-001.dat'])
+    assert mock_copy.call_count == 1
+    assert list(report['failed']) == ['amp-A-001.dat']
+    assert report['retried'] == {}
+
+def test_copy_files_failure_budget(mock_recording):
+    """Test that files not yet started are given up once the budget is spent"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    with patch('src.transfer_engine.copy_file',
+               side_effect=OSError(5, 'Input/output error')) as mock_copy, \
+         patch('src.transfer_engine.retry_delay', return_value=0), \
+         patch('sys.stderr', new=StringIO()):
+        report = copy_files(data_folder, server_data_folder, list(file_sizes),
+                            retries=1, max_failures=1)
+    # The two largest files fail after one retry each, the others are not tried
+    assert mock_copy.call_count == 4
+    assert len(report['failed']) == len(file_sizes)
+    assert 'failure budget' in report['failed']['test.info']
+    assert report['settings']['budget_spent']
+    assert FILE_RETRIES > 1
+
+def append_bytes(path, n_bytes):
+    data = os.urandom(n_bytes)
+    with open(path, 'ab') as f:
+        f.write(data)
+    return data
+
+def test_live_recording(mock_recording):
+    """Test copying .dat files as they grow and finishing once settled"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-000.dat')
+    dst_path = os.path.join(server_data_folder, 'amp-A-000.dat')
+    live = LiveRecording(data_folder, server_data_folder)
+
+    assert live.poll(now=0) == 3000 + 5000
+    # Only .dat files are copied while the recording grows
+    assert os.path.getsize(dst_path + PARTIAL_SUFFIX) == 3000
+    assert not os.path.exists(os.path.join(server_data_folder, 'test.info'))
+    assert not live.is_settled(60, now=30)
+
+    # Only appended bytes are copied
+    append_bytes(src_path, 2000)
+    assert live.poll(now=40) == 2000
+    assert os.path.getsize(dst_path + PARTIAL_SUFFIX) == 5000
+    assert not live.is_settled(60, now=90)
+    assert live.poll(now=100) == 0
+    assert live.is_settled(60, now=100)
+
+    report = live.finalize()
+    assert report['failed'] == {}
+    assert sorted(report['copied']) == sorted(file_sizes)
+    assert report['bytes_copied'] == sum(file_sizes.values()) + 2000
+    for rel_file in file_sizes:
+        src = os.path.join(data_folder, rel_file)
+        dst = os.path.join(server_data_folder, rel_file)
+        assert read_bytes(src) == read_bytes(dst)
+        assert report['digests'][rel_file] == hashlib.blake2b(read_bytes(src)).hexdigest()
+        assert not os.path.exists(dst + PARTIAL_SUFFIX)
+    assert os.path.getmtime(src_path) == os.path.getmtime(dst_path)
+
+def test_live_recording_rewritten_file(mock_recording):
+    """Test that a file rewritten in place during acquisition is copied again"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-000.dat')
+    progress = MagicMock()
+    live = LiveRecording(data_folder, server_data_folder, progress=progress)
+    live.poll()
+
+    # Same size, different contents
+    with open(src_path, 'r+b') as f:
+        f.write(os.urandom(100))
+    live.poll()
+    report = live.finalize()
+    assert report['failed'] == {}
+    # The stale tail is taken back and the file copied again is reported to
+    # progress, which ends at the total
+    updates = [c.args[0] for c in progress.update.call_args_list]
+    assert -file_sizes['amp-A-000.dat'] in updates
+    reported = sum(updates)
+    assert reported == sum(c.args[0] for c in progress.add_total.call_args_list)
+    assert reported == sum(file_sizes.values())
+    assert read_bytes(src_path) == read_bytes(os.path.join(server_data_folder, 'amp-A-000.dat'))
+    assert report['digests']['amp-A-000.dat'] == \
+        hashlib.blake2b(read_bytes(src_path)).hexdigest()
+
+def test_follow_recording(mock_recording):
+    """Test following a recording until it stops growing"""
+    data_folder, server_data_folder, file_sizes = mock_recording
+    src_path = os.path.join(data_folder, 'amp-A-001.dat')
+    appended = []
+
+    def acquire(seconds):
+        # Acquisition writes two more blocks, then stops
+        if len(appended) < 2:
+            appended.append(append_bytes(src_path, 1000))
+
+    with patch('src.transfer_engine.time.sleep', side_effect=acquire), \
+         patch('sys.stderr', new=StringIO()):
+        report = follow_recording(data_folder, server_data_folder,
+                                  poll_seconds=0, settle_seconds=0.1)
+    assert len(appended) == 2
+    assert report['failed'] == {}
+    assert sorted(report['files']) == sorted(file_sizes)
+    assert read_bytes(src_path) == read_bytes(os.path.join(server_data_folder, 'amp-A-001.dat'))
@@ -0,0 +1,99 @@
+import pytest
+import os
+import tempfile
+import shutil
+
+from src.transfer_rules import (
+    get_rules_paths,
+    parse_rules,
+    load_rules,
+    matches,
+    is_included,
+    filter_files,
+    included_dirs,
+    RULES_NAME,
+    TEMPLATE_NAME,
+)
+
+@pytest.fixture
+def temp_dir():
+    """Create a temporary directory for testing"""
+    temp_dir = tempfile.mkdtemp()
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+def write_rules(dir_path, name, text):
+    os.makedirs(os.path.join(dir_path, 'local_only_files'), exist_ok=True)
+    with open(os.path.join(dir_path, 'local_only_files', name), 'w') as f:
+        f.write(text)
+
+def test_parse_rules():
+    """Test parsing rule lines"""
+    rules = parse_rules(["# Derived files\n", "exclude *.h5\n", "\n",
+                         "  include  keep/  \n"])
+    assert rules == [('exclude', '*.h5'), ('include', 'keep')]
+    with pytest.raises(ValueError):
+        parse_rules(["skip *.h5"])
+    with pytest.raises(ValueError):
+        parse_rules(["exclude"])
+
+def test_load_rules(temp_dir):
+    """Test that user rules are read after the rig rules"""
+    # Without rules files everything is transferred
+    assert load_rules('user1', temp_dir) == []
+    write_rules(temp_dir, 'transfer_rules_user1.txt', "include *.h5\n")
+    assert load_rules('user1', temp_dir) == [('include', '*.h5')]
+    write_rules(temp_dir, RULES_NAME, "")
+    assert load_rules(None, temp_dir) == []
+    write_rules(temp_dir, RULES_NAME, "exclude *.h5\nexclude plots\n")
+    write_rules(temp_dir, 'transfer_rules_user1.txt', "include *.h5\n")
+    assert load_rules(None, temp_dir) == [('exclude', '*.h5'), ('exclude', 'plots')]
+    assert load_rules('user1', temp_dir) == [
+        ('exclude', '*.h5'), ('exclude', 'plots'), ('include', '*.h5')]
+    assert load_rules('user2', temp_dir) == load_rules(None, temp_dir)
+    assert len(get_rules_paths('user1', temp_dir)) == 2
+
+def test_matches():
+    """Test matching names anywhere and paths from the top of the folder"""
+    path = os.path.join('session1', 'plots', 'unit_1.png')
+    assert matches('*.png', path)
+    assert matches('plots', path)
+    assert matches('session1/plots', path)
+    assert matches('session1/*', path)
+    assert not matches('plots/*.png', path)
+    assert not matches('*.h5', path)
+
+def test_is_included():
+    """Test that the last matching rule wins and unmatched files are kept"""
+    rules = [('exclude', 'plots'), ('include', 'plots/summary.png')]
+    assert is_included('amp-A-000.dat', rules)
+    assert not is_included(os.path.join('plots', 'unit_1.png'), rules)
+    assert is_included(os.path.join('plots', 'summary.png'), rules)
+    assert is_included('anything', [])
+
+def test_filter_files():
+    """Test splitting files and counting excluded bytes"""
+    file_sizes = {'amp-A-000.dat': 1000, 'data.h5': 5000, 'test.info': 10}
+    included, excluded, bytes_excluded = filter_files(
+        sorted(file_sizes), file_sizes, [('exclude', '*.h5')])
+    assert included == ['amp-A-000.dat', 'test.info']
+    assert excluded == ['data.h5']
+    assert bytes_excluded == 5000
+
+def test_template_rules():
+    """Test that the shipped template leaves out blech_clust outputs but not raw data"""
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(repo_dir, 'local_only_files', TEMPLATE_NAME), 'r') as f:
+        rules = parse_rules(f)
+    for rel_path in ['rec.h5', os.path.join('Plots', 'unit_1.png'),
+                     os.path.join('spike_waveforms', 'electrode00', 'w.npy')]:
+        assert not is_included(rel_path, rules)
+    for rel_path in ['amp-A-000.dat', 'info.rhd', 'rec.info', 'time.dat']:
+        assert is_included(rel_path, rules)
+
+def test_included_dirs():
+    """Test that an excluded directory is kept for a file included again"""
+    rules = [('exclude', 'Plots'), ('include', 'Plots/summary.png'), ('exclude', 'temp')]
+    rel_dir_list = ['Plots', 'temp', 'session1', os.path.join('session1', 'empty')]
+    assert included_dirs(rel_dir_list, [os.path.join('Plots', 'summary.png')], rules) == \
+        sorted(['Plots', 'session1', os.path.join('session1', 'empty')])